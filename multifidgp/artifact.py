@@ -0,0 +1,54 @@
+__doc__ = """
+Artifact
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Storage of fitted kriging models as uncompressed .npz archives. Because
+the members are stored uncompressed, each array can be memory-mapped
+directly from the archive, so prediction workers can open a fitted
+model without reading the factorization into memory.
+
+"""
+
+import struct
+import zipfile
+import numpy as np
+
+
+def save(path, arrays):
+    """Saves a dict of arrays to an uncompressed .npz archive at path."""
+    with open(path, 'wb') as fid:
+        np.savez(fid, **arrays)
+
+
+def load(path, mmap=True):
+    """Loads a dict of arrays saved by save(), memory-mapped if mmap is set."""
+    arrays = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as fid:
+        for info in archive.infolist():
+            name = info.filename[:-4]
+            if not mmap or info.compress_type != zipfile.ZIP_STORED:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            # Skip the local file header to reach the .npy member
+            fid.seek(info.header_offset)
+            header = fid.read(30)
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            fid.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(fid)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fid)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fid)
+            if dtype.hasobject or int(np.prod(shape)) == 0 or len(shape) == 0:
+                with archive.open(info) as member:
+                    arrays[name] = np.lib.format.read_array(member)
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', shape=shape,
+                                     order='F' if fortran_order else 'C', offset=fid.tell())
+    return arrays
@@ -0,0 +1,120 @@
+__doc__ = """
+Covariance models
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Covariance models used in place of the variogram as kriging matrix. m is
+[psill, range, nugget] as in variogram_models.py and the covariance is
+C(d) = psill + nugget - g(d) for the variogram g(d), with the nugget added
+at d = 0 [1].
+
+The compactly supported models, exactly zero beyond a finite distance,
+are the spherical model and the exponential model tapered by the
+Wendland function [2]. Their kriging matrices are assembled as
+scipy.sparse matrices from the site pairs within the support radius,
+found by KD-tree range queries.
+
+The separable models are products of one exponential or Gaussian factor
+per coordinate axis, which is the exponential model of the cityblock
+distance or the Gaussian model of the euclidean distance. On a lattice
+their kriging matrices are Kronecker products of the per-axis factors
+(see kronecker.py).
+
+References
+----------
+.. [1] P.K. Kitanidis, Introduction to Geostatistcs: Applications in
+Hydrogeology, (Cambridge University Press, 1997) 272 p.
+.. [2] Furrer, R., Genton, M. G., & Nychka, D. (2006). Covariance
+tapering for interpolation of large spatial datasets. Journal of
+Computational and Graphical Statistics, 15(3), 502-523.
+
+"""
+
+import numpy as np
+import scipy.sparse as sp
+from scipy.spatial import cKDTree
+from multifidgp.variogram_models import spherical_variogram_model
+from multifidgp.variogram_models import exponential_variogram_model
+from multifidgp.variogram_models import gaussian_variogram_model
+
+compact_kernels = ('spherical', 'wendland')
+separable_kernels = ('separable_exponential', 'separable_gaussian')
+
+
+def spherical_covariance_model(m, d):
+    """Spherical model, m is [psill, range, nugget]; zero beyond the range"""
+    psill = float(m[0])
+    nugget = float(m[2])
+    d = np.asarray(d, dtype=float)
+    return np.where(d == 0, psill + nugget, psill + nugget - spherical_variogram_model(m, d))
+
+
+def wendland_exponential_covariance_model(m, d, taper):
+    """Exponential model tapered by the Wendland function, m is [psill, range, nugget]; zero beyond taper"""
+    psill = float(m[0])
+    nugget = float(m[2])
+    d = np.asarray(d, dtype=float)
+    C = np.where(d == 0, psill + nugget, psill + nugget - exponential_variogram_model(m, d))
+    h = np.minimum(d/taper, 1.)
+    return C*(1. - h)**4*(1. + 4.*h)
+
+
+def separable_exponential_covariance_model(m, d):
+    """Product of exponential factors per axis, m is [psill, range, nugget]; d is the cityblock distance"""
+    psill = float(m[0])
+    nugget = float(m[2])
+    d = np.asarray(d, dtype=float)
+    return np.where(d == 0, psill + nugget, psill + nugget - exponential_variogram_model(m, d))
+
+
+def separable_gaussian_covariance_model(m, d):
+    """Product of Gaussian factors per axis, m is [psill, range, nugget]; d is the euclidean distance"""
+    psill = float(m[0])
+    nugget = float(m[2])
+    d = np.asarray(d, dtype=float)
+    return np.where(d == 0, psill + nugget, psill + nugget - gaussian_variogram_model(m, d))
+
+
+def axis_covariance(kernel, m, x1, x2):
+    """Factor of one coordinate axis of a separable kernel between the values x1 and x2, (n1, n2)."""
+    range_ = float(m[1])
+    d = abs(np.reshape(x1, (-1, 1)) - np.reshape(x2, (1, -1)))
+    if kernel == 'separable_exponential':
+        return np.exp(-d/(range_/3.))
+    return np.exp(-d**2./(range_*4./7.)**2.)
+
+
+def metric(kernel):
+    """Distance (scipy cdist metric) of which the covariance of kernel is a function."""
+    return 'cityblock' if kernel == 'separable_exponential' else 'euclidean'
+
+
+def support(kernel, m, taper=None):
+    """Distance beyond which the covariance of kernel is zero."""
+    if kernel == 'spherical':
+        return float(m[1])
+    return float(m[1]) if taper is None else float(taper)
+
+
+def covariance(kernel, m, d, taper=None):
+    """Covariance of kernel at distances d, see metric() for the distance."""
+    if kernel == 'spherical':
+        return spherical_covariance_model(m, d)
+    if kernel == 'separable_exponential':
+        return separable_exponential_covariance_model(m, d)
+    if kernel == 'separable_gaussian':
+        return separable_gaussian_covariance_model(m, d)
+    return wendland_exponential_covariance_model(m, d, support(kernel, m, taper))
+
+
+def sparse_covariance(kernel, m, X1, X2, taper=None):
+    """Assembles the (n1, n2) covariance matrix of kernel as a scipy.sparse CSR matrix."""
+    X1 = np.reshape(X1, (len(X1), -1))
+    X2 = np.reshape(X2, (len(X2), -1))
+    pairs = cKDTree(X1).sparse_distance_matrix(cKDTree(X2), support(kernel, m, taper), output_type='ndarray')
+    C = covariance(kernel, m, pairs['v'], taper)
+    return sp.csr_matrix((C, (pairs['i'], pairs['j'])), shape=(len(X1), len(X2)))
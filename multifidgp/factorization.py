@@ -0,0 +1,514 @@
+__doc__ = """
+Factorization
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Contains class Factorization, the shared solver used by the kriging and
+Bayesian experimental design classes. The kriging matrix is factored once
+with a Cholesky decomposition and every solve, quadratic form and
+log-determinant is taken from that factor. Matrices assembled from a
+variogram are generally not positive definite; those fall back to a
+pivoted LU factorization with the same interface. New observations are
+added by bordering the factor [2] rather than refactoring.
+
+Contains class SparseFactorization, the same interface for a kriging
+matrix whose first block is replaced by its FITC approximation through m
+inducing points [3]. Solves and log-determinants go through the Woodbury
+identity and a Schur complement, in O(N m^2) for that block.
+
+Contains class SparseMatrixFactorization, the same interface for a
+scipy.sparse kriging matrix of a compactly supported covariance, factored
+with a sparse LU decomposition (SuperLU) that keeps the fill-in low.
+
+Contains class KroneckerFactorization, the same interface for the kriging
+matrix of a separable kernel on a lattice, a Kronecker product of per-axis
+factors, inverted through their eigendecompositions [4].
+
+References
+----------
+.. [1] Rasmussen, C. E., & Williams, C. K. I. (2006). Gaussian Processes
+for Machine Learning, (MIT Press) Algorithm 2.1.
+.. [2] Golub, G. H., & Van Loan, C. F. (2013). Matrix Computations,
+4th ed., (Johns Hopkins University Press) Section 3.2.
+.. [3] Snelson, E., & Ghahramani, Z. (2006). Sparse Gaussian processes
+using pseudo-inputs. Advances in Neural Information Processing Systems,
+18, 1257-1264.
+.. [4] Saatci, Y. (2012). Scalable inference for structured Gaussian
+process models, (PhD thesis, University of Cambridge) Chapter 5.
+
+"""
+
+import threading
+from collections import namedtuple, OrderedDict
+import numpy as np
+import numpy.linalg as la
+import scipy.linalg as sla
+import scipy.sparse as sp
+import scipy.sparse.linalg as spla
+from multifidgp import tiling
+from multifidgp import kronecker
+
+# Immutable fitted state of a kriging model: hyperparameters, scaling
+# coefficient rho (None for single-fidelity), mean, factorization of K
+# and the kriging weights beta = K^-1 (y - mu)
+KrigingState = namedtuple('KrigingState', ['hyp', 'rho', 'mu', 'factor', 'beta'])
+
+FACTOR_BUDGET = 512*2**20   # Memory held by a FactorCache (bytes)
+
+
+def pivot_rows(piv):
+    """Returns the row order applied by the LAPACK row interchanges piv."""
+    rows = np.arange(len(piv))
+    for i, p in enumerate(piv):
+        rows[[i, p]] = rows[[p, i]]
+    return rows
+
+
+class Factorization:
+
+    def __init__(self, K):
+        self.N = len(K)
+        # Rows of K held by each row of the factor, None if in order
+        self.perm = None
+        try:
+            self.L = sla.cholesky(K, lower=True, check_finite=False)
+            self.L.setflags(write=False)
+            self.cholesky = True
+        except la.LinAlgError:
+            self.lu_piv = sla.lu_factor(K, check_finite=False)
+            for a in self.lu_piv:
+                a.setflags(write=False)
+            self.lu_rows = pivot_rows(self.lu_piv[1])
+            self.cholesky = False
+
+    def arrays(self, prefix='factor_'):
+        """Returns the factor as a dict of arrays for storage."""
+        arrays = {prefix+'L': self.L} if self.cholesky else {prefix+'lu': self.lu_piv[0], prefix+'piv': self.lu_piv[1]}
+        if self.perm is not None:
+            arrays[prefix+'perm'] = self.perm
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='factor_'):
+        """Rebuilds a Factorization from the arrays returned by arrays()."""
+        F = cls.__new__(cls)
+        F.perm = np.array(arrays[prefix+'perm']) if prefix+'perm' in arrays else None
+        F.cholesky = prefix+'L' in arrays
+        if F.cholesky:
+            F.L = arrays[prefix+'L']
+        else:
+            F.lu_piv = (arrays[prefix+'lu'], arrays[prefix+'piv'])
+            F.lu_rows = pivot_rows(F.lu_piv[1])
+        F.N = len(F.L) if F.cholesky else len(F.lu_piv[0])
+        return F
+
+    def nbytes(self):
+        """Returns the memory held by the factor."""
+        return sum(a.nbytes for a in self.arrays().values())
+
+    def solve(self, B):
+        """Returns K^-1 B."""
+        if self.perm is None:
+            return self.solve_factor(B)
+        X = np.empty(np.shape(B))
+        X[self.perm] = self.solve_factor(np.asarray(B)[self.perm])
+        return X
+
+    def solve_factor(self, B):
+        """Returns K^-1 B in the row order of the factor."""
+        if self.cholesky:
+            return sla.cho_solve((self.L, True), B, check_finite=False)
+        # getrs of the bundled OpenBLAS corrupts the heap when threads pivot
+        # concurrently, so the rows are swapped here before two triangular solves
+        lu = self.lu_piv[0]
+        Y = sla.solve_triangular(lu, np.asarray(B)[self.lu_rows], lower=True, unit_diagonal=True, check_finite=False)
+        return sla.solve_triangular(lu, Y, check_finite=False)
+
+    def logdet(self):
+        """Returns log|det K| from the diagonal of the factor."""
+        if self.cholesky:
+            return 2*np.sum(np.log(np.diag(self.L)))
+        return np.sum(np.log(abs(np.diag(self.lu_piv[0]))))
+
+    def quad(self, B):
+        """Returns B^T K^-1 B."""
+        if self.perm is not None:
+            B = np.asarray(B)[self.perm]
+        if self.cholesky:
+            V = sla.solve_triangular(self.L, B, lower=True, check_finite=False)
+            return V.T@V
+        return B.T@self.solve_factor(B)
+
+    def quad_diag(self, B):
+        """Returns the diagonal of B^T K^-1 B without forming the full product."""
+        if self.perm is not None:
+            B = np.asarray(B)[self.perm]
+        if self.cholesky:
+            V = sla.solve_triangular(self.L, B, lower=True, check_finite=False)
+            return np.einsum('ij,ij->j', V, V)
+        return np.einsum('ij,ij->j', B, self.solve_factor(B))
+
+    def inv_blocks(self):
+        """Yields (columns, K^-1[:, columns]) over consecutive column blocks."""
+        for cols in tiling.tile_slices(self.N, tiling.tile_size(self.N)):
+            E = np.zeros((self.N, cols.stop - cols.start))
+            E[np.arange(cols.start, cols.stop), np.arange(cols.stop - cols.start)] = 1
+            yield cols, self.solve(E)
+
+    def inv_diag(self):
+        """Returns the diagonal of K^-1 from column blocks, without forming K^-1."""
+        d = np.empty(self.N)
+        if not self.cholesky:
+            for cols, W in self.inv_blocks():
+                d[cols] = W[np.arange(cols.start, cols.stop), np.arange(cols.stop - cols.start)]
+            return d
+        # (K^-1)_jj = |L^-1 e_j|^2 and L^-1 e_j is zero above row j
+        for cols in tiling.tile_slices(self.N, tiling.tile_size(self.N)):
+            E = np.zeros((self.N - cols.start, cols.stop - cols.start))
+            E[np.arange(cols.stop - cols.start), np.arange(cols.stop - cols.start)] = 1
+            V = sla.solve_triangular(self.L[cols.start:, cols.start:], E, lower=True, check_finite=False)
+            d[cols] = np.einsum('ij,ij->j', V, V)
+        if self.perm is not None:
+            d[self.perm] = d.copy()
+        return d
+
+    def trace_solve(self, B):
+        """Returns trace(K^-1 B) from solves against column blocks of B."""
+        B = np.asarray(B)
+        trace = 0.
+        for cols in tiling.tile_slices(self.N, tiling.tile_size(self.N)):
+            X = self.solve(B[:, cols])
+            trace += np.sum(X[np.arange(cols.start, cols.stop), np.arange(cols.stop - cols.start)])
+        return trace
+
+    def extend(self, B, C, index=None):
+        """Returns the factorization of K bordered by k new rows and columns.
+
+        The bordered matrix is [[K, B], [B^T, C]] with the new rows placed
+        before row index of K (appended if None); B is (N, k) in the row
+        order of K and C is (k, k). The factor is bordered in O(N^2 k)
+        and the new rows are tracked by a permutation instead of being
+        moved. A Cholesky factor whose Schur complement C - B^T K^-1 B is
+        not positive definite continues as an LU factor.
+        """
+        N = self.N
+        B = np.asarray(B, dtype=float).reshape(N, -1)
+        k = B.shape[1]
+        C = np.asarray(C, dtype=float).reshape(k, k)
+        perm = np.arange(N) if self.perm is None else self.perm
+        if index is None:
+            index = N
+        B = B[perm]
+        perm = np.concatenate([np.where(perm >= index, perm + k, perm), index + np.arange(k)])
+
+        F = Factorization.__new__(Factorization)
+        F.N = N + k
+        F.perm = None if np.array_equal(perm, np.arange(N + k)) else perm
+
+        if self.cholesky:
+            L21 = sla.solve_triangular(self.L, B, lower=True, check_finite=False).T
+            try:
+                L22 = sla.cholesky(C - L21@L21.T, lower=True, check_finite=False)
+                F.L = np.block([[self.L, np.zeros((N, k))], [L21, L22]])
+                F.L.setflags(write=False)
+                F.cholesky = True
+                return F
+            except la.LinAlgError:
+                # K = (L D^-1)(D L^T) is an LU factorization without pivoting
+                d = np.diag(self.L)
+                lu = np.tril(self.L/d, -1) + np.triu(d.reshape(N, 1)*self.L.T)
+                piv = np.arange(N, dtype=np.int32)
+        else:
+            lu, piv = self.lu_piv
+
+        # [[K, B], [B^T, C]] = [[P L, 0], [X, I]] [[U, Y], [0, C - X Y]]
+        Y = sla.solve_triangular(lu, B[pivot_rows(piv)], lower=True, unit_diagonal=True, check_finite=False)
+        X = sla.solve_triangular(lu, B, trans='T', check_finite=False).T
+        lu_S, piv_S = sla.lu_factor(C - X@Y, check_finite=False)
+        for i, p in enumerate(piv_S):
+            X[[i, p]] = X[[p, i]]
+        F.lu_piv = (np.block([[lu, Y], [X, lu_S]]), np.concatenate([piv, piv_S + N]).astype(piv.dtype))
+        for a in F.lu_piv:
+            a.setflags(write=False)
+        F.lu_rows = pivot_rows(F.lu_piv[1])
+        F.cholesky = False
+        return F
+
+
+class SparseFactorization:
+    """Factorization of K = [[A, B], [B^T, E]] with A = Lam + P Kuu^-1 P^T.
+
+    A is the FITC approximation [3] of the first Ns rows: a diagonal Lam
+    plus the Nystrom term of m inducing points, where P holds the
+    covariances of those rows with the inducing points and Kuu the
+    covariances among them. The remaining rows are kept exact in E and
+    coupled to the first ones by B. A is inverted by the Woodbury identity
+    and the exact rows through the Schur complement S = E - B^T A^-1 B,
+    so the cost is O(Ns m^2 + Ns Ne m + Ne^3) instead of O(N^3). Lam^-1/2
+    is applied to both sides of P (Ps = Lam^-1/2 P), so the Woodbury
+    terms are not divided by a small Lam twice.
+    """
+
+    def __init__(self, lam, P, Kuu, B, E):
+        self.lam = lam
+        self.P = P
+        self.N_s = len(lam)
+        self.N = self.N_s + len(E)
+        self.F_uu = Factorization(Kuu)
+        self.Ps = P/np.sqrt(lam).reshape(-1, 1)
+        self.F_sigma = Factorization(Kuu + self.Ps.T@self.Ps)
+        # G = A^-1 B
+        self.G = self.solve_sparse(B)
+        self.F_S = Factorization(E - B.T@self.G)
+        # log|det A| by the matrix determinant lemma
+        self.logdet_sparse = np.sum(np.log(abs(lam))) + self.F_sigma.logdet() - self.F_uu.logdet()
+
+    def arrays(self, prefix='factor_'):
+        """Returns the factor as a dict of arrays for storage."""
+        arrays = {prefix+'lam': self.lam, prefix+'P': self.P, prefix+'G': self.G,
+                  prefix+'logdet_sparse': self.logdet_sparse}
+        arrays.update(self.F_uu.arrays(prefix+'uu_'))
+        arrays.update(self.F_sigma.arrays(prefix+'sigma_'))
+        arrays.update(self.F_S.arrays(prefix+'schur_'))
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='factor_'):
+        """Rebuilds a SparseFactorization from the arrays returned by arrays().
+
+        The arrays are small next to the data and are read into aligned
+        memory, so that the solves round to the same results as before
+        saving instead of following the offsets of memory-mapped members.
+        """
+        arrays = {name: np.array(a) for name, a in arrays.items() if name.startswith(prefix)}
+        F = cls.__new__(cls)
+        F.lam = arrays[prefix+'lam']
+        F.P = arrays[prefix+'P']
+        F.G = arrays[prefix+'G']
+        F.logdet_sparse = float(arrays[prefix+'logdet_sparse'])
+        F.F_uu = Factorization.from_arrays(arrays, prefix+'uu_')
+        F.F_sigma = Factorization.from_arrays(arrays, prefix+'sigma_')
+        F.F_S = Factorization.from_arrays(arrays, prefix+'schur_')
+        F.Ps = F.P/np.sqrt(F.lam).reshape(-1, 1)
+        F.N_s = len(F.lam)
+        F.N = F.N_s + F.F_S.N
+        return F
+
+    def nbytes(self):
+        """Returns the memory held by the factor."""
+        return sum(np.asarray(a).nbytes for a in self.arrays().values())
+
+    def project(self, K_su, P=None):
+        """Returns the Nystrom covariances K_su Kuu^-1 P^T of new points with the first rows, or with the sites of P."""
+        P = self.P if P is None else P
+        return self.F_uu.solve(K_su.T).T@P.T
+
+    def solve_sparse(self, V):
+        """Returns A^-1 V by the Woodbury identity."""
+        sqrt_lam = np.sqrt(self.lam).reshape((-1,) + (1,)*(np.ndim(V)-1))
+        W = V/sqrt_lam
+        return (W - self.Ps@self.F_sigma.solve(self.Ps.T@W))/sqrt_lam
+
+    def solve(self, B):
+        """Returns K^-1 B."""
+        B = np.asarray(B)
+        B_s = B[:self.N_s]
+        X_e = self.F_S.solve(B[self.N_s:] - self.G.T@B_s)
+        X_s = self.solve_sparse(B_s) - self.G@X_e
+        return np.concatenate([X_s, X_e])
+
+    def logdet(self):
+        """Returns log|det K| = log|det A| + log|det S|."""
+        return self.logdet_sparse + self.F_S.logdet()
+
+    def quad(self, B):
+        """Returns B^T K^-1 B."""
+        return B.T@self.solve(B)
+
+    def quad_diag(self, B):
+        """Returns the diagonal of B^T K^-1 B without forming the full product."""
+        return np.einsum('ij,ij->j', B, self.solve(B))
+
+    def inv_diag(self):
+        """Returns the diagonal of K^-1."""
+        invA_diag = (1 - np.einsum('ij,ji->i', self.Ps, self.F_sigma.solve(self.Ps.T)))/self.lam
+        invK_diag_s = invA_diag + np.einsum('ij,ji->i', self.G, self.F_S.solve(self.G.T))
+        return np.concatenate([invK_diag_s, self.F_S.inv_diag()])
+
+    def trace_solve_exact(self, DB, DE):
+        """Returns trace(K^-1 D) for D = [[0, DB], [DB^T, DE]], which leaves A unchanged."""
+        return -2*self.F_S.trace_solve(self.G.T@DB) + self.F_S.trace_solve(DE)
+
+
+class SparseMatrixFactorization:
+    """Sparse LU factorization of a scipy.sparse kriging matrix K.
+
+    Solves, quadratic forms and log|det K| come from the factor. The
+    diagonal of K^-1 and traces against K^-1 are built from K^-1 column
+    blocks sized by the tiling memory budget, so K^-1 is never held.
+    """
+
+    def __init__(self, K):
+        self.K = sp.csc_matrix(K)
+        self.N = self.K.shape[0]
+        self.lu = spla.splu(self.K)
+
+    def arrays(self, prefix='factor_'):
+        """Returns K as a dict of arrays for storage, the factor is rebuilt on load."""
+        return {prefix+'K_data': self.K.data, prefix+'K_indices': self.K.indices,
+                prefix+'K_indptr': self.K.indptr}
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix='factor_'):
+        """Rebuilds a SparseMatrixFactorization from the arrays returned by arrays()."""
+        indptr = np.array(arrays[prefix+'K_indptr'])
+        N = len(indptr) - 1
+        K = sp.csc_matrix((np.array(arrays[prefix+'K_data']), np.array(arrays[prefix+'K_indices']), indptr),
+                          shape=(N, N))
+        return cls(K)
+
+    def nbytes(self):
+        """Returns the memory held by K and its factor."""
+        return sum(a.data.nbytes + a.indices.nbytes + a.indptr.nbytes for a in (self.K, self.lu.L, self.lu.U))
+
+    def solve(self, B):
+        """Returns K^-1 B."""
+        B = np.asarray(B, dtype=float)
+        if B.ndim > 1 and B.shape[1] == 0:
+            return B.copy()
+        return self.lu.solve(B)
+
+    def logdet(self):
+        """Returns log|det K| from the diagonal of U (L has a unit diagonal)."""
+        return np.sum(np.log(abs(self.lu.U.diagonal())))
+
+    def quad(self, B):
+        """Returns B^T K^-1 B."""
+        return B.T@self.solve(B)
+
+    def quad_diag(self, B):
+        """Returns the diagonal of B^T K^-1 B without forming the full product."""
+        return np.einsum('ij,ij->j', B, self.solve(B))
+
+    def inv_blocks(self):
+        """Yields (columns, K^-1[:, columns]) over consecutive column blocks."""
+        for cols in tiling.tile_slices(self.N, tiling.tile_size(self.N)):
+            E = np.zeros((self.N, cols.stop - cols.start))
+            E[np.arange(cols.start, cols.stop), np.arange(cols.stop - cols.start)] = 1
+            yield cols, self.solve(E)
+
+    def inv_diag(self):
+        """Returns the diagonal of K^-1."""
+        d = np.empty(self.N)
+        for cols, W in self.inv_blocks():
+            d[cols] = W[np.arange(cols.start, cols.stop), np.arange(cols.stop - cols.start)]
+        return d
+
+    def trace_solve(self, B):
+        """Returns trace(K^-1 B) for a dense or sparse B, using the symmetry of K."""
+        B = sp.csc_matrix(B)
+        return sum(B[:, cols].multiply(W).sum() for cols, W in self.inv_blocks())
+
+
+class KroneckerFactorization:
+    """Factorization of K = scale (K_1 kron ... kron K_d) + shift I for sites on a lattice.
+
+    eig holds the eigendecompositions (lam_a, Q_a) of the per-axis
+    factors K_a and perm the rows of K in C order of the lattice. K has
+    the eigenvectors Q_1 kron ... kron Q_d, so every solve is a few
+    per-axis products in O(N (n_1 + ... + n_d)).
+    """
+
+    def __init__(self, eig, scale, shift, perm):
+        self.Q = [Q for lam, Q in eig]
+        self.QT = [Q.T for Q in self.Q]
+        lam = eig[0][0]
+        for lam_a, Q in eig[1:]:
+            lam = np.multiply.outer(lam, lam_a).reshape(-1)
+        # eigenvalues of K in C order of the lattice
+        self.lam = scale*lam + shift
+        self.perm = perm
+        self.N = len(perm)
+
+    def nbytes(self):
+        """Returns the memory held by the factor."""
+        return sum(Q.nbytes for Q in self.Q) + self.lam.nbytes + self.perm.nbytes
+
+    def solve(self, B):
+        """Returns K^-1 B."""
+        B = np.asarray(B, dtype=float)
+        lam = self.lam.reshape((-1,) + (1,)*(B.ndim-1))
+        X = np.empty(B.shape)
+        X[self.perm] = kronecker.kron_mv(self.Q, kronecker.kron_mv(self.QT, B[self.perm])/lam)
+        return X
+
+    def logdet(self):
+        """Returns log|det K| from the eigenvalues."""
+        return np.sum(np.log(abs(self.lam)))
+
+    def quad(self, B):
+        """Returns B^T K^-1 B."""
+        return B.T@self.solve(B)
+
+    def quad_diag(self, B):
+        """Returns the diagonal of B^T K^-1 B without forming the full product."""
+        return np.einsum('ij,ij->j', B, self.solve(B))
+
+    def quad_diag_kron(self, Ps):
+        """Returns the diagonal of B^T K^-1 B for B^T = P_1 kron ... kron P_d, in O(M (n_1 + ... + n_d))."""
+        return kronecker.kron_mv([(P@Q)**2 for P, Q in zip(Ps, self.Q)], 1/self.lam)
+
+    def inv_diag(self):
+        """Returns the diagonal of K^-1."""
+        d = np.empty(self.N)
+        d[self.perm] = kronecker.kron_mv([Q**2 for Q in self.Q], 1/self.lam)
+        return d
+
+
+class FactorCache:
+    """Least-recently-used cache of factorizations held within a memory budget.
+
+    Entries are stored with their size in bytes; the least recently used
+    ones are dropped once the total exceeds the budget.
+    """
+
+    def __init__(self, budget=FACTOR_BUDGET):
+        self.budget = budget
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the entry stored under key, or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key, value, nbytes):
+        """Stores value under key and evicts entries beyond the budget."""
+        if nbytes > self.budget:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.budget:
+                self.nbytes -= self.entries.popitem(last=False)[1][1]
+
+    def items(self):
+        """Returns the (key, value) pairs from least to most recently used."""
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
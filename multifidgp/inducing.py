@@ -0,0 +1,54 @@
+__doc__ = """
+Inducing
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Placement of the inducing points of the sparse (FITC) kriging
+approximation [1]. The m points are either the k-means centroids of the
+training sites, which follow dense profiles of measurements, or a regular
+grid over their bounding box.
+
+References
+----------
+.. [1] Snelson, E., & Ghahramani, Z. (2006). Sparse Gaussian processes
+using pseudo-inputs. Advances in Neural Information Processing Systems,
+18, 1257-1264.
+
+"""
+
+import numpy as np
+from scipy.cluster.vq import kmeans2
+
+placements = ('kmeans', 'grid')
+
+
+def kmeans(X, m, seed=0):
+    """Returns m inducing points at the k-means centroids of the sites X."""
+    X = np.reshape(X, (len(X), -1)).astype(float)
+    if m >= len(X):
+        return X.copy()
+    Z, label = kmeans2(X, int(m), minit='++', seed=seed)
+    # drop centroids of empty clusters
+    return Z[np.unique(label)]
+
+
+def grid(X, m):
+    """Returns about m inducing points on a regular grid over the bounding box of X."""
+    X = np.reshape(X, (len(X), -1)).astype(float)
+    d = X.shape[1]
+    n = max(int(round(m**(1/d))), 2)
+    axes = [np.linspace(lo, hi, n) for lo, hi in zip(X.min(axis=0), X.max(axis=0))]
+    return np.stack([a.reshape(-1) for a in np.meshgrid(*axes, indexing='ij')], axis=1)
+
+
+def place(X, m, placement='kmeans'):
+    """Returns about m inducing points for the sites X by kmeans() or grid()."""
+    if placement not in placements:
+        raise Exception("The inducing point placement must be 'kmeans' or 'grid'!")
+    if placement == 'grid':
+        return grid(X, m)
+    return kmeans(X, m)
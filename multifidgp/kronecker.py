@@ -0,0 +1,105 @@
+__doc__ = """
+Kronecker
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Lattice (regular grid) helpers for separable kernels. The covariance of a
+separable kernel between two lattices is the Kronecker product of one
+small factor per coordinate axis, and between a lattice and scattered
+sites its rows are products of per-axis factors. Products with such
+matrices are applied axis by axis [1] without forming them, and kriging
+matrices of sites on a lattice are inverted through the
+eigendecompositions of their per-axis factors (see
+KroneckerFactorization in factorization.py).
+
+References
+----------
+.. [1] Saatci, Y. (2012). Scalable inference for structured Gaussian
+process models, (PhD thesis, University of Cambridge) Chapter 5.
+
+"""
+
+import numpy as np
+
+
+def grid_axes(X):
+    """Returns (axes, perm) if the sites X form a full lattice, None otherwise.
+
+    axes holds the sorted values of each coordinate and X[perm] lists
+    the sites in C order of the lattice.
+    """
+    X = np.reshape(X, (len(X), -1))
+    N = len(X)
+    axes = [np.unique(X[:, a]) for a in range(X.shape[1])]
+    shape = tuple(len(g) for g in axes)
+    if int(np.prod(shape)) != N:
+        return None
+    flat = np.ravel_multi_index([np.searchsorted(g, X[:, a]) for a, g in enumerate(axes)], shape)
+    if len(np.unique(flat)) != N:
+        return None
+    perm = np.empty(N, dtype=int)
+    perm[flat] = np.arange(N)
+    return axes, perm
+
+
+def meshgrid_axes(*coords):
+    """Returns (axes, dims) if the coordinate arrays form a lattice, None otherwise.
+
+    The arrays are laid out as by np.meshgrid: coordinate c takes the
+    values axes[c] along array axis dims[c] and is constant along the
+    others.
+    """
+    shape = np.shape(coords[0])
+    if len(coords) != len(shape):
+        return None
+    axes = []
+    dims = []
+    for C in coords:
+        C = np.asarray(C)
+        if C.shape != shape:
+            return None
+        varying = [p for p in range(len(shape)) if np.any(np.diff(C, axis=p) != 0)]
+        if len(varying) != 1:
+            return None
+        p = varying[0]
+        g = np.moveaxis(C, p, 0).reshape(shape[p], -1)[:, 0]
+        if not np.array_equal(np.moveaxis(C, p, -1), np.broadcast_to(g, np.moveaxis(C, p, -1).shape)):
+            return None
+        axes.append(g)
+        dims.append(p)
+    if sorted(dims) != list(range(len(shape))):
+        return None
+    return axes, dims
+
+
+def to_meshgrid(values, axes, dims):
+    """Lays out values in C order of the lattice axes as the meshgrid arrays of meshgrid_axes."""
+    return np.transpose(np.reshape(values, tuple(len(g) for g in axes)), np.argsort(dims))
+
+
+def kron_mv(As, V):
+    """Returns (A_1 kron ... kron A_d) V without forming the Kronecker product."""
+    V = np.asarray(V)
+    rest = V.shape[1:]
+    T = V.reshape(tuple(A.shape[1] for A in As) + rest)
+    for a, A in enumerate(As):
+        T = np.moveaxis(np.tensordot(A, T, axes=(1, a)), 0, a)
+    return T.reshape((-1,) + rest)
+
+
+def grid_rows(Es, idx):
+    """Returns the rows idx (C order) of the lattice of the product of per-axis factors.
+
+    Es holds one (n_a, N) factor per axis between its lattice values and
+    N sites; row i of the result is the product over the axes of the rows
+    of Es at the lattice index of point i.
+    """
+    sub = np.unravel_index(idx, tuple(len(E) for E in Es))
+    P = Es[0][sub[0]]
+    for E, i in zip(Es[1:], sub[1:]):
+        P = P*E[i]
+    return P
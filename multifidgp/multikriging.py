@@ -8,15 +8,47 @@ cytseng2@illinois.edu
 Contains class MultiKriging
 Contains PyKrige.variogram_models
 
+With inducing_L set, the low-fidelity block of K is replaced by its FITC
+approximation through m inducing points [4] (see inducing.py) while the
+high-fidelity block stays exact, so factoring K costs O(N_L m^2) instead
+of O((N_L+N_H)^3). This needs a covariance kernel (not the variogram).
+
+With likelihood_mode='vecchia' the hyperparameters are fitted on the
+Vecchia approximation of the likelihood [5] over the sites of both
+fidelities (see vecchia.py) and the fitted model predicts from the
+nearest sites of each point, so neither step factors K.
+
+With kernel='spherical' or 'wendland' K is built from compactly
+supported covariances (see covariance_models.py), assembled and factored
+as a sparse matrix.
+
+With kernel='separable_exponential' or 'separable_gaussian' the kriging
+matrices are products of one factor per coordinate axis (see
+covariance_models.py), and predictions on a lattice (predict_grid)
+assemble their covariances with the sites of both fidelities from
+per-axis factors [6] (see kronecker.py).
+
 References
 ----------
 .. [1] Raissi, M., & Karniadakis, G. (2016). Deep multi-fidelity 
 Gaussian processes. arXiv preprint arXiv:1604.07484.
 .. [2] P.K. Kitanidis, Introduction to Geostatistcs: Applications in
 Hydrogeology, (Cambridge University Press, 1997) 272 p.
+.. [3] Le Gratiet, L., & Garnier, J. (2014). Recursive co-kriging model
+for design of computer experiments with multiple levels of fidelity.
+International Journal for Uncertainty Quantification, 4(5), 365-386.
+.. [4] Snelson, E., & Ghahramani, Z. (2006). Sparse Gaussian processes
+using pseudo-inputs. Advances in Neural Information Processing Systems,
+18, 1257-1264.
+.. [5] Vecchia, A. V. (1988). Estimation and model identification for
+continuous spatial processes. Journal of the Royal Statistical Society:
+Series B, 50(2), 297-312.
+.. [6] Saatci, Y. (2012). Scalable inference for structured Gaussian
+process models, (PhD thesis, University of Cambridge) Chapter 5.
 
 """
 
+from collections import namedtuple
 import numpy as np
 import scipy.linalg
 import scipy.linalg as sla
@@ -24,46 +56,150 @@ import numpy.linalg as la
 from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
 import scipy.optimize as op
+import scipy.sparse as sp
+from multifidgp.factorization import Factorization, SparseFactorization, SparseMatrixFactorization, KrigingState, FactorCache
+from multifidgp.neighborhood import Neighborhood
+from multifidgp import inducing
+from multifidgp import tiling
+from multifidgp import artifact
+from multifidgp import vecchia
+from multifidgp import covariance_models
+from multifidgp import kronecker
 from multifidgp.variogram_models import gaussian_variogram_model
 from multifidgp.variogram_models import exponential_variogram_model
 
-P = 0
-L = 0
-U = 0
+# Immutable fitted state of recursive co-kriging: hyperparameters, rho and
+# mean, factorization and weights of the low-fidelity (L) and discrepancy
+# (D) levels
+RecursiveState = namedtuple('RecursiveState', ['hyp', 'rho', 'mu_L', 'factor_L', 'beta_L',
+                                               'mu_D', 'factor_D', 'beta_D'])
 
 class MultiKriging:
 
     eps = 1.e-10   # Cutoff for comparison to zero
+    jitter = 1.e-6   # Floor of the FITC diagonal and of K_uu, relative to diag(K_LL)
+    # exact likelihood, or its Vecchia approximation on the n_neighbors
+    # nearest preceding sites in maxmin order
+    likelihood_modes = ('exact', 'vecchia')
+    # variogram as kriging matrix, or compactly supported spherical or
+    # Wendland-tapered exponential covariance as sparse matrix, or
+    # separable exponential or Gaussian covariance (per-axis factors on lattices)
+    kernels = ('variogram', 'spherical', 'wendland', 'separable_exponential', 'separable_gaussian')
     # model_parameters_L = [sL rL nL]
     # model_parameters_H = [sH rH nH]
     
     def __init__(self, XData_H, KData_H, XData_L, KData_L,
-                 model_parameters_H, model_parameters_L):
+                 model_parameters_H, model_parameters_L, recursive=False, inducing_L=None,
+                 likelihood_mode='exact', n_neighbors=30, kernel='variogram', taper=None,
+                 inducing_placement='kmeans'):
+        """inducing_L is None (exact), a number m of inducing points or an
+        (m, d) array of inducing points for the low-fidelity level. A
+        number m is placed by inducing_placement, 'kmeans' or 'grid' (see
+        inducing.py). The low-fidelity level is evaluated at the sites of
+        both fidelities, so the points are placed over both."""
+        if np.ndim(inducing_L) == 0 and inducing_L is not None:
+            inducing_L = inducing.place(np.concatenate([XData_L, XData_H]), inducing_L, inducing_placement)
+        if recursive and inducing_L is not None:
+            raise Exception("Inducing points are not supported in recursive co-kriging!")
+        if inducing_L is not None and kernel == 'variogram':
+            # the variogram matrix is not a covariance, so its Nystrom term is meaningless
+            raise ValueError("Inducing points need a covariance kernel, not kernel='variogram'!")
+        if likelihood_mode not in self.likelihood_modes:
+            raise Exception("The likelihood mode must be 'exact' or 'vecchia'!")
+        if recursive and likelihood_mode == 'vecchia':
+            raise Exception("The Vecchia likelihood is not supported in recursive co-kriging!")
+        if kernel not in self.kernels:
+            raise Exception("The kernel must be 'variogram', 'spherical', 'wendland', "
+                            "'separable_exponential' or 'separable_gaussian'!")
         self.Xdata_H=XData_H
         self.Kdata_H=KData_H
         self.Xdata_L=XData_L
         self.Kdata_L=KData_L
         self.model_parameters_H=model_parameters_H
         self.model_parameters_L=model_parameters_L
+        self.recursive=recursive
+        self.inducing_L=inducing_L
+        self.likelihood_mode=likelihood_mode
+        self.n_neighbors=n_neighbors   # Conditioning sites of the Vecchia likelihood
+        self.ordering=None
+        self.kernel=kernel
+        self.taper=taper   # Support of the Wendland taper, None for the range of each level
+        self.blocks=None
+        self.cache=None
+        self.state=None
+        self.neighborhood=None
+        self.local_factors=FactorCache()
 
     def k(self, X1, X2, model_parameters):
         """Assembles the kriging matrix."""
         if X1.size==len(X1):
             X1=X1.reshape(len(X1),1)
             X2=X2.reshape(len(X2),1)
-        d = cdist(X1, X2, 'euclidean')
+        d = cdist(X1, X2, covariance_models.metric(self.kernel))
         n1 = len(X1)
         n2 = len(X2)
         K = np.zeros((n1, n2))
+        K[:n1, :n2] = self.k_values(model_parameters, d)
+        return K
+
+    def k_values(self, model_parameters, d):
+        """Kriging matrix entries at the distances d."""
+        if self.kernel != 'variogram':
+            return covariance_models.covariance(self.kernel, model_parameters, d, self.taper)
         # Assign Exponential variogram model
-        K[:n1, :n2] = exponential_variogram_model(model_parameters, d)
+        return exponential_variogram_model(model_parameters, d)
         # Assign Gaussian variogram model
-        #K[:n1, :n2] = gaussian_variogram_model(model_parameters, d)
-        return K
+        #return gaussian_variogram_model(model_parameters, d)
+
+    def k_sparse(self, X1, X2, model_parameters):
+        """Assembles the kriging matrix of a compactly supported kernel as a sparse matrix."""
+        return covariance_models.sparse_covariance(self.kernel, model_parameters, X1, X2, self.taper)
+
+    def k_diag(self, X, model_parameters):
+        """Diagonal of the kriging matrix k(X, X)."""
+        d = np.zeros(len(X))
+        return self.k_values(model_parameters, d)
+
+    def kernel_blocks(self):
+        """Assembles the hyperparameter-independent kriging blocks once.
+
+        The blocks are sparse for a compactly supported kernel, except
+        with inducing points.
+        """
+        if self.blocks is None:
+            X_L = self.Xdata_L
+            X_H = self.Xdata_H
+            compact = self.kernel in covariance_models.compact_kernels
+            k = self.k_sparse if compact and self.inducing_L is None else self.k
+            if self.inducing_L is not None:
+                Z = self.inducing_L
+                self.blocks = {'uu': self.k(Z, Z, self.model_parameters_L),
+                               'Lu': self.k(X_L, Z, self.model_parameters_L),
+                               'Hu': self.k(X_H, Z, self.model_parameters_L),
+                               'L_diag': self.k_diag(X_L, self.model_parameters_L)}
+            else:
+                self.blocks = {'LL': k(X_L, X_L, self.model_parameters_L)}
+            self.blocks.update({'LH': k(X_L, X_H, self.model_parameters_L),
+                           'HH_L': k(X_H, X_H, self.model_parameters_L),
+                           'HH_H': k(X_H, X_H, self.model_parameters_H)})
+        return self.blocks
+
+    def factorize(self, hyp):
+        """Factors the co-kriging matrix once per distinct hyp.
+
+        K, its factorization, alpha = K^-1 y and log|K| are cached on the
+        model so that likelihood, Gradient and Hessian evaluated at the
+        same hyp share a single factorization.
+        """
+        key = tuple(np.asarray(hyp, dtype=float).reshape(-1))
+        cached = self.cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if self.inducing_L is not None:
+            C = self.factorize_sparse(hyp)
+            self.cache = (key, C)
+            return C
 
-    def likelihood(self, hyp):
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
         y_L = self.Kdata_L
         y_H = self.Kdata_H
         y=np.concatenate([y_L, y_H])
@@ -72,14 +208,19 @@ class MultiKriging:
         sigma_eps_H = hyp[1]
         rho = hyp[2]
         
-        N_L = len(X_L)
-        N_H = len(X_H)
+        N_L = len(self.Xdata_L)
+        N_H = len(self.Xdata_H)
         N = N_L + N_H
 
-        K_LL = self.k(X_L, X_L, self.model_parameters_L)
-        K_LH = rho*self.k(X_L, X_H, self.model_parameters_L)
-        K_HL = rho*self.k(X_H, X_L, self.model_parameters_L)
-        K_HH = (rho**2)*self.k(X_H, X_H, self.model_parameters_L) + self.k(X_H, X_H, self.model_parameters_H)
+        B = self.kernel_blocks()
+        if sp.issparse(B['LL']):
+            C = self.factorize_sparse_matrix(hyp)
+            self.cache = (key, C)
+            return C
+        K_LL = B['LL']
+        K_LH = rho*B['LH']
+        K_HL = K_LH.T
+        K_HH = (rho**2)*B['HH_L'] + B['HH_H']
  
         K_LL = K_LL + np.eye(N_L)*sigma_eps_L
         K_HH = K_HH + np.eye(N_H)*sigma_eps_H
@@ -88,219 +229,714 @@ class MultiKriging:
  
         K = K + np.eye(N)*self.eps
         
-        # LU Decomposition
-        global P, L, U
-        P, L, U = sla.lu(K)
-
-        alpha = la.inv(U)@(la.inv(L)@(P.T@y))
-        for m in range(40):
-            if (np.prod(np.diag(U*np.exp(1)**m))!=0):
-                break
-        NLML = 0.5*y.T@alpha + 0.5*(np.log(abs(np.prod(np.diag(U*np.exp(1)**m))))-m*N) + np.log(2*np.pi)*N/2
+        # Cholesky Decomposition (LU if K is not positive definite)
+        F = Factorization(K)
+        alpha = F.solve(y)
+        logdet = F.logdet()
+
+        # Derivative of K with respect to rho
+        DK_LL = np.zeros([N_L,N_L])
+        DK_LH = B['LH']
+        DK_HL = DK_LH.T
+        DK_HH = (2*rho)*B['HH_L']
+        DK = np.concatenate([np.concatenate([DK_LL,DK_LH], axis=1),np.concatenate([DK_HL,DK_HH], axis=1)])
+
+        C = {'y': y, 'N_L': N_L, 'N': N, 'K': K, 'factor': F,
+             'alpha': alpha, 'logdet': logdet, 'DK': DK}
+        # key and factorization are swapped in together for concurrent callers
+        self.cache = (key, C)
+        return C
+
+    def factorize_sparse_matrix(self, hyp):
+        """Factors the sparse co-kriging matrix of a compactly supported kernel."""
+        y = np.concatenate([self.Kdata_L, self.Kdata_H])
+        sigma_eps_L = hyp[0]
+        sigma_eps_H = hyp[1]
+        rho = hyp[2]
+        N_L = len(self.Xdata_L)
+        N_H = len(self.Xdata_H)
+        N = N_L + N_H
+
+        B = self.kernel_blocks()
+        K_LL = B['LL'] + sp.identity(N_L)*sigma_eps_L
+        K_LH = rho*B['LH']
+        K_HH = (rho**2)*B['HH_L'] + B['HH_H'] + sp.identity(N_H)*sigma_eps_H
+        K = sp.bmat([[K_LL, K_LH], [K_LH.T, K_HH]]) + sp.identity(N)*self.eps
+
+        # Sparse LU Decomposition
+        F = SparseMatrixFactorization(K)
+        alpha = F.solve(y)
+        logdet = F.logdet()
+
+        # Derivative of K with respect to rho
+        DK = sp.bmat([[None, B['LH']], [B['LH'].T, (2*rho)*B['HH_L']]])
+
+        C = {'y': y, 'N_L': N_L, 'N': N, 'K': K, 'factor': F,
+             'alpha': alpha, 'logdet': logdet, 'DK': DK}
+        return C
+
+    def factorize_sparse(self, hyp):
+        """Factors K with the low-fidelity block replaced by its FITC approximation.
+
+        K_LL is approximated by Q_LL + Lam with the Nystrom term
+        Q_LL = K_Lu K_uu^-1 K_uL of the inducing points and the diagonal
+        Lam = diag(K_LL - Q_LL) + sigma_eps_L, floored at jitter*diag(K_LL).
+        The low-fidelity covariances of the L and H sites are projected on
+        the inducing points as well (Q_LH), so that K stays a covariance
+        matrix; the high-fidelity block is exact. Only the blocks of the
+        derivative with respect to rho that are not zero are kept, and
+        dlam_L marks the rows of Lam that are not floored and so depend on
+        sigma_eps_L.
+        """
+        y = np.concatenate([self.Kdata_L, self.Kdata_H])
+        sigma_eps_L = hyp[0]
+        sigma_eps_H = hyp[1]
+        rho = hyp[2]
+        N_L = len(self.Xdata_L)
+        N_H = len(self.Xdata_H)
+        N = N_L + N_H
+
+        B = self.kernel_blocks()
+        m = len(B['uu'])
+        floor = self.jitter*B['L_diag']
+        K_uu = B['uu'] + np.eye(m)*self.eps
+        F_uu = Factorization(K_uu)
+        Q_diag = F_uu.quad_diag(B['Lu'].T)
+        Q_LH = B['Lu']@F_uu.solve(B['Hu'].T)
+        lam = np.maximum(B['L_diag'] - Q_diag, 0) + sigma_eps_L
+        dlam_L = (lam > floor).astype(float)
+        lam = np.maximum(lam, floor)
+        K_LH = rho*Q_LH
+        K_HH = (rho**2)*B['HH_L'] + B['HH_H'] + np.eye(N_H)*(sigma_eps_H + self.eps)
+
+        # Woodbury identity for the L block, Schur complement for the H block
+        F = SparseFactorization(lam, B['Lu'], K_uu, K_LH, K_HH)
+        alpha = F.solve(y)
+        logdet = F.logdet()
+
+        # Derivative of K with respect to rho, [[0, DK_LH], [DK_HL, DK_HH]]
+        C = {'y': y, 'N_L': N_L, 'N': N, 'factor': F, 'alpha': alpha, 'logdet': logdet,
+             'DK_LH': Q_LH, 'DK_HH': (2*rho)*B['HH_L'], 'dlam_L': dlam_L}
+        return C
+
+    def likelihood(self, hyp):
+        C = self.factorize(hyp)
+        y = C['y']
+        N = C['N']
+        alpha = C['alpha']
+
+        NLML = 0.5*y.T@alpha + 0.5*C['logdet'] + np.log(2*np.pi)*N/2
         print(NLML, hyp)
         return NLML
     
     def Gradient(self, hyp):
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-        y=np.concatenate([y_L, y_H])
-        
+        C = self.factorize(hyp)
+        N_L = C['N_L']
+        alpha = C['alpha']
+
+        sigma_eps_L = hyp[0]
+        sigma_eps_H = hyp[1]
+        factor = C['factor']
+
+        # Derivatives, with Q = K^-1 - alpha*alpha^T (dL/dK) kept implicit
+        D_NLML = np.zeros(len(hyp))
+        invK_diag = factor.inv_diag()
+        alpha_sq = np.sum(alpha.reshape(len(alpha), -1)**2, axis=1)
+        
+        if 'DK' in C:
+            DK = C['DK']
+            D_NLML[2] = (factor.trace_solve(DK) - np.sum(alpha*(DK@alpha)))/2 # Derivatives for rho
+        else:
+            DK_LH = C['DK_LH']
+            DK_HH = C['DK_HH']
+            alpha_DK_alpha = 2*np.sum(alpha[0:N_L]*(DK_LH@alpha[N_L:])) + np.sum(alpha[N_L:]*(DK_HH@alpha[N_L:]))
+            D_NLML[2] = (factor.trace_solve_exact(DK_LH, DK_HH) - alpha_DK_alpha)/2 # Derivatives for rho
+        dlam_L = C.get('dlam_L', 1)  # rows of a floored FITC diagonal do not depend on eps_L
+        D_NLML[0] = sigma_eps_L*np.sum(dlam_L*(invK_diag[0:N_L] - alpha_sq[0:N_L]))/2  # Derivatives for eps_L
+        D_NLML[1] = sigma_eps_H*np.sum(invK_diag[N_L:] - alpha_sq[N_L:])/2  # Derivatives for eps_H
+        return D_NLML
+
+    def value_and_grad(self, hyp, n_jobs=1):
+        """Returns the NLML and its gradient from one factorization of K."""
+        if self.likelihood_mode == 'vecchia':
+            return self.likelihood_vecchia(hyp, n_jobs)
+        return self.likelihood(hyp), self.Gradient(hyp)
+
+    def vecchia_neighbors(self):
+        """Returns the maxmin order of the L and H sites and their nearest preceding sites, computed once per n_neighbors."""
+        if self.ordering is None or self.ordering[1].shape[1] != self.n_neighbors:
+            X = np.concatenate([self.Xdata_L.reshape(len(self.Xdata_L), -1),
+                                self.Xdata_H.reshape(len(self.Xdata_H), -1)])
+            order = vecchia.maxmin_order(X)
+            self.ordering = (order, vecchia.ordered_neighbors(X[order], self.n_neighbors))
+        return self.ordering
+
+    def likelihood_vecchia(self, hyp, n_jobs=1, backend='thread'):
+        """Returns the Vecchia NLML and its gradient, scaled as in Gradient.
+
+        The sites of both fidelities are ordered together and each is
+        conditioned on its n_neighbors nearest preceding sites of either
+        fidelity; the sites are solved in batches over n_jobs workers.
+        """
+        order, NN = self.vecchia_neighbors()
+        N_L = len(self.Xdata_L)
+        X = np.concatenate([self.Xdata_L.reshape(N_L, -1),
+                            self.Xdata_H.reshape(len(self.Xdata_H), -1)])[order]
+        y = np.concatenate([self.Kdata_L, self.Kdata_H]).reshape(-1)[order]
+        is_H = order >= N_L
         sigma_eps_L = hyp[0]
         sigma_eps_H = hyp[1]
         rho = hyp[2]
-        
-        N_L = len(X_L)
-        N_H = len(X_H)
-        N = N_L + N_H
- 
-        K_LL = self.k(X_L, X_L, self.model_parameters_L)
-        K_LH = rho*self.k(X_L, X_H, self.model_parameters_L)
-        K_HL = rho*self.k(X_H, X_L, self.model_parameters_L)
-        K_HH = (rho**2)*self.k(X_H, X_H, self.model_parameters_L) + self.k(X_H, X_H, self.model_parameters_H)
- 
-        K_LL = K_LL + np.eye(N_L)*sigma_eps_L
-        K_HH = K_HH + np.eye(N_H)*sigma_eps_H
- 
-        K = np.concatenate([np.concatenate([K_LL,K_LH], axis=1),np.concatenate([K_HL,K_HH], axis=1)])
 
-        K = K + np.eye(N)*self.eps
-        
-        # LU Decomposition
-        global P, L, U
-        P, L, U = sla.lu(K)
-        
-        alpha = la.inv(U)@(la.inv(L)@(P.T@y))
+        def local_cov(c):
+            D = vecchia.local_distances(X, c, covariance_models.metric(self.kernel))
+            h = is_H[c].astype(int)
+            # number of H sites in each pair: rho^0 for L-L, rho for L-H and rho^2 for H-H
+            n_H = h[:, :, None] + h[:, None, :]
+            K_L = self.k_values(self.model_parameters_L, D)
+            K_H = self.k_values(self.model_parameters_H, D)
+            I = np.eye(c.shape[1])
+            sigma_eps = np.where(h == 1, sigma_eps_H, sigma_eps_L) + self.eps
+            K = rho**n_H*K_L + (n_H == 2)*K_H + I*sigma_eps[:, :, None]
 
-        # Derivatives
-        D_NLML = 0*hyp
-        Q = la.inv(U)@(la.inv(L)@(P.T@np.eye(N))) - alpha@alpha.T
+            # Derivatives of K with respect to eps_L, eps_H and rho
+            DK = np.stack([I*(1-h)[:, :, None], I*h[:, :, None],
+                           n_H*rho**np.maximum(n_H-1, 0)*K_L])
+            return K, DK
 
-        DK_LL = np.zeros([N_L,N_L])
-        DK_LH = self.k(X_L, X_H, self.model_parameters_L)
-        DK_HL = self.k(X_H, X_L, self.model_parameters_L)
-        DK_HH = (2*rho)*self.k(X_H, X_H, self.model_parameters_L)
-        DK = np.concatenate([np.concatenate([DK_LL,DK_LH], axis=1),np.concatenate([DK_HL,DK_HH], axis=1)])
-        
-        D_NLML[2] = sum(sum(Q*DK))/2 # Derivatives for rho
-        D_NLML[0] = sigma_eps_L*np.trace(Q[0:N_L,0:N_L])/2  # Derivatives for eps_L
-        D_NLML[1] = sigma_eps_H*np.trace(Q[N_L:,N_L:])/2  # Derivatives for eps_H
-        return D_NLML
+        NLML, D_NLML = vecchia.likelihood(local_cov, y, NN, len(hyp), n_jobs, backend)
+        D_NLML[0] = sigma_eps_L*D_NLML[0]  # Derivatives for eps_L
+        D_NLML[1] = sigma_eps_H*D_NLML[1]  # Derivatives for eps_H
+        print(NLML, hyp)
+        return NLML, D_NLML
     
     def Hessian(self, hyp):
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-        y=np.concatenate([y_L, y_H])
-        
+        C = self.factorize(hyp)
+        if 'DK' not in C:
+            raise Exception("The Hessian is not available with inducing points!")
+        y = C['y']
+        N_L = C['N_L']
+        N = C['N']
+        DK = C['DK']
+        if sp.issparse(DK):
+            DK = DK.toarray()
+
         sigma_eps_L = hyp[0]
         sigma_eps_H = hyp[1]
-        rho = hyp[2]
-        
-        N_L = len(X_L)
-        N_H = len(X_H)
-        N = N_L + N_H
- 
-        K_LL = self.k(X_L, X_L, self.model_parameters_L)
-        K_LH = rho*self.k(X_L, X_H, self.model_parameters_L)
-        K_HL = rho*self.k(X_H, X_L, self.model_parameters_L)
-        K_HH = (rho**2)*self.k(X_H, X_H, self.model_parameters_L) + self.k(X_H, X_H, self.model_parameters_H)
- 
-        K_LL = K_LL + np.eye(N_L)*sigma_eps_L
-        K_HH = K_HH + np.eye(N_H)*sigma_eps_H
- 
-        K = np.concatenate([np.concatenate([K_LL,K_LH], axis=1),np.concatenate([K_HL,K_HH], axis=1)])
- 
-        K = K + np.eye(N)*self.eps
-        
-        # LU Decomposition
-        global P, L, U
-        P, L, U = sla.lu(K)
-        
-        alpha = la.inv(U)@(la.inv(L)@(P.T@y))
 
-        # Derivatives
+        # Derivatives, with DQ = 0.5*K^-1 K^-1 - alpha*gamma^T and gamma = K^-1 alpha
+        # taken from K^-1 column blocks, so K^-1 is never held
         DD_NLML = np.zeros([len(hyp), len(hyp)])
-        invK = la.inv(U)@(la.inv(L)@(P.T@np.eye(N)))
-        DQ = 0.5*invK@(np.eye(N)-2*y@y.T@invK)@invK
-
-        DK_LL = np.zeros([N_L,N_L])
-        DK_LH = self.k(X_L, X_H, self.model_parameters_L)
-        DK_HL = self.k(X_H, X_L, self.model_parameters_L)
-        DK_HH = (2*rho)*self.k(X_H, X_H, self.model_parameters_L)
-        DK = np.concatenate([np.concatenate([DK_LL,DK_LH], axis=1),np.concatenate([DK_HL,DK_HH], axis=1)])
-        
-        DD_NLML[2, 2] = sum(sum(DQ*DK**2)) # Derivatives for rho^2
-        DD_NLML[0, 0] = sigma_eps_L**2*np.trace(DQ[0:N_L,0:N_L])  # Derivatives for eps_L^2
-        DD_NLML[1, 1] = sigma_eps_H**2*np.trace(DQ[N_L:,N_L:])  # Derivatives for eps_H^2
+        factor = C['factor']
+        alpha = factor.solve(y).reshape(N, -1)
+        gamma = factor.solve(alpha)
+        DK2 = DK**2
+        invK2_diag = np.zeros(N)
+        invK2_DK2 = 0.
+        for cols, W in factor.inv_blocks():
+            invK2_diag[cols] = np.sum(W**2, axis=0)
+            invK2_DK2 += np.sum(W*(DK2@W))
+        DQ_diag = 0.5*invK2_diag - np.sum(alpha*gamma, axis=1)
+        
+        DD_NLML[2, 2] = 0.5*invK2_DK2 - np.sum(alpha*(DK2@gamma)) # Derivatives for rho^2
+        DD_NLML[0, 0] = sigma_eps_L**2*np.sum(DQ_diag[0:N_L])  # Derivatives for eps_L^2
+        DD_NLML[1, 1] = sigma_eps_H**2*np.sum(DQ_diag[N_L:])  # Derivatives for eps_H^2
         DD_NLML[0, 1] = 0
-        DD_NLML[0, 2] = sigma_eps_L*np.trace(DQ[0:N_L,0:N_L]*DK[0:N_L,0:N_L])
-        DD_NLML[1, 2] = sigma_eps_H*np.trace(DQ[N_L:,N_L:]*DK[N_L:,N_L:])
+        DD_NLML[0, 2] = sigma_eps_L*np.sum(DQ_diag[0:N_L]*np.diag(DK)[0:N_L])
+        DD_NLML[1, 2] = sigma_eps_H*np.sum(DQ_diag[N_L:]*np.diag(DK)[N_L:])
         DD_NLML[1, 0] = DD_NLML[0, 1]
         DD_NLML[2, 0] = DD_NLML[0, 2]
         DD_NLML[2, 1] = DD_NLML[1, 2]
         return DD_NLML
 
-    def execute1D(self, xx):
+    def factorize_recursive(self, hyp):
+        """Factors the low-fidelity and discrepancy systems separately.
+
+        Recursive co-kriging [3]: the low fidelity is kriged on its own and
+        the high-fidelity data are modelled as y_H = rho*y_L + mu_D + delta,
+        with rho and mu_D estimated by generalized least squares. Two
+        systems of size N_L and N_H are factored instead of one of size
+        N_L+N_H. y_L at the high-fidelity sites is the observed value where
+        a site is shared with the low-fidelity data (nested design) and the
+        low-fidelity kriging mean elsewhere. hyp = [sigma_eps_L, sigma_eps_H].
+        """
+        key = ('recursive',) + tuple(np.asarray(hyp, dtype=float).reshape(-1))
+        cached = self.cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        y_L = np.reshape(self.Kdata_L, -1)
+        y_H = np.reshape(self.Kdata_H, -1)
+
+        sigma_eps_L = hyp[0]
+        sigma_eps_H = hyp[1]
+
+        N_L = len(self.Xdata_L)
+        N_H = len(self.Xdata_H)
+        B = self.kernel_blocks()
+
+        # Low-fidelity level
+        F_L = Factorization(B['LL'] + np.eye(N_L)*(sigma_eps_L + self.eps))
+        mu_L = np.mean(y_L)
+        beta_L = F_L.solve(y_L - mu_L)
+
+        # Low fidelity at the high-fidelity sites, observed where nested
+        d = cdist(self.Xdata_H.reshape(N_H, -1), self.Xdata_L.reshape(N_L, -1))
+        nearest = np.argmin(d, axis=1)
+        nested = d[np.arange(N_H), nearest] <= self.eps
+        y_LH = np.where(nested, y_L[nearest], mu_L + B['LH'].T@beta_L)
+
+        # Discrepancy level with [rho, mu_D] by generalized least squares
+        F_D = Factorization(B['HH_H'] + np.eye(N_H)*(sigma_eps_H + self.eps))
+        G = np.stack([y_LH, np.ones(N_H)], axis=1)
+        KiG = F_D.solve(G)
+        rho, mu_D = la.solve(G.T@KiG, KiG.T@y_H)
+        r_H = y_H - rho*y_LH - mu_D
+        beta_D = F_D.solve(r_H)
+
+        NLML = (0.5*(y_L - mu_L)@beta_L + 0.5*F_L.logdet()
+                + 0.5*r_H@beta_D + 0.5*F_D.logdet() + np.log(2*np.pi)*(N_L + N_H)/2)
+        # Derivatives for eps_L and eps_H, in the same form as Gradient
+        D_NLML = np.array([sigma_eps_L*np.sum(F_L.inv_diag() - beta_L**2)/2,
+                           sigma_eps_H*np.sum(F_D.inv_diag() - beta_D**2)/2])
+
+        C = {'NLML': NLML, 'D_NLML': D_NLML, 'rho': rho,
+             'mu_L': mu_L, 'factor_L': F_L, 'beta_L': beta_L,
+             'mu_D': mu_D, 'factor_D': F_D, 'beta_D': beta_D}
+        # key and factorization are swapped in together for concurrent callers
+        self.cache = (key, C)
+        return C
+
+    def value_and_grad_recursive(self, hyp):
+        """Returns the recursive co-kriging NLML and its gradient."""
+        C = self.factorize_recursive(hyp)
+        print(C['NLML'], hyp, C['rho'])
+        return C['NLML'], C['D_NLML']
+
+    def recursive_state(self, hyp):
+        """Returns the recursive co-kriging prediction state for hyp."""
+        C = self.factorize_recursive(hyp)
+        return RecursiveState(hyp=np.array(hyp, dtype=float), rho=C['rho'],
+                              mu_L=C['mu_L'], factor_L=C['factor_L'], beta_L=C['beta_L'],
+                              mu_D=C['mu_D'], factor_D=C['factor_D'], beta_D=C['beta_D'])
+
+    def fit_recursive(self, bnds=((-5, 2), (-5, 2))):
+        """Fits [sigma_eps_L, sigma_eps_H] by TNC with rho profiled by GLS."""
+        # initialhyp = [ sigma_eps_L  sigma_eps_H]
+        inihyp = np.array([0, 0])
+        Result = op.minimize(fun = self.value_and_grad_recursive, x0 = inihyp, method = 'TNC', jac = True, bounds = bnds)
+        print('TNC Optimization details:')
+        print(Result)
+        self.state = self.recursive_state(Result.x)
+        return self.state
+
+    def predict_tile_recursive(self, x_star, state, full_cov=False):
+        """Predicts the recursive co-kriging mean and variance on one tile."""
+        rho = state.rho
+        psi_L = self.k(x_star, self.Xdata_L, self.model_parameters_L)
+        psi_D = self.k(x_star, self.Xdata_H, self.model_parameters_H)
+
+        # calculate prediction
+        mean_star = rho*(state.mu_L + psi_L@state.beta_L) + state.mu_D + psi_D@state.beta_D
+        if full_cov:
+            cov_L = self.k(x_star, x_star, self.model_parameters_L) - state.factor_L.quad(psi_L.T)
+            cov_D = self.k(x_star, x_star, self.model_parameters_H) - state.factor_D.quad(psi_D.T)
+            return mean_star, rho**2*cov_L + cov_D
+        var_L = self.k_diag(x_star, self.model_parameters_L) - state.factor_L.quad_diag(psi_L.T)
+        var_D = self.k_diag(x_star, self.model_parameters_H) - state.factor_D.quad_diag(psi_D.T)
+        var_star = abs(rho**2*var_L + var_D)
+        return mean_star, var_star
+
+    def kriging_state(self, hyp):
+        """Returns the prediction state (hyp, rho, mu, factor, beta) for hyp."""
+        C = self.factorize(hyp)
+        y = C['y']
+        mu = np.mean(y)
+        return KrigingState(hyp=np.array(hyp, dtype=float), rho=hyp[-1], mu=mu,
+                            factor=C['factor'], beta=C['factor'].solve(y-mu))
+
+    def fit(self, bnds=((-5, 2), (-5, 2), (0, 1)), hess=None, n_jobs=1):
+        """Fits [sigma_eps_L, sigma_eps_H, rho] by TNC and factors K once.
+
+        The fitted KrigingState is kept on the model for predict() and
+        save(), and is also returned. The state is immutable, so models
+        can be fitted and used for prediction concurrently. For a model
+        built with recursive=True this runs fit_recursive() instead.
+        With likelihood_mode='vecchia' the likelihood is evaluated over
+        n_jobs workers and K is not factored; the state then has no
+        factor and predict() kriges each point from its nearest sites.
+        """
+        if self.recursive:
+            return self.fit_recursive(bnds[:2])
+
         # initialhyp = [ sigma_eps_L  sigma_eps_H rho]
         inihyp = np.array([0, 0, 0])
-        bnds = ((-5, 2), (-5, 2), (0, 10))
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient, bounds = bnds)
+        Result = op.minimize(fun = self.value_and_grad, x0 = inihyp, args = (n_jobs,), method = 'TNC', jac = True, hess = hess, bounds = bnds)
         print('TNC Optimization details:')
         print(Result)
         hyp = Result.x
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-        rho = hyp[-1]
         # Set up the limit range of rho and assign the value when reaching the limit
-        if rho>1:
+        if hyp[-1]>1:
             hyp = np.array([0, 0, 0.8])
-            rho = hyp[-1]
-            self.likelihood(hyp)
-        y = np.concatenate([y_L, y_H])
-        mu = np.mean(y)
+        if self.likelihood_mode == 'vecchia':
+            mu = np.mean(np.concatenate([self.Kdata_L, self.Kdata_H]))
+            self.state = KrigingState(hyp=np.array(hyp, dtype=float), rho=hyp[-1], mu=mu, factor=None, beta=None)
+            return self.state
+        self.state = self.kriging_state(hyp)
+        return self.state
+
+    def border(self, X_new, fidelity, hyp):
+        """Returns the covariances (B, C) of new points at fidelity 'L' or 'H' and their row in K."""
+        sigma_eps_L = hyp[0]
+        sigma_eps_H = hyp[1]
+        rho = hyp[2]
+        N_L = len(self.Xdata_L)
+        N_H = len(self.Xdata_H)
+        if fidelity == 'L':
+            B_L = self.k(self.Xdata_L, X_new, self.model_parameters_L)
+            B_H = rho*self.k(self.Xdata_H, X_new, self.model_parameters_L)
+            C = self.k(X_new, X_new, self.model_parameters_L) + np.eye(len(X_new))*sigma_eps_L
+            index = N_L
+        else:
+            B_L = rho*self.k(self.Xdata_L, X_new, self.model_parameters_L)
+            B_H = (rho**2)*self.k(self.Xdata_H, X_new, self.model_parameters_L) + self.k(self.Xdata_H, X_new, self.model_parameters_H)
+            C = (rho**2)*self.k(X_new, X_new, self.model_parameters_L) + self.k(X_new, X_new, self.model_parameters_H) + np.eye(len(X_new))*sigma_eps_H
+            index = N_L + N_H
+        C = C + np.eye(len(X_new))*self.eps
+        return np.concatenate([B_L, B_H]), C, index
+
+    def add_observations(self, X_new, y_new, fidelity):
+        """Adds observations at fidelity 'L' or 'H' and updates the fitted state.
+
+        The hyperparameters of the fitted state are kept and the factor of
+        K is bordered with the new rows inside the L or H block in O(N^2)
+        instead of being refactored; mu and beta are then re-estimated.
+        A recursive state, or one with inducing points or a sparse
+        factor, is rebuilt from the new data. A state without a factor (from a Vecchia fit) only
+        updates mu. Call fit() to re-estimate the hyperparameters.
+        """
+        if fidelity not in ('L', 'H'):
+            raise Exception("The fidelity must be 'L' or 'H'!")
+        X_ref = self.Xdata_L if fidelity == 'L' else self.Xdata_H
+        y_ref = self.Kdata_L if fidelity == 'L' else self.Kdata_H
+        X_new = np.asarray(X_new, dtype=float).reshape((-1,) + np.shape(X_ref)[1:])
+        y_new = np.asarray(y_new, dtype=float).reshape((-1,) + np.shape(y_ref)[1:])
+
+        state = self.state
+        bordered = isinstance(state, KrigingState) and isinstance(state.factor, Factorization)
+        if bordered:
+            B, C, index = self.border(X_new, fidelity, state.hyp)
+            factor = state.factor.extend(B, C, index)
+
+        if fidelity == 'L':
+            self.Xdata_L = np.concatenate([self.Xdata_L, X_new])
+            self.Kdata_L = np.concatenate([self.Kdata_L, y_new])
+        else:
+            self.Xdata_H = np.concatenate([self.Xdata_H, X_new])
+            self.Kdata_H = np.concatenate([self.Kdata_H, y_new])
+        self.blocks = None
+        self.cache = None
+        self.neighborhood = None
+        self.local_factors.clear()
+        self.ordering = None
+
+        if bordered:
+            y = np.concatenate([self.Kdata_L, self.Kdata_H])
+            mu = np.mean(y)
+            self.state = state._replace(mu=mu, factor=factor, beta=factor.solve(y-mu))
+        elif isinstance(state, KrigingState) and state.factor is None:
+            self.state = state._replace(mu=np.mean(np.concatenate([self.Kdata_L, self.Kdata_H])))
+        elif isinstance(state, KrigingState):
+            self.state = self.kriging_state(state.hyp)
+        elif state is not None:
+            self.state = self.recursive_state(state.hyp)
+        return self.state
+
+    def predict_tile(self, x_star, state, full_cov=False):
+        """Predicts the co-kriging mean and variance on one tile.
+
+        Only the diagonal of the predictive covariance is computed unless
+        full_cov is set, in which case the tile x tile covariance is
+        returned instead of the variance.
+        """
+        if isinstance(state, RecursiveState):
+            return self.predict_tile_recursive(x_star, state, full_cov)
+        X_L = self.Xdata_L
+        X_H = self.Xdata_H
+        rho = state.rho
+        if isinstance(state.factor, SparseFactorization):
+            # FITC covariances with the low-fidelity level through the inducing points
+            K_su = self.k(x_star, self.inducing_L, self.model_parameters_L)
+            psi1 = rho*state.factor.project(K_su)
+            psi2_L = state.factor.project(K_su, self.k(X_H, self.inducing_L, self.model_parameters_L))
+        else:
+            psi1 = rho*self.k(x_star, X_L, self.model_parameters_L)
+            psi2_L = self.k(x_star, X_H, self.model_parameters_L)
+        psi2 = rho**2*psi2_L + self.k(x_star, X_H, self.model_parameters_H)
+        psi = np.concatenate([psi1, psi2], axis=1)
+
+        # calculate prediction
+        mean_star = state.mu + psi@state.beta
+        if full_cov:
+            cov_star = rho**2*self.k(x_star, x_star, self.model_parameters_L) + self.k(x_star, x_star, self.model_parameters_H) - state.factor.quad(psi.T)
+            return mean_star, cov_star
+        var_star = rho**2*self.k_diag(x_star, self.model_parameters_L) + self.k_diag(x_star, self.model_parameters_H) - state.factor.quad_diag(psi.T)
+        var_star = abs(var_star)
+        return mean_star, var_star
+
+    def local_factor(self, i_L, i_H, state):
+        """Factorization and beta of the co-kriging system on the sites i_L and i_H, cached."""
+        key = (tuple(state.hyp), float(state.mu), tuple(i_L), tuple(i_H))
+        local = self.local_factors.get(key)
+        if local is not None:
+            return local
+        sigma_eps_L = state.hyp[0]
+        sigma_eps_H = state.hyp[1]
+        rho = state.rho
+        X_L = self.Xdata_L[i_L]
+        X_H = self.Xdata_H[i_H]
+
+        # K matrix of the neighborhood
+        K_LL = self.k(X_L, X_L, self.model_parameters_L) + np.eye(len(i_L))*sigma_eps_L
+        K_LH = rho*self.k(X_L, X_H, self.model_parameters_L)
+        K_HH = (rho**2)*self.k(X_H, X_H, self.model_parameters_L) + self.k(X_H, X_H, self.model_parameters_H) + np.eye(len(i_H))*sigma_eps_H
+        K = np.concatenate([np.concatenate([K_LL,K_LH], axis=1),np.concatenate([K_LH.T,K_HH], axis=1)])
+        K = K + np.eye(len(K))*self.eps
+
+        F = Factorization(K)
+        y = np.concatenate([self.Kdata_L[i_L], self.Kdata_H[i_H]])
+        local = (F, F.solve(y-state.mu))
+        self.local_factors.put(key, local, F.nbytes() + local[1].nbytes)
+        return local
+
+    def predict_tile_local(self, x_star, state, neighborhood):
+        """Predicts the co-kriging mean and variance on one tile from the nearest sites of each point."""
+        rho = state.rho
+        mean_star = np.empty(len(x_star))
+        var_star = np.empty(len(x_star))
+        for rows, (i_L, i_H) in neighborhood.groups(x_star):
+            F, beta = self.local_factor(i_L, i_H, state)
+            x = x_star[rows]
+            psi1 = rho*self.k(x, self.Xdata_L[i_L], self.model_parameters_L)
+            psi2 = rho**2*self.k(x, self.Xdata_H[i_H], self.model_parameters_L) + self.k(x, self.Xdata_H[i_H], self.model_parameters_H)
+            psi = np.concatenate([psi1, psi2], axis=1)
+
+            # calculate prediction
+            mean_star[rows] = state.mu + (psi@beta).reshape(-1)
+            var_star[rows] = rho**2*self.k_diag(x, self.model_parameters_L) + self.k_diag(x, self.model_parameters_H) - F.quad_diag(psi.T)
+        var_star = abs(var_star)
+        return mean_star, var_star
+
+    def predict(self, x_star_all, state=None, out=None, tiles=False, full_cov=False,
+                budget=tiling.MEMORY_BUDGET, n_jobs=1, backend='thread', neighbors=None):
+        """Predicts the co-kriging mean and variance at x_star_all.
+
+        state holds rho, mu, the factorization of K and beta = K^-1 (y-mu);
+        it defaults to the state from fit() or load().
+        The points are predicted in tiles sized by budget (bytes) and
+        written into out = (mean, var) if given. With tiles=True a
+        generator of (slice, mean, var) per finished tile is returned.
+        With full_cov=True all points are predicted at once and the full
+        predictive covariance is returned in place of the variance.
+        n_jobs > 1 (or -1 for all cores) spreads the tiles over a pool of
+        threads, or of forked processes sharing the factorization when
+        backend='process'.
+        With neighbors = k each point is kriged from its k nearest
+        training sites per fidelity (an int or (k_L, k_H)) only (moving window), using hyp and mu of state;
+        the cost then scales with k instead of the number of sites.
+        A state without a factor uses neighbors = n_neighbors by default.
+        """
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() or load() first!")
+        if isinstance(state, KrigingState) and state.factor is None and neighbors is None:
+            neighbors = self.n_neighbors
+        x_star_all = x_star_all.reshape(len(x_star_all), -1)
+        if full_cov and neighbors is None:
+            mean_star, cov_star = self.predict_tile(x_star_all, state, full_cov=True)
+            return mean_star.reshape(-1), cov_star
+        N = len(self.Xdata_L) + len(self.Xdata_H)
+        predict_tile = lambda x_star: self.predict_tile(x_star, state)
+        if neighbors is not None:
+            if full_cov or isinstance(state, RecursiveState):
+                raise Exception("Neighborhood kriging only predicts the variance of a co-kriging state!")
+            if self.neighborhood is None or self.neighborhood[0] != neighbors:
+                self.neighborhood = (neighbors, Neighborhood([self.Xdata_L, self.Xdata_H], neighbors))
+            neighborhood = self.neighborhood[1]
+            N = neighborhood.size()
+            predict_tile = lambda x_star: self.predict_tile_local(x_star, state, neighborhood)
+        if tiles:
+            return tiling.iter_predict(predict_tile, x_star_all, N, budget, n_jobs, backend)
+        return tiling.predict(predict_tile, x_star_all, N, out, budget, n_jobs, backend)
+
+    def predict_grid(self, axes, state=None, out=None, budget=tiling.MEMORY_BUDGET, n_jobs=1, backend='thread'):
+        """Predicts the co-kriging mean and variance on the lattice of the coordinate values axes.
+
+        mean and var are returned (or written into out) in C order of the
+        lattice. With a separable kernel the tiles of covariances of the
+        lattice with the sites of both fidelities are assembled from
+        per-axis factors instead of distances. The nugget is not added at
+        lattice points that coincide with sites. Other kernels, inducing
+        points, recursive states and states without a factor predict at
+        the lattice points with predict().
+        """
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() or load() first!")
+        axes = [np.asarray(g, dtype=float).reshape(-1) for g in axes]
+        M = int(np.prod([len(g) for g in axes]))
+        if (self.kernel not in covariance_models.separable_kernels or isinstance(state, RecursiveState)
+                or state.factor is None or isinstance(state.factor, SparseFactorization)):
+            x_star_all = np.stack([x.reshape(-1) for x in np.meshgrid(*axes, indexing='ij')], axis=1)
+            return self.predict(x_star_all, state, out=out, budget=budget, n_jobs=n_jobs, backend=backend)
+
+        rho = state.rho
+        psill_L = float(self.model_parameters_L[0])
+        psill_H = float(self.model_parameters_H[0])
+        C0 = rho**2*self.k_diag(np.zeros(1), self.model_parameters_L) + self.k_diag(np.zeros(1), self.model_parameters_H)
+        X_L = np.reshape(self.Xdata_L, (len(self.Xdata_L), -1))
+        X_H = np.reshape(self.Xdata_H, (len(self.Xdata_H), -1))
+
+        # Per-axis covariances of the lattice values with the sites
+        axis_cov = lambda m, X: [covariance_models.axis_covariance(self.kernel, m, g, X[:, a])
+                                 for a, g in enumerate(axes)]
+        E_L = axis_cov(self.model_parameters_L, np.concatenate([X_L, X_H]))
+        E_H = axis_cov(self.model_parameters_H, X_H)
+        N_L = len(X_L)
+
+        def predict_tile(idx):
+            psi_L = psill_L*kronecker.grid_rows(E_L, idx)
+            psi1 = rho*psi_L[:, :N_L]
+            psi2 = rho**2*psi_L[:, N_L:] + psill_H*kronecker.grid_rows(E_H, idx)
+            psi = np.concatenate([psi1, psi2], axis=1)
+            mean_star = state.mu + psi@state.beta
+            var_star = C0 - state.factor.quad_diag(psi.T)
+            return mean_star, abs(var_star)
+
+        return tiling.predict(predict_tile, np.arange(M), N_L + len(X_H), out, budget, n_jobs, backend)
+
+    def predict_meshgrid(self, coords, state=None, out=None, n_jobs=1):
+        """Predicts on the np.meshgrid arrays coords through predict_grid.
+
+        Returns None unless the kernel is separable, state is a co-kriging
+        state with an exact or sparse factor and coords form a lattice.
+        """
+        if state is None:
+            state = self.state
+        if (self.kernel not in covariance_models.separable_kernels or isinstance(state, RecursiveState)
+                or state.factor is None or isinstance(state.factor, SparseFactorization)):
+            return None
+        lattice = kronecker.meshgrid_axes(*coords)
+        if lattice is None:
+            return None
+        axes, dims = lattice
+        mean_star, var_star = self.predict_grid(axes, state, n_jobs=n_jobs)
+        mean_star_all = kronecker.to_meshgrid(mean_star, axes, dims)
+        var_star_all = kronecker.to_meshgrid(var_star, axes, dims)
+        if out is not None:
+            out[0][...] = mean_star_all
+            out[1][...] = var_star_all
+            return out
+        return mean_star_all, var_star_all
+
+    def save(self, path, state=None):
+        """Saves the training data and fitted state to a .npz file at path."""
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() first!")
+        arrays = {'Xdata_H': self.Xdata_H, 'Kdata_H': self.Kdata_H,
+                  'Xdata_L': self.Xdata_L, 'Kdata_L': self.Kdata_L,
+                  'model_parameters_H': self.model_parameters_H,
+                  'model_parameters_L': self.model_parameters_L}
+        if self.inducing_L is not None:
+            arrays['inducing_L'] = self.inducing_L
+        if self.kernel != 'variogram':
+            arrays['kernel'] = np.array(self.kernel)
+            if self.taper is not None:
+                arrays['taper'] = np.array(self.taper)
+        if isinstance(state, RecursiveState):
+            arrays.update({'hyp': state.hyp, 'rho': state.rho,
+                           'mu_L': state.mu_L, 'beta_L': state.beta_L,
+                           'mu_D': state.mu_D, 'beta_D': state.beta_D})
+            arrays.update(state.factor_L.arrays('factor_L_'))
+            arrays.update(state.factor_D.arrays('factor_D_'))
+        elif state.factor is None:
+            arrays.update({'hyp': state.hyp, 'mu': state.mu, 'n_neighbors': self.n_neighbors})
+        else:
+            arrays.update({'hyp': state.hyp, 'mu': state.mu, 'beta': state.beta})
+            arrays.update(state.factor.arrays())
+        artifact.save(path, arrays)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a model saved by save(), ready to predict without refitting.
+
+        With mmap set the training data and factorization are memory-mapped
+        from the file instead of being read into memory.
+        """
+        A = artifact.load(path, mmap)
+        recursive = 'beta_D' in A
+        inducing_L = A['inducing_L'] if 'inducing_L' in A else None
+        kernel = str(A['kernel']) if 'kernel' in A else 'variogram'
+        taper = float(A['taper']) if 'taper' in A else None
+        model = cls(A['Xdata_H'], A['Kdata_H'], A['Xdata_L'], A['Kdata_L'],
+                    A['model_parameters_H'], A['model_parameters_L'], recursive, inducing_L,
+                    kernel=kernel, taper=taper)
+        if recursive:
+            model.state = RecursiveState(hyp=np.array(A['hyp']), rho=float(A['rho']),
+                                         mu_L=float(A['mu_L']), factor_L=Factorization.from_arrays(A, 'factor_L_'),
+                                         beta_L=A['beta_L'], mu_D=float(A['mu_D']),
+                                         factor_D=Factorization.from_arrays(A, 'factor_D_'), beta_D=A['beta_D'])
+            return model
+        if 'beta' not in A:
+            # fitted on the Vecchia likelihood, predicted from neighborhoods
+            model.likelihood_mode = 'vecchia'
+            model.n_neighbors = int(A['n_neighbors'])
+            model.state = KrigingState(hyp=np.array(A['hyp']), rho=float(A['hyp'][-1]), mu=float(A['mu']),
+                                       factor=None, beta=None)
+            return model
+        if 'factor_lam' in A:
+            factor = SparseFactorization.from_arrays(A)
+        elif 'factor_K_data' in A:
+            factor = SparseMatrixFactorization.from_arrays(A)
+        else:
+            factor = Factorization.from_arrays(A)
+        model.state = KrigingState(hyp=np.array(A['hyp']), rho=float(A['hyp'][-1]), mu=float(A['mu']),
+                                   factor=factor, beta=A['beta'])
+        return model
+
+    def execute1D(self, xx, out=None, n_jobs=1):
+        rho = self.fit(bnds = ((-5, 2), (-5, 2), (0, 10))).rho
         
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
         x_star_all = xx
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi1 = rho*self.k(x_star, X_L, self.model_parameters_L)
-            psi2 = rho**2*self.k(x_star, X_H, self.model_parameters_L) + self.k(x_star, X_H, self.model_parameters_H)
-            psi = np.concatenate([psi1, psi2], axis=1)
-        
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            var_star = rho**2*self.k(x_star, x_star, self.model_parameters_L) + self.k(x_star, x_star, self.model_parameters_H) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
         
         #mean_star_all = mean_star_all.reshape(dim[0])
         #var_star_all = var_star_all.reshape(dim[0])
 
         return mean_star_all, var_star_all, rho
 
-    def execute2D(self, xx, yy):
-        # initialhyp = [ sigma_eps_L  sigma_eps_H rho]
-        inihyp = np.array([0, 0, 0])
-        bnds = ((-5, 2), (-5, 2), (0, 1))
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient, bounds = bnds)
-        print('TNC Optimization details:')
-        print(Result)
-        hyp = Result.x
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-        rho = hyp[-1]
-
-        y = np.concatenate([y_L, y_H])
-        mu = np.mean(y)
+    def execute2D(self, xx, yy, out=None, n_jobs=1):
+        rho = self.fit(bnds = ((-5, 2), (-5, 2), (0, 1))).rho
         
+        grid = self.predict_meshgrid((xx, yy), out=out, n_jobs=n_jobs)
+        if grid is not None:
+            return grid[0], grid[1], rho
+
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
         yy = yy.reshape(np.size(yy),-1)
         x_star_all = np.concatenate([xx, yy],axis=1)
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi1 = rho*self.k(x_star, X_L, self.model_parameters_L)
-            psi2 = rho**2*self.k(x_star, X_H, self.model_parameters_L) + self.k(x_star, X_H, self.model_parameters_H)
-            psi = np.concatenate([psi1, psi2], axis=1)
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            var_star = rho**2*self.k(x_star, x_star, self.model_parameters_L) + self.k(x_star, x_star, self.model_parameters_H) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0], dim[1])
         var_star_all = var_star_all.reshape(dim[0], dim[1])
@@ -310,28 +946,13 @@ class MultiKriging:
         
         return mean_star_all, var_star_all, rho
     
-    def execute3D(self, xx, yy, zz):
-        # initialhyp = [ sigma_eps_L  sigma_eps_H rho]
-        inihyp = np.array([0, 0, 0])
-        bnds = ((-5, 2), (-5, 2), (0, 10))
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient, hess = self.Hessian, bounds = bnds)
-        print('TNC Optimization details:')
-        print(Result)
-        hyp = Result.x
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-        rho = hyp[-1]
-        # Set up the limit range of rho and assign the value when reaching the limit
-        if rho>1:
-            hyp = np.array([0, 0, 0.8])
-            rho = hyp[-1]
-            self.likelihood(hyp)
-        D = np.size(X_H)/len(X_H)
-        y = np.concatenate([y_L, y_H])
-        mu = np.mean(y)
+    def execute3D(self, xx, yy, zz, out=None, n_jobs=1):
+        rho = self.fit(bnds = ((-5, 2), (-5, 2), (0, 10)), hess = self.Hessian).rho
         
+        grid = self.predict_meshgrid((xx, yy, zz), out=out, n_jobs=n_jobs)
+        if grid is not None:
+            return grid[0], grid[1], rho
+
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
@@ -339,93 +960,28 @@ class MultiKriging:
         zz = zz.reshape(np.size(zz),-1)
         x_star_all = np.concatenate([xx, yy, zz],axis=1)
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi1 = rho*self.k(x_star, X_L, self.model_parameters_L)
-            psi2 = rho**2*self.k(x_star, X_H, self.model_parameters_L) + self.k(x_star, X_H, self.model_parameters_H)
-            psi = np.concatenate([psi1, psi2], axis=1)
-        
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            var_star = rho**2*self.k(x_star, x_star, self.model_parameters_L) + self.k(x_star, x_star, self.model_parameters_H) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0], dim[1], dim[2])
         var_star_all = var_star_all.reshape(dim[0], dim[1], dim[2])
         
         return mean_star_all, var_star_all, rho
     
-    def MultiKrig2D(self, xx, yy, r):
-        X_L = self.Xdata_L
-        X_H = self.Xdata_H
-        y_L = self.Kdata_L
-        y_H = self.Kdata_H
-
-        sigma_eps_L = 0
-        sigma_eps_H = 0
-        rho = r
-
-        y = np.concatenate([y_L, y_H])
-        mu = np.mean(y)
-
-        N_L = len(X_L)
-        N_H = len(X_H)
-        N = N_L + N_H
- 
-        K_LL = self.k(X_L, X_L, self.model_parameters_L)
-        K_LH = rho*self.k(X_L, X_H, self.model_parameters_L)
-        K_HL = rho*self.k(X_H, X_L, self.model_parameters_L)
-        K_HH = (rho**2)*self.k(X_H, X_H, self.model_parameters_L) + self.k(X_H, X_H, self.model_parameters_H)
- 
-        K_LL = K_LL + np.eye(N_L)*sigma_eps_L
-        K_HH = K_HH + np.eye(N_H)*sigma_eps_H
- 
-        K = np.concatenate([np.concatenate([K_LL,K_LH], axis=1),np.concatenate([K_HL,K_HH], axis=1)])
-        K = K + np.eye(N)*self.eps
-        
-        # LU Decomposition
-        PP, LL, UU = sla.lu(K)        
+    def MultiKrig2D(self, xx, yy, r, out=None, n_jobs=1):
+        # Co-Kriging with a given rho and without noise terms
+        state = self.kriging_state(np.array([0, 0, r]))
        
+        grid = self.predict_meshgrid((xx, yy), state, out=out, n_jobs=n_jobs)
+        if grid is not None:
+            return grid
+
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
         yy = yy.reshape(np.size(yy),-1)
         x_star_all = np.concatenate([xx, yy],axis=1)
 
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi1 = rho*self.k(x_star, X_L, self.model_parameters_L)
-            psi2 = rho**2*self.k(x_star, X_H, self.model_parameters_L) + self.k(x_star, X_H, self.model_parameters_H)
-            psi = np.concatenate([psi1, psi2], axis=1)
-        
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(UU)@(la.inv(LL)@(PP.T@(y-mu))))
-            var_star = rho**2*self.k(x_star, x_star, self.model_parameters_L) + self.k(x_star, x_star, self.model_parameters_H) - psi@(la.inv(UU)@(la.inv(LL)@(PP.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, state, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0], dim[1])
         var_star_all = var_star_all.reshape(dim[0], dim[1])
@@ -434,5 +990,3 @@ class MultiKriging:
         #var_lognormal = (np.exp(var_star_all)-1)*np.exp(2*mean_star_all+var_star_all)
         
         return mean_star_all, var_star_all
-    
-    
@@ -0,0 +1,350 @@
+__doc__ = """
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+-------
+Contains class MultiLevelKriging
+Contains PyKrige.variogram_models
+
+Summary
+-------
+Autoregressive co-kriging over an arbitrary number of fidelity levels
+[1]. Level t is modelled as f_t(x) = rho_t-1*f_t-1(x) + delta_t(x), so
+
+    Cov(f_s(x), f_t(x')) = sum_{i<=min(s,t)} c_is*c_it*k_i(x, x'),
+
+where c_it is the product of rho_i ... rho_t-1 (c_tt = 1). The kernel
+blocks k_i(X_s, X_t) do not depend on the hyperparameters and are cached
+once per model; K is reassembled from them for every [sigma_eps, rho].
+
+References
+----------
+.. [1] Kennedy, M. C., & O'Hagan, A. (2000). Predicting the output from
+a complex computer code when fast approximations are available.
+Biometrika, 87(1), 1-13.
+.. [2] P.K. Kitanidis, Introduction to Geostatistcs: Applications in
+Hydrogeology, (Cambridge University Press, 1997) 272 p.
+
+"""
+
+import numpy as np
+from scipy.spatial.distance import cdist
+import scipy.optimize as op
+from multifidgp.factorization import Factorization, KrigingState
+from multifidgp import tiling
+from multifidgp import artifact
+from multifidgp.variogram_models import exponential_variogram_model
+
+
+class MultiLevelKriging:
+
+    eps = 1.e-10   # Cutoff for comparison to zero
+    # levels = [(XData_1, KData_1, model_parameters_1), ..., (XData_T, KData_T, model_parameters_T)]
+    # ordered from the lowest to the highest fidelity, model_parameters_t = [s r n]
+    # hyp = [sigma_eps_1 ... sigma_eps_T rho_1 ... rho_T-1]
+
+    def __init__(self, levels):
+        self.Xdata = [X for X, K, m in levels]
+        self.Kdata = [K for X, K, m in levels]
+        self.model_parameters = [m for X, K, m in levels]
+        self.T = len(levels)
+        self.blocks = None
+        self.cache = None
+        self.state = None
+
+    def k(self, X1, X2, model_parameters):
+        """Assembles the kriging matrix."""
+        if X1.size==len(X1):
+            X1=X1.reshape(len(X1),1)
+            X2=X2.reshape(len(X2),1)
+        d = cdist(X1, X2, 'euclidean')
+        n1 = len(X1)
+        n2 = len(X2)
+        K = np.zeros((n1, n2))
+        # Assign Exponential variogram model
+        K[:n1, :n2] = exponential_variogram_model(model_parameters, d)
+        return K
+
+    def k_diag(self, X, model_parameters):
+        """Diagonal of the kriging matrix k(X, X)."""
+        d = np.zeros(len(X))
+        # Assign Exponential variogram model
+        return exponential_variogram_model(model_parameters, d)
+
+    def coefficient(self, i, s, t, rho, j=None):
+        """Coefficient c_is*c_it of k_i in Cov(f_s, f_t), or its derivative in rho_j."""
+        n = np.zeros(self.T-1)
+        n[i:s] += 1
+        n[i:t] += 1
+        if j is None:
+            return np.prod(rho**n)
+        if n[j] == 0:
+            return 0.
+        m = n.copy()
+        m[j] -= 1
+        return n[j]*np.prod(rho**m)
+
+    def kernel_blocks(self):
+        """Assembles the hyperparameter-independent blocks k_i(X_s, X_t) once."""
+        if self.blocks is None:
+            blocks = {}
+            for s in range(self.T):
+                for t in range(s, self.T):
+                    for i in range(s+1):
+                        blocks[i, s, t] = self.k(self.Xdata[s], self.Xdata[t], self.model_parameters[i])
+            self.blocks = blocks
+        return self.blocks
+
+    def assemble(self, rho, j=None):
+        """Assembles K without noise terms from the cached blocks, or dK/drho_j."""
+        B = self.kernel_blocks()
+        n = [len(X) for X in self.Xdata]
+        o = np.cumsum([0] + n)
+        K = np.zeros((o[-1], o[-1]))
+        for s in range(self.T):
+            for t in range(s, self.T):
+                K_st = np.zeros((n[s], n[t]))
+                for i in range(s+1):
+                    c = self.coefficient(i, s, t, rho, j)
+                    if c != 0:
+                        K_st += c*B[i, s, t]
+                K[o[s]:o[s+1], o[t]:o[t+1]] = K_st
+                K[o[t]:o[t+1], o[s]:o[s+1]] = K_st.T
+        return K
+
+    def factorize(self, hyp):
+        """Factors the co-kriging matrix once per distinct hyp."""
+        key = tuple(np.asarray(hyp, dtype=float).reshape(-1))
+        cached = self.cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        hyp = np.asarray(hyp, dtype=float)
+        sigma_eps = hyp[:self.T]
+        rho = hyp[self.T:]
+        y = np.concatenate(self.Kdata)
+
+        # Noise of each level on the diagonal
+        noise = np.concatenate([np.ones(len(X))*sigma_eps[t] for t, X in enumerate(self.Xdata)])
+        K = self.assemble(rho) + np.diag(noise + self.eps)
+
+        # Cholesky Decomposition (LU if K is not positive definite)
+        F = Factorization(K)
+        alpha = F.solve(y)
+
+        C = {'y': y, 'N': len(y), 'factor': F, 'alpha': alpha, 'logdet': F.logdet()}
+        # key and factorization are swapped in together for concurrent callers
+        self.cache = (key, C)
+        return C
+
+    def likelihood(self, hyp):
+        C = self.factorize(hyp)
+        y = C['y']
+        N = C['N']
+        alpha = C['alpha']
+
+        NLML = 0.5*y.T@alpha + 0.5*C['logdet'] + np.log(2*np.pi)*N/2
+        print(NLML, hyp)
+        return NLML
+
+    def Gradient(self, hyp):
+        C = self.factorize(hyp)
+        alpha = C['alpha']
+        factor = C['factor']
+
+        hyp = np.asarray(hyp, dtype=float)
+        sigma_eps = hyp[:self.T]
+        rho = hyp[self.T:]
+        o = np.cumsum([0] + [len(X) for X in self.Xdata])
+
+        # Derivatives, with Q = K^-1 - alpha*alpha^T (dL/dK) kept implicit
+        D_NLML = np.zeros(len(hyp))
+        trace_Q = factor.inv_diag() - np.sum(alpha.reshape(len(alpha), -1)**2, axis=1)
+        for t in range(self.T):
+            D_NLML[t] = sigma_eps[t]*np.sum(trace_Q[o[t]:o[t+1]])/2  # Derivatives for eps_t
+        for j in range(self.T-1):
+            DK = self.assemble(rho, j)
+            D_NLML[self.T+j] = (factor.trace_solve(DK) - np.sum(alpha*(DK@alpha)))/2  # Derivatives for rho_j
+        return D_NLML
+
+    def value_and_grad(self, hyp):
+        """Returns the NLML and its gradient from one factorization of K."""
+        return self.likelihood(hyp), self.Gradient(hyp)
+
+    def kriging_state(self, hyp):
+        """Returns the prediction state (hyp, rho, mu, factor, beta) for hyp."""
+        C = self.factorize(hyp)
+        y = C['y']
+        mu = np.mean(y)
+        hyp = np.array(hyp, dtype=float)
+        return KrigingState(hyp=hyp, rho=hyp[self.T:], mu=mu,
+                            factor=C['factor'], beta=C['factor'].solve(y-mu))
+
+    def fit(self, bnds=None):
+        """Fits [sigma_eps_1..T, rho_1..T-1] by TNC and factors K once.
+
+        bnds defaults to (-5, 2) for each noise term and (0, 1) for each
+        rho. The fitted KrigingState is kept on the model for predict()
+        and save(), and is also returned.
+        """
+        if bnds is None:
+            bnds = ((-5, 2),)*self.T + ((0, 1),)*(self.T-1)
+        inihyp = np.zeros(2*self.T-1)
+        Result = op.minimize(fun = self.value_and_grad, x0 = inihyp, method = 'TNC', jac = True, bounds = bnds)
+        print('TNC Optimization details:')
+        print(Result)
+        self.state = self.kriging_state(Result.x)
+        return self.state
+
+    def border(self, X_new, fidelity, hyp):
+        """Returns the covariances (B, C) of new points at level fidelity and their row in K."""
+        t = fidelity
+        sigma_eps = hyp[:self.T]
+        rho = hyp[self.T:]
+        B = np.concatenate([sum(self.coefficient(i, s, t, rho)*self.k(self.Xdata[s], X_new, self.model_parameters[i])
+                                for i in range(min(s, t)+1)) for s in range(self.T)])
+        C = sum(self.coefficient(i, t, t, rho)*self.k(X_new, X_new, self.model_parameters[i]) for i in range(t+1))
+        C = C + np.eye(len(X_new))*(sigma_eps[t] + self.eps)
+        index = sum(len(X) for X in self.Xdata[:t+1])
+        return B, C, index
+
+    def add_observations(self, X_new, y_new, fidelity):
+        """Adds observations at level fidelity (0 is the lowest) and updates the fitted state.
+
+        The hyperparameters of the fitted state are kept and the factor of
+        K is bordered with the new rows inside the level's block in O(N^2)
+        instead of being refactored; mu and beta are then re-estimated.
+        """
+        if fidelity not in range(self.T):
+            raise Exception("The fidelity must be a level index from 0 to %d!" % (self.T-1))
+        t = fidelity
+        X_new = np.asarray(X_new, dtype=float).reshape((-1,) + np.shape(self.Xdata[t])[1:])
+        y_new = np.asarray(y_new, dtype=float).reshape((-1,) + np.shape(self.Kdata[t])[1:])
+
+        state = self.state
+        if state is not None:
+            B, C, index = self.border(X_new, t, state.hyp)
+            factor = state.factor.extend(B, C, index)
+
+        self.Xdata[t] = np.concatenate([self.Xdata[t], X_new])
+        self.Kdata[t] = np.concatenate([self.Kdata[t], y_new])
+        self.blocks = None
+        self.cache = None
+
+        if state is not None:
+            y = np.concatenate(self.Kdata)
+            mu = np.mean(y)
+            self.state = state._replace(mu=mu, factor=factor, beta=factor.solve(y-mu))
+        return self.state
+
+    def predict_tile(self, x_star, state, full_cov=False):
+        """Predicts the highest-fidelity mean and variance on one tile.
+
+        Only the diagonal of the predictive covariance is computed unless
+        full_cov is set, in which case the tile x tile covariance is
+        returned instead of the variance.
+        """
+        T = self.T-1
+        rho = state.rho
+        psi = np.concatenate([sum(self.coefficient(i, s, T, rho)*self.k(x_star, self.Xdata[s], self.model_parameters[i])
+                                  for i in range(s+1)) for s in range(self.T)], axis=1)
+
+        # calculate prediction
+        mean_star = state.mu + psi@state.beta
+        if full_cov:
+            cov_star = sum(self.coefficient(i, T, T, rho)*self.k(x_star, x_star, self.model_parameters[i])
+                           for i in range(self.T)) - state.factor.quad(psi.T)
+            return mean_star, cov_star
+        var_star = sum(self.coefficient(i, T, T, rho)*self.k_diag(x_star, self.model_parameters[i])
+                       for i in range(self.T)) - state.factor.quad_diag(psi.T)
+        var_star = abs(var_star)
+        return mean_star, var_star
+
+    def predict(self, x_star_all, state=None, out=None, tiles=False, full_cov=False,
+                budget=tiling.MEMORY_BUDGET, n_jobs=1, backend='thread'):
+        """Predicts the highest-fidelity mean and variance at x_star_all.
+
+        Takes the same options as MultiKriging.predict; state defaults to
+        the state from fit() or load().
+        """
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() or load() first!")
+        x_star_all = x_star_all.reshape(len(x_star_all), -1)
+        if full_cov:
+            mean_star, cov_star = self.predict_tile(x_star_all, state, full_cov=True)
+            return mean_star.reshape(-1), cov_star
+        N = sum(len(X) for X in self.Xdata)
+        predict_tile = lambda x_star: self.predict_tile(x_star, state)
+        if tiles:
+            return tiling.iter_predict(predict_tile, x_star_all, N, budget, n_jobs, backend)
+        return tiling.predict(predict_tile, x_star_all, N, out, budget, n_jobs, backend)
+
+    def save(self, path, state=None):
+        """Saves the training data and fitted state to a .npz file at path."""
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() first!")
+        arrays = {'hyp': state.hyp, 'mu': state.mu, 'beta': state.beta}
+        for t in range(self.T):
+            arrays['Xdata_%d' % t] = self.Xdata[t]
+            arrays['Kdata_%d' % t] = self.Kdata[t]
+            arrays['model_parameters_%d' % t] = self.model_parameters[t]
+        arrays.update(state.factor.arrays())
+        artifact.save(path, arrays)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Loads a model saved by save(), ready to predict without refitting."""
+        A = artifact.load(path, mmap)
+        T = (len(A['hyp'])+1)//2
+        model = cls([(A['Xdata_%d' % t], A['Kdata_%d' % t], A['model_parameters_%d' % t]) for t in range(T)])
+        hyp = np.array(A['hyp'])
+        model.state = KrigingState(hyp=hyp, rho=hyp[T:], mu=float(A['mu']),
+                                   factor=Factorization.from_arrays(A), beta=A['beta'])
+        return model
+
+    def execute1D(self, xx, out=None, n_jobs=1):
+        rho = self.fit().rho
+
+        xx = xx.reshape(np.size(xx),-1)
+        mean_star_all, var_star_all = self.predict(xx, out=out, n_jobs=n_jobs)
+
+        return mean_star_all, var_star_all, rho
+
+    def execute2D(self, xx, yy, out=None, n_jobs=1):
+        rho = self.fit().rho
+
+        dim = xx.shape
+
+        xx = xx.reshape(np.size(xx),-1)
+        yy = yy.reshape(np.size(yy),-1)
+        x_star_all = np.concatenate([xx, yy],axis=1)
+
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
+
+        mean_star_all = mean_star_all.reshape(dim[0], dim[1])
+        var_star_all = var_star_all.reshape(dim[0], dim[1])
+
+        return mean_star_all, var_star_all, rho
+
+    def execute3D(self, xx, yy, zz, out=None, n_jobs=1):
+        rho = self.fit().rho
+
+        dim = xx.shape
+
+        xx = xx.reshape(np.size(xx),-1)
+        yy = yy.reshape(np.size(yy),-1)
+        zz = zz.reshape(np.size(zz),-1)
+        x_star_all = np.concatenate([xx, yy, zz],axis=1)
+
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
+
+        mean_star_all = mean_star_all.reshape(dim[0], dim[1], dim[2])
+        var_star_all = var_star_all.reshape(dim[0], dim[1], dim[2])
+
+        return mean_star_all, var_star_all, rho
@@ -0,0 +1,54 @@
+__doc__ = """
+Neighborhood
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Moving-window (local neighborhood) kriging support. The training sites of
+each fidelity level are indexed by a KD-tree and every prediction point is
+kriged from its k nearest sites per level only. Points that share the same
+neighbor sets, which is common for adjacent points of a prediction grid,
+are grouped so that each local system is factored once; the kriging
+classes keep those factorizations in a FactorCache across tiles.
+
+References
+----------
+.. [1] P.K. Kitanidis, Introduction to Geostatistcs: Applications in
+Hydrogeology, (Cambridge University Press, 1997) 272 p.
+
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class Neighborhood:
+
+    def __init__(self, Xs, k):
+        """Indexes the training sets Xs, k nearest sites per set (an int or one per set)."""
+        if np.ndim(k) == 0:
+            k = [k]*len(Xs)
+        self.trees = [cKDTree(np.reshape(X, (len(X), -1))) for X in Xs]
+        self.k = [int(min(n, len(X))) for n, X in zip(k, Xs)]
+
+    def size(self):
+        """Number of training sites in one neighborhood."""
+        return sum(self.k)
+
+    def groups(self, x_star):
+        """Yields (rows of x_star, neighbor indices per set) for points sharing their neighbors."""
+        x_star = np.reshape(x_star, (len(x_star), -1))
+        idx = [np.sort(tree.query(x_star, k)[1].reshape(len(x_star), -1), axis=1)
+               for tree, k in zip(self.trees, self.k)]
+        sets, inverse = np.unique(np.concatenate(idx, axis=1), axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.cumsum(np.bincount(inverse, minlength=len(sets)))
+        splits = np.cumsum(self.k)[:-1]
+        start = 0
+        for g, end in enumerate(bounds):
+            yield order[start:end], np.split(sets[g], splits)
+            start = end
@@ -27,18 +27,42 @@ import numpy.linalg as la
 from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
 import scipy.optimize as op
+from scipy.special import logsumexp
+from numpy.polynomial.chebyshev import chebvander
+from multifidgp.factorization import Factorization, FactorCache, FACTOR_BUDGET
+from multifidgp import tiling
+from multifidgp import surrogate
 from multifidgp.variogram_models import gaussian_variogram_model
 from multifidgp.variogram_models import exponential_variogram_model
 
 class SingleBayesianExp:
 
     eps = 1.e-10   # Cutoff for comparison to zero
+    # nested Monte Carlo expected information gain, or its second-order
+    # expansion in the spread of the model outputs with the outputs
+    # interpolated in the range (laplace), see expected_information_local
+    utility_modes = ('nested_mc', 'laplace')
+    n_nodes = 7   # Chebyshev nodes of the range interpolation of the 'laplace' Utility
     # model_parameters = [s r n]
     
-    def __init__(self, XData, KData, model_parameters):
+    def __init__(self, XData, KData, model_parameters, cache_budget=FACTOR_BUDGET,
+                 n_samples=100, seed=None, utility_mode='nested_mc'):
         self.Xdata=XData
         self.Kdata=KData
         self.model_parameters=model_parameters
+        self.n_samples=n_samples   # Gaussian samplings of the Utility
+        self.seed=seed   # Seed of the common random numbers, None for the global random state
+        if utility_mode not in self.utility_modes:
+            raise Exception("The utility mode must be 'nested_mc' or 'laplace'!")
+        self.utility_mode=utility_mode
+        # Factorizations per sampled range r, keyed with the training data version
+        self.version = 0
+        self.factors = FactorCache(cache_budget)
+
+    def invalidate(self):
+        """Drops the cached factorizations, call after changing the training data."""
+        self.version += 1
+        self.factors.clear()
 
     def k(self, X1, X2, model_parameters):
         """Assembles the kriging matrix."""
@@ -53,11 +77,42 @@ class SingleBayesianExp:
         K[:n1, :n2] = exponential_variogram_model(model_parameters, d)
         return K
     
+    def k_diag(self, X, model_parameters):
+        """Diagonal of the kriging matrix k(X, X)."""
+        d = np.zeros(len(X))
+        # Assign Exponential variogram model
+        return exponential_variogram_model(model_parameters, d)
+
+    def k_grad(self, X1, X2, model_parameters):
+        """Derivative of the kriging matrix k(X1, X2) with respect to the locations X1, shape (n1, n2, d)."""
+        if X1.size==len(X1):
+            X1=X1.reshape(len(X1),1)
+            X2=X2.reshape(len(X2),1)
+        diff = X1[:, None, :] - X2[None, :, :]
+        d = np.sqrt(np.sum(diff**2, axis=2))
+        # Derivative of the Exponential variogram model with respect to distance
+        psill = float(model_parameters[0])
+        range_ = float(model_parameters[1])
+        dgamma = psill*3./range_*np.exp(-d/(range_/3.))
+        # d(distance)/dX1 is the unit vector from X2 to X1, taken as 0 at zero distance
+        dd = np.divide(diff, d[:, :, None], out=np.zeros(diff.shape), where=d[:, :, None]>0)
+        return dgamma[:, :, None]*dd
+
     def likelihood(self, d, G):
         p = np.exp(-0.5*(d-G)**2)
         return p
     
-    def SingleKrig(self, s, r):
+    def factor_sample(self, r):
+        """Factors the kriging matrix for one sampled range r, returns (factor, mu, beta)."""
+        key = (self.version, float(r))
+        sample = self.factors.get(key)
+        if sample is None:
+            sample = self.compute_sample(r)
+            self.factors.put(key, sample, sample[0].nbytes() + sample[2].nbytes)
+        return sample
+
+    def compute_sample(self, r):
+        """Factors the kriging matrix for one sampled range r without the cache."""
         X = self.Xdata
         y = np.log(self.Kdata)
         mu = np.mean(y)
@@ -65,127 +120,359 @@ class SingleBayesianExp:
         N = len(X)
 
         # K matrix
-        K = self.k(X, X, self.model_parameters) 
+        K = self.k(X, X, np.array([self.model_parameters[0], r, self.model_parameters[2]])) 
         K = K + np.eye(N)*self.eps
         
-        # LU Decomposition
-        P, L, U = sla.lu(K)
+        # Cholesky Decomposition (LU if K is not positive definite)
+        F = Factorization(K)
+        return F, mu, F.solve(y-mu)
 
-        s = s.reshape(-1)
-        x_star = s.reshape([1,len(s)])
-        dim = x_star.shape
+    def border(self, X_new, r):
+        """Returns the covariances (B, C) of new points with the data and with themselves."""
+        model_parameters = np.array([self.model_parameters[0], r, self.model_parameters[2]])
+        B = self.k(self.Xdata, X_new, model_parameters)
+        C = self.k(X_new, X_new, model_parameters) + np.eye(len(X_new))*self.eps
+        return B, C
+
+    def add_observations(self, X_new, K_new):
+        """Adds observations to the training data.
+
+        Every cached factorization is bordered with the new rows in O(N^2)
+        instead of being refactored, and is kept under the new training
+        data version.
+        """
+        X_new = np.asarray(X_new, dtype=float).reshape((-1,) + np.shape(self.Xdata)[1:])
+        K_new = np.asarray(K_new, dtype=float).reshape((-1,) + np.shape(self.Kdata)[1:])
 
-        psi = self.k(x_star, X, self.model_parameters)
+        samples = [(key, sample) for key, sample in self.factors.items() if key[0] == self.version]
+        borders = [self.border(X_new, key[1]) for key, sample in samples]
+
+        self.Xdata = np.concatenate([self.Xdata, X_new])
+        self.Kdata = np.concatenate([self.Kdata, K_new])
+        self.invalidate()
+
+        y = np.log(self.Kdata)
+        mu = np.mean(y)
+        for (key, sample), (B, C) in zip(samples, borders):
+            F = sample[0].extend(B, C)
+            beta = F.solve(y-mu)
+            self.factors.put((self.version,) + key[1:], (F, mu, beta), F.nbytes() + beta.nbytes)
+
+    def SingleKrig_batch(self, x_star, r):
+        """Lognormal kriging mean and variance at the (M, d) locations x_star for one range r."""
+        X = self.Xdata
+        F, mu, beta = self.factor_sample(r)
+
+        psi = self.k(x_star, X, np.array([self.model_parameters[0], r, self.model_parameters[2]]))
         
         # calculate prediction
-        mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-        var_star = self.k(x_star, x_star, self.model_parameters) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-        var_star = abs(np.diag(var_star))
+        mean_star = mu + (psi@beta).reshape(-1)
+        var_star = self.k_diag(x_star, np.array([self.model_parameters[0], r, self.model_parameters[2]])) - F.quad_diag(psi.T)
+        var_star = abs(var_star)
 
         mean_lognormal = np.exp(mean_star + 0.5*var_star)
         var_lognormal = (np.exp(var_star)-1)*np.exp(2*mean_star+var_star)     
-        return mean_lognormal, var_lognormal
+        return mean_lognormal.reshape(-1), var_lognormal.reshape(-1)
+
+    def SingleKrig_grad(self, x_star, r):
+        """SingleKrig_batch with the derivatives of the mean and variance with respect to x_star, each (M, d)."""
+        X = self.Xdata
+        model_parameters = np.array([self.model_parameters[0], r, self.model_parameters[2]])
+        F, mu, beta = self.factor_sample(r)
+
+        psi = self.k(x_star, X, model_parameters)
+        dpsi = self.k_grad(x_star, X, model_parameters)
+
+        # calculate prediction and its derivatives with respect to x_star
+        mean_star = mu + (psi@beta).reshape(-1)
+        dmean_star = np.einsum('mnd,n->md', dpsi, np.reshape(beta, -1))
+        w = F.solve(psi.T)
+        var_star = self.k_diag(x_star, model_parameters) - np.einsum('nm,mn->m', w, psi)
+        dvar_star = -2*np.einsum('mnd,nm->md', dpsi, w)*np.sign(var_star).reshape(-1,1)
+        var_star = abs(var_star)
+
+        mean_lognormal = np.exp(mean_star + 0.5*var_star)
+        var_lognormal = (np.exp(var_star)-1)*np.exp(2*mean_star+var_star)
+        dmean_lognormal = mean_lognormal.reshape(-1,1)*(dmean_star + 0.5*dvar_star)
+        dvar_lognormal = var_lognormal.reshape(-1,1)*(2*dmean_star + dvar_star) + np.exp(2*mean_star+2*var_star).reshape(-1,1)*dvar_star
+        return mean_lognormal, var_lognormal, dmean_lognormal, dvar_lognormal
+
+    def SingleKrig(self, s, r):
+        s = np.reshape(s, -1)
+        x_star = s.reshape([1,len(s)])
+        mean_lognormal, var_lognormal = self.SingleKrig_batch(x_star, r)
+        # keep the shape of the data, e.g. (1, 1) for column vectors
+        shape = (-1,) + np.shape(self.Kdata)[1:]
+        return mean_lognormal.reshape(shape), var_lognormal.reshape(shape)
 
     def utility(self, s):
-        N=100 # Gaussian samplings
-        d=abs(np.random.normal(loc=self.SingleKrig(s, self.model_parameters[1])[0], scale=self.SingleKrig(s, self.model_parameters_H[1])[1], size=N))
-        r=abs(np.random.normal(loc=self.model_parameters[1], scale=0.2*self.model_parameters[1], size=N))
-        
-        s = s.reshape(-1)
-        s = s.reshape([1,len(s)])
-                                 
-        Utility = 0
-        for i in range(N):
-            prior = 0
-            for j in range(N):
-                prior = prior + 1/N*(self.likelihood(d[i],self.SingleKrig(s, r[j])[0]))
-            Utility = Utility + 1/N*(np.log(self.likelihood(d[i],self.SingleKrig(s, r[i])[0]))-np.log(prior))    
-        Utility=-Utility
+        s = np.reshape(s, -1)
+        Utility = self.utility_batch(s.reshape([1,len(s)]))[0]
         print("Utility = ", -Utility)
         return Utility
-    
+
+    def generator(self):
+        """Random source of one Utility evaluation.
+
+        With a seed every evaluation restarts a numpy Generator from it, so
+        all candidates and all calls share common random numbers (and the
+        cached factorizations of the sampled ranges); otherwise the global
+        numpy random state is used.
+        """
+        return np.random if self.seed is None else np.random.default_rng(self.seed)
+
+    def sample_ranges(self, random, N):
+        """Draws N samples of the correlation range r."""
+        return abs(random.normal(loc=self.model_parameters[1], scale=0.2*self.model_parameters[1], size=N))
+
+    def utility_batch(self, S, rng=None, mode=None, ranges=None, z=None):
+        """Utilities (negated) of the (M, d) candidate locations S.
+
+        The N = n_samples range samples and the standard normal draws of
+        the observations are common to all candidates, so each sampled
+        covariance is factored once and kriged at every candidate at once.
+        The samples are drawn from rng (a numpy Generator) if given, else
+        from generator(); ranges and z fix the range samples and the
+        normal draws instead (see common_samples). mode overrides utility_mode, see utility_modes;
+        the 'laplace' mode takes the same draws as the nested Monte Carlo.
+        """
+        mode = self.utility_mode if mode is None else mode
+        if mode not in self.utility_modes:
+            raise Exception("The utility mode must be 'nested_mc' or 'laplace'!")
+        random = self.generator() if rng is None else rng
+        N=self.n_samples # Gaussian samplings
+        S = S.reshape(len(S), -1)
+        M = len(S)
+        mean, var = self.SingleKrig_batch(S, self.model_parameters[1])
+        z=random.normal(size=N) if z is None else z
+        d=abs(mean.reshape(M,1) + var.reshape(M,1)*z)
+        r=self.sample_ranges(random, N) if ranges is None else ranges
+        if mode == 'laplace':
+            return -self.expected_information_local(d, self.range_outputs(S, r)[0])
+
+        # Krige every candidate for each sampled r
+        G = np.zeros((M, N))
+        for j in range(N):
+            G[:, j] = self.SingleKrig_batch(S, r[j])[0]
+
+        return -self.expected_information(d, G)
+
+    def utility_grad(self, S, rng=None, mode=None):
+        """utility_batch of the (M, d) candidates S and its gradient with respect to S.
+
+        The gradient is pathwise: for the drawn samples the Utility is a
+        smooth function of the location through the kriging moments, and
+        it is differentiated exactly. Takes the same draws and mode as
+        utility_batch for the same random source, at about the cost of one
+        evaluation.
+        """
+        mode = self.utility_mode if mode is None else mode
+        if mode not in self.utility_modes:
+            raise Exception("The utility mode must be 'nested_mc' or 'laplace'!")
+        random = self.generator() if rng is None else rng
+        N=self.n_samples # Gaussian samplings
+        S = S.reshape(len(S), -1)
+        M = len(S)
+        mean, var, dmean, dvar = self.SingleKrig_grad(S, self.model_parameters[1])
+        z=random.normal(size=N)
+        e = mean.reshape(M,1) + var.reshape(M,1)*z
+        d = abs(e)
+        dd = np.sign(e)[:, :, None]*(dmean[:, None, :] + dvar[:, None, :]*z.reshape(1,N,1))
+        r=self.sample_ranges(random, N)
+        if mode == 'laplace':
+            G, dG = self.range_outputs(S, r, grad=True)
+            Utility, dUtility = self.expected_information_local(d, G, dd, dG)
+            return -Utility, -dUtility
+
+        # Krige every candidate for each sampled r
+        G = np.zeros((M, N))
+        dG = np.zeros((M, N, S.shape[1]))
+        for j in range(N):
+            G[:, j], _, dG[:, j], _ = self.SingleKrig_grad(S, r[j])
+
+        # d/ds of log p(d_i|G_i) - log(1/N*sum_j p(d_i|G_j)), the sum by its softmax weights
+        diff = d.reshape(M,N,1) - G.reshape(M,1,N)
+        logL = -0.5*diff**2
+        W = np.exp(logL - logsumexp(logL, axis=2, keepdims=True))
+        own = -(d - G)[:, :, None]*(dd - dG)
+        evidence = -np.sum(W*diff, axis=2)[:, :, None]*dd + np.einsum('mij,mjd->mid', W*diff, dG)
+        Utility = np.mean(np.diagonal(logL, axis1=1, axis2=2) - (logsumexp(logL, axis=2) - np.log(N)), axis=1)
+        return -Utility, -np.mean(own - evidence, axis=1)
+
     def gradient(self, s):
-        dx = 0.01
-        dy = 0.01
-        dz = 0.01
-        if len(s)==1:
-            grad = (self.utility(s+dx)-self.utility(s-dx))/(2*dx)
-        if len(s)==2:
-            grad = np.zeros(2)
-            grad[0] = (self.utility(s+np.array([dx,0]))-self.utility(s-np.array([dx,0])))/(2*dx)
-            grad[1] = (self.utility(s+np.array([0,dy]))-self.utility(s-np.array([0,dy])))/(2*dy)
-        if len(s)==3:
-            grad = np.zeros(3)
-            grad[0] = (self.utility(s+np.array([dx,0,0]))-self.utility(s-np.array([dx,0,0])))/(2*dx)
-            grad[1] = (self.utility(s+np.array([0,dy,0]))-self.utility(s-np.array([0,dy,0])))/(2*dy)
-            grad[2] = (self.utility(s+np.array([0,0,dz]))-self.utility(s-np.array([0,0,dz])))/(2*dz)
-        return grad
-
-    # Find maximum Utility by assigning uniform grid with resolution (res) for the sampling location candidates    
-    def execute_max(self, bnd, res):
-        if len(bnd)==1:
-            bndx = bnd
-            linx = np.linspace(bndx[0], bndx[1], int(abs(bndx[0]-bndx[1])/res)+1)
-            s = np.zeros(len(linx))
-            Utility = np.zeros(len(s))
-            for i in range(len(linx)):
-                s[i] = linx[i]
-                Utility[i] = self.utility(s[i])   
-            maxU = np.min(Utility)
-            smax = s[Utility==maxU]
-            max = smax.reshape(-1)
-            print("max Utility = ", -maxU, " s = ", smax)
-        elif len(bnd)==2:
-            bndx = bnd[0, :]
-            bndy = bnd[1, :]
-            linx = np.linspace(bndx[0], bndx[1], int(abs(bndx[0]-bndx[1])/res)+1)
-            liny = np.linspace(bndy[0], bndy[1], int(abs(bndy[0]-bndy[1])/res)+1)
-            s = np.zeros([len(linx)*len(liny), 2])
-            Utility = np.zeros(len(s))
-            for i in range(len(linx)):
-                for j in range(len(liny)):
-                    s[i*len(liny)+j, 0] = linx[i]
-                    s[i*len(liny)+j, 1] = liny[j]
-                    Utility[i*len(liny)+j] = self.utility(s[i*len(liny)+j, :])   
-            maxU = np.min(Utility)
-            smax = s[Utility==maxU, :]
-            max = smax.reshape(-1)
-            print("max Utility = ", -maxU, " s = ", smax)
-        elif len(bnd)==3:
-            bndx = bnd[0, :]
-            bndy = bnd[1, :]
-            bndz = bnd[2, :]
-            linx = np.linspace(bndx[0], bndx[1], int(abs(bndx[0]-bndx[1])/res)+1)
-            liny = np.linspace(bndy[0], bndy[1], int(abs(bndy[0]-bndy[1])/res)+1)
-            linz = np.linspace(bndz[0], bndz[1], int(abs(bndz[0]-bndz[1])/res)+1)
-            s = np.zeros([len(linx)*len(liny)*len(linz), 3])
-            Utility = np.zeros(len(s))
-            for i in range(len(linx)):
-                for j in range(len(liny)):
-                    for k in range(len(linz)):
-                        s[i*len(liny)*len(linz)+j*len(linz)+k, 0] = linx[i]
-                        s[i*len(liny)*len(linz)+j*len(linz)+k, 1] = liny[j]
-                        s[i*len(liny)*len(linz)+j*len(linz)+k, 2] = linz[k]
-                        Utility[i*len(liny)*len(linz)+j*len(linz)+k] = self.utility(s[i*len(liny)*len(linz)+j*len(linz)+k, :])   
-            maxU = np.min(Utility)
-            smax = s[Utility==maxU, :]
-            max = smax.reshape(-1)
-            print("max Utility = ", -maxU, " s = ", smax)
+        """Analytic gradient of the Utility with respect to the location s."""
+        s = np.reshape(s, -1)
+        return self.utility_grad(s.reshape([1,len(s)]))[1][0]
+
+    def utility_parallel(self, S, n_jobs=-1, backend='process', seed=None, ranges=None, z=None):
+        """utility_batch of the (M, d) candidates S split over n_jobs workers.
+
+        With the draws ranges and z of common_samples every worker scores
+        its chunk of candidates on the same samples, whose factorizations
+        it inherits when forked. Otherwise each worker gets its own random
+        stream spawned from seed (drawn from the global numpy random state
+        if not given), so results are reproducible for a given seed and
+        n_jobs; a model built with a seed uses its common random numbers
+        instead.
+        """
+        n_jobs = tiling.n_workers(n_jobs)
+        S = S.reshape(len(S), -1)
+        if seed is None:
+            seed = np.random.randint(2**32)
+        chunks = list(tiling.tile_slices(len(S), max(-(-len(S)//n_jobs), 1)))
+        seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+        # factor the nominal model once before the workers are forked
+        self.factor_sample(self.model_parameters[1])
+        rng = lambda i: None if self.seed is not None else np.random.default_rng(seeds[i])
+        task = lambda i: self.utility_batch(S[chunks[i]], rng(i), ranges=ranges, z=z)
+        return np.concatenate(list(tiling.map_tiles(task, range(len(chunks)), n_jobs, backend)))
+
+    def expected_information(self, d, G):
+        """Nested Monte Carlo estimate of the expected information gain per candidate.
+
+        d and G are (M, N) arrays of sampled observations and model outputs.
+        """
+        M, N = d.shape
+        Utility = np.zeros(M)
+        for tile in tiling.tile_slices(M, tiling.tile_size(N*N)):
+            # Log-likelihood of every d_i under every G_j, log p(d_i|G_j) = -0.5*(d_i-G_j)^2
+            logL = -0.5*(d[tile].reshape(-1,N,1) - G[tile].reshape(-1,1,N))**2
+            # Evidence p(d_i) = 1/N*sum_j p(d_i|G_j) by log-sum-exp
+            logprior = logsumexp(logL, axis=2) - np.log(N)
+            Utility[tile] = np.mean(np.diagonal(logL, axis1=1, axis2=2) - logprior, axis=1)
+        return Utility
+    
+    def range_outputs(self, S, r, grad=False):
+        """Kriged means at the (M, d) candidates S for the sampled ranges r, interpolated in the range.
+
+        The means are kriged at n_nodes Chebyshev nodes spanning the samples
+        and interpolated by a polynomial, so the N samples cost n_nodes
+        kriging evaluations instead of N. With grad set, the derivatives
+        (M, N, d) with respect to S are returned as well, else None.
+        """
+        r = np.asarray(r, dtype=float).reshape(-1)
+        n = self.n_nodes
+        lo = np.min(r)
+        span = max(np.max(r) - lo, self.eps)
+        t = np.cos(np.pi*(np.arange(n) + 0.5)/n)
+        # weights of the node values in the interpolated value of each sample
+        W = chebvander(2*(r - lo)/span - 1, n-1)@la.inv(chebvander(t, n-1))
+
+        G = np.zeros((len(S), n))
+        dG = np.zeros((len(S), n, S.shape[1])) if grad else None
+        for k, r_k in enumerate(lo + span*(t + 1)/2):
+            if grad:
+                G[:, k], _, dG[:, k], _ = self.SingleKrig_grad(S, r_k)
+            else:
+                G[:, k] = self.SingleKrig_batch(S, r_k)[0]
+        return G@W.T, None if dG is None else np.einsum('mkd,jk->mjd', dG, W)
+
+    def expected_information_local(self, d, G, dd=None, dG=None):
+        """Second-order expansion of expected_information in the spread of G.
+
+        With a = d - mean(G) and delta = G - mean(G) per candidate, the
+        nested Monte Carlo estimate is mean(a*delta) - var(G)/2*mean(a^2)
+        up to third-order terms in delta. It takes the same draws, so it
+        ranks the candidates as the nested estimate does, without the
+        N x N evidence. With the derivatives dd and dG, (M, N, d), of d and
+        G with respect to the locations, its gradient is returned as well.
+        """
+        a = d - np.mean(G, axis=1, keepdims=True)
+        delta = G - np.mean(G, axis=1, keepdims=True)
+        v = np.mean(delta**2, axis=1)
+        A = np.mean(a**2, axis=1)
+        Utility = np.mean(a*delta, axis=1) - 0.5*v*A
+        if dd is None:
+            return Utility
+        da = dd - np.mean(dG, axis=1, keepdims=True)
+        ddelta = dG - np.mean(dG, axis=1, keepdims=True)
+        dv = 2*np.einsum('mj,mjd->md', delta, ddelta)/d.shape[1]
+        dA = 2*np.einsum('mj,mjd->md', a, da)/d.shape[1]
+        dUtility = (np.einsum('mjd,mj->md', da, delta) + np.einsum('mj,mjd->md', a, ddelta))/d.shape[1]
+        return Utility, dUtility - 0.5*dv*A.reshape(-1, 1) - 0.5*v.reshape(-1, 1)*dA
+
+    def candidates(self, bnd, res):
+        """Uniform grid of sampling location candidates with resolution res."""
+        if len(bnd)==1 or np.ndim(bnd)==1:
+            bndx = np.reshape(bnd, -1)
+            s = np.linspace(bndx[0], bndx[1], int(abs(bndx[0]-bndx[1])/res)+1)
+        elif len(bnd)==2 or len(bnd)==3:
+            lins = [np.linspace(b[0], b[1], int(abs(b[0]-b[1])/res)+1) for b in bnd]
+            s = np.stack(np.meshgrid(*lins, indexing='ij'), axis=-1).reshape(-1, len(bnd))
         else:
-            raise Exception("The input sampling location is not in 1D, 2D, or 3D coordinate!")            
+            raise Exception("The input sampling location is not in 1D, 2D, or 3D coordinate!")
+        return s
+
+    def common_samples(self, random):
+        """Draws the normal draws z and range samples r of utility_batch from random.
+
+        The covariances of the sampled ranges are factored here, so that
+        workers forked afterwards inherit the factorizations instead of
+        each rebuilding them. Returns (z, r).
+        """
+        z = random.normal(size=self.n_samples)
+        r = self.sample_ranges(random, self.n_samples)
+        self.factor_sample(self.model_parameters[1])
+        for r_j in r:
+            self.factor_sample(r_j)
+        return z, r
+
+    # Find maximum Utility by assigning uniform grid with resolution (res) for the sampling location candidates
+    # n_jobs > 1 (or -1 for all cores) splits the candidates over worker processes, see utility_parallel;
+    # the draws come from seed unless the model has its own, and are common to all workers
+    def execute_max(self, bnd, res, n_jobs=1, seed=None):
+        s = self.candidates(bnd, res)
+        random = self.generator() if seed is None or self.seed is not None else np.random.default_rng(seed)
+        if tiling.n_workers(n_jobs) > 1:
+            z, ranges = self.common_samples(random)
+            Utility = self.utility_parallel(s, n_jobs, ranges=ranges, z=z)
+        else:
+            Utility = self.utility_batch(s, random)
+        maxU = np.min(Utility)
+        smax = s[Utility==maxU]
+        smax = smax.reshape(-1)
+        print("max Utility = ", -maxU, " s = ", smax)
+        return smax
+
+    # Screen the candidate grid with the 'laplace' Utility and re-rank the top_k candidates by nested Monte Carlo
+    # the Laplace mode expands the nested Monte Carlo estimate with the same draws, so it keeps its ranking
+    def execute_screening(self, bnd, res, top_k=20, mode='laplace'):
+        s = self.candidates(bnd, res)
+        Utility = self.utility_batch(s, mode=mode)
+        top = np.argsort(Utility)[:top_k]
+        Utility = self.utility_batch(s[top], mode='nested_mc')
+        i = np.argmin(Utility)
+        smax = s[top][i].reshape(-1)
+        print("max Utility = ", -Utility[i], " s = ", smax, " of ", len(top), " screened candidates")
+        return smax
+
+    # Find maximum Utility by expected improvement on a kriging surrogate of the Utility, see surrogate.minimize
+    # the candidates are drawn from rng, by default a Generator spawned from seed so that the search is reproducible
+    def execute_surrogate(self, bnd, budget=30, n_init=None, n_candidates=2000, rng=None):
+        if rng is None:
+            seed = self.seed if self.seed is not None else np.random.randint(2**32)
+            rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+        smax, maxU, s, Utility = surrogate.minimize(self.utility_batch, bnd, budget, n_init, n_candidates, rng)
+        print("max Utility = ", -maxU, " s = ", smax, " in ", len(Utility), " Utility evaluations")
         return smax
 
     # Find maximum Utility by performing numerical optimization for the sampling location candidates
-    def execute_optimization(self, inis):
+    # method is 'L-BFGS-B' with the analytic gradient (utility_grad), or a derivative-free method such as 'Powell'
+    def execute_optimization(self, inis, method='L-BFGS-B'):
         if len(inis)==1:
-            bnds = ((-30, 5))
+            bnds = ((-30, 5),)
         if len(inis)==2:
             bnds = ((-30, 5), (-10, 25))
         if len(inis)==3:
             bnds = ((-30, 5), (-10, 25), (0, 200))
-        Result = op.minimize(fun = self.utility, x0 = inis, method = 'Powell', bounds = bnds)
-        #Result = op.minimize(fun = self.utility, x0 = inis, method = 'SLSQP', jac = self.gradient)#, bounds = bnds)
-        print('Powell Optimization details:')
+        if method == 'L-BFGS-B':
+            # one set of common random numbers for the whole optimization
+            seed = self.seed if self.seed is not None else np.random.randint(2**32)
+            fun = lambda s: [a[0] for a in self.utility_grad(np.reshape(s, (1,-1)), np.random.default_rng(seed))]
+            Result = op.minimize(fun = fun, x0 = inis, method = 'L-BFGS-B', jac = True, bounds = bnds)
+        else:
+            Result = op.minimize(fun = self.utility, x0 = inis, method = method, bounds = bnds)
+        print(method + ' Optimization details:')
         print(Result)
         s = Result.x
         return s
\ No newline at end of file
@@ -8,12 +8,33 @@ cytseng2@illinois.edu
 Contains class SingleKriging
 Contains PyKrige.variogram_models
 
+With likelihood_mode='vecchia' the hyperparameters are fitted on the
+Vecchia approximation of the likelihood [3] (see vecchia.py) and the
+fitted model predicts from the nearest sites of each point, so neither
+step factors the full kriging matrix.
+
+With kernel='spherical' or 'wendland' the kriging matrix is a compactly
+supported covariance (see covariance_models.py), assembled and factored
+as a sparse matrix.
+
+With kernel='separable_exponential' or 'separable_gaussian' the kriging
+matrix is a product of one factor per coordinate axis (see
+covariance_models.py). Sites on a lattice are then factored through the
+eigendecompositions of the per-axis factors [4], and predictions on a
+lattice (predict_grid) assemble their covariances with the sites from
+per-axis factors (see kronecker.py).
+
 References
 ----------
 .. [1] Raissi, M., & Karniadakis, G. (2016). Deep multi-fidelity 
 Gaussian processes. arXiv preprint arXiv:1604.07484.
 .. [2] P.K. Kitanidis, Introduction to Geostatistcs: Applications in
 Hydrogeology, (Cambridge University Press, 1997) 272 p.
+.. [3] Vecchia, A. V. (1988). Estimation and model identification for
+continuous spatial processes. Journal of the Royal Statistical Society:
+Series B, 50(2), 297-312.
+.. [4] Saatci, Y. (2012). Scalable inference for structured Gaussian
+process models, (PhD thesis, University of Cambridge) Chapter 5.
 
 """
 
@@ -24,192 +45,497 @@ import numpy.linalg as la
 from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
 import scipy.optimize as op
+import scipy.sparse as sp
+from multifidgp.factorization import Factorization, SparseMatrixFactorization, KroneckerFactorization
+from multifidgp.factorization import KrigingState, FactorCache
+from multifidgp.neighborhood import Neighborhood
+from multifidgp import tiling
+from multifidgp import vecchia
+from multifidgp import covariance_models
+from multifidgp import kronecker
 from multifidgp.variogram_models import gaussian_variogram_model
 from multifidgp.variogram_models import exponential_variogram_model
 
-P = 0
-L = 0
-U = 0
 
 class SingleKriging:
 
     eps = 1.e-10   # Cutoff for comparison to zero
+    # exact likelihood, or its Vecchia approximation on the n_neighbors
+    # nearest preceding sites in maxmin order
+    likelihood_modes = ('exact', 'vecchia')
+    # variogram as kriging matrix, or compactly supported spherical or
+    # Wendland-tapered exponential covariance as sparse matrix, or
+    # separable exponential or Gaussian covariance (Kronecker on lattices)
+    kernels = ('variogram', 'spherical', 'wendland', 'separable_exponential', 'separable_gaussian')
     # model_parameters = [s r n]
     
-    def __init__(self, XData, KData, model_parameters):
+    def __init__(self, XData, KData, model_parameters, likelihood_mode='exact', n_neighbors=30,
+                 kernel='variogram', taper=None):
         self.Xdata=XData
         self.Kdata=KData
         self.model_parameters=model_parameters
+        if likelihood_mode not in self.likelihood_modes:
+            raise Exception("The likelihood mode must be 'exact' or 'vecchia'!")
+        self.likelihood_mode=likelihood_mode
+        self.n_neighbors=n_neighbors   # Conditioning sites of the Vecchia likelihood
+        self.ordering=None
+        if kernel not in self.kernels:
+            raise Exception("The kernel must be 'variogram', 'spherical', 'wendland', "
+                            "'separable_exponential' or 'separable_gaussian'!")
+        self.kernel=kernel
+        self.taper=taper   # Support of the Wendland taper, None for the range
+        self.blocks=None
+        self.cache=None
+        self.state=None
+        self.neighborhood=None
+        self.local_factors=FactorCache()
 
     def k(self, X1, X2, model_parameters):
         """Assembles the kriging matrix."""
         if X1.size==len(X1):
             X1=X1.reshape(len(X1),1)
             X2=X2.reshape(len(X2),1)
-        d = cdist(X1, X2, 'euclidean')
+        d = cdist(X1, X2, covariance_models.metric(self.kernel))
         n1 = len(X1)
         n2 = len(X2)
         K = np.zeros((n1, n2))
+        K[:n1, :n2] = self.k_values(model_parameters, d)
+        return K
+
+    def k_values(self, model_parameters, d):
+        """Kriging matrix entries at the distances d."""
+        if self.kernel != 'variogram':
+            return covariance_models.covariance(self.kernel, model_parameters, d, self.taper)
         # Assign Exponential variogram model
-        K[:n1, :n2] = exponential_variogram_model(model_parameters, d)
+        return exponential_variogram_model(model_parameters, d)
         # Assign Gaussian variogram model
-        #K[:n1, :n2] = gaussian_variogram_model(model_parameters, d)
-        return K
+        #return gaussian_variogram_model(model_parameters, d)
+
+    def k_sparse(self, X1, X2, model_parameters):
+        """Assembles the kriging matrix of a compactly supported kernel as a sparse matrix."""
+        return covariance_models.sparse_covariance(self.kernel, model_parameters, X1, X2, self.taper)
+
+    def k_diag(self, X, model_parameters):
+        """Diagonal of the kriging matrix k(X, X)."""
+        d = np.zeros(len(X))
+        return self.k_values(model_parameters, d)
+
+    def kronecker_blocks(self):
+        """Per-axis factors of the kriging matrix if the sites form a lattice, None otherwise.
+
+        Returns a dict with the lattice axes, the permutation of the sites
+        into C order of the lattice and the eigendecompositions of the
+        per-axis factors, which do not depend on sigma_eps.
+        """
+        if self.kernel not in covariance_models.separable_kernels:
+            return None
+        lattice = kronecker.grid_axes(self.Xdata)
+        if lattice is None:
+            return None
+        axes, perm = lattice
+        eig = [la.eigh(covariance_models.axis_covariance(self.kernel, self.model_parameters, g, g))
+               for g in axes]
+        return {'axes': axes, 'perm': perm, 'eig': eig}
+
+    def factorize(self, hyp):
+        """Factors the kriging matrix once per distinct hyp.
+
+        K, its factorization, alpha = K^-1 y and log|K| are cached on the
+        model so that likelihood and Gradient evaluated at the same hyp
+        share a single factorization.
+        """
+        key = tuple(np.asarray(hyp, dtype=float).reshape(-1))
+        cached = self.cache
+        if cached is not None and cached[0] == key:
+            return cached[1]
 
-    def likelihood(self, hyp):
         X = self.Xdata
         y = self.Kdata
         
         sigma_eps = hyp
         
         N = len(X)
-        D = np.size(X)/len(X)
+        if self.blocks is None:
+            self.blocks = self.kronecker_blocks()
+        if self.kernel in covariance_models.compact_kernels:
+            if self.blocks is None:
+                self.blocks = self.k_sparse(X, X, self.model_parameters)
+            K = self.blocks + sp.identity(N)*(hyp[0] + self.eps)
+
+            # Sparse LU Decomposition
+            F = SparseMatrixFactorization(K)
+        elif isinstance(self.blocks, dict):
+            psill = float(self.model_parameters[0])
+            nugget = float(self.model_parameters[2])
+            K = None
+
+            # Kronecker eigendecomposition
+            F = KroneckerFactorization(self.blocks['eig'], psill, nugget + hyp[0] + self.eps, self.blocks['perm'])
+        else:
+            if self.blocks is None:
+                self.blocks = self.k(X, X, self.model_parameters)
+            K = self.blocks + np.eye(N)*sigma_eps
+            K = K + np.eye(N)*self.eps
+
+            # Cholesky Decomposition (LU if K is not positive definite)
+            F = Factorization(K)
+        alpha = F.solve(y)
+
+        C = {'y': y, 'N': N, 'K': K, 'factor': F,
+             'alpha': alpha, 'logdet': F.logdet()}
+        # key and factorization are swapped in together for concurrent callers
+        self.cache = (key, C)
+        return C
+
+    def likelihood(self, hyp):
+        X = self.Xdata
         print(X)
-        print(N)
-        K = self.k(X, X, self.model_parameters) 
-        K = K + np.eye(N)*sigma_eps
-        K = K + np.eye(N)*self.eps
-        
-        # LU Decomposition
-        global P, L, U
-        P, L, U = sla.lu(K)
-
-        alpha = la.inv(U)@(la.inv(L)@(P.T@y))
-        for m in range(40):
-            if (np.prod(np.diag(U*np.exp(1)**m))!=0):
-                break
-        NLML = 0.5*y.T@alpha + 0.5*(np.log(abs(np.prod(np.diag(U*np.exp(1)**m))))-m*N) + np.log(2*np.pi)*N/2
+        print(len(X))
+        C = self.factorize(hyp)
+        y = C['y']
+        N = C['N']
+        alpha = C['alpha']
+
+        NLML = 0.5*y.T@alpha + 0.5*C['logdet'] + np.log(2*np.pi)*N/2
         print(NLML, hyp)
         return NLML
     
     def Gradient(self, hyp):
-        X = self.Xdata
-        y = self.Kdata
+        C = self.factorize(hyp)
+        alpha = C['alpha']
         
         sigma_eps = hyp
-        
-        N = len(X)
-        D = np.size(X)/len(X)
-
-        K = self.k(X, X, self.model_parameters) 
-        K = K + np.eye(N)*sigma_eps
-        K = K + np.eye(N)*self.eps
-        
-        # LU Decomposition
-        global P, L, U
-        P, L, U = sla.lu(K)
-        
-        alpha = la.inv(U)@(la.inv(L)@(P.T@y))
+        factor = C['factor']
 
-        # Derivatives
-        D_NLML = 0*hyp
-        Q = la.inv(U)@(la.inv(L)@(P.T@np.eye(N))) - alpha@alpha.T # dL/dK
-        D_NLML = sigma_eps*np.trace(Q)/2  # dL/dK*dK/dtheta
+        # Derivatives, trace(Q) with Q = K^-1 - alpha*alpha^T (dL/dK)
+        trace_Q = np.sum(factor.inv_diag()) - np.sum(alpha**2)
+        D_NLML = sigma_eps*trace_Q/2  # dL/dK*dK/dtheta
         return D_NLML
+
+    def value_and_grad(self, hyp, n_jobs=1):
+        """Returns the NLML and its gradient from one factorization of K."""
+        if self.likelihood_mode == 'vecchia':
+            return self.likelihood_vecchia(hyp, n_jobs)
+        return self.likelihood(hyp), self.Gradient(hyp)
+
+    def vecchia_neighbors(self):
+        """Returns the maxmin order of the sites and their nearest preceding sites, computed once per n_neighbors."""
+        if self.ordering is None or self.ordering[1].shape[1] != self.n_neighbors:
+            X = self.Xdata.reshape(len(self.Xdata), -1)
+            order = vecchia.maxmin_order(X)
+            self.ordering = (order, vecchia.ordered_neighbors(X[order], self.n_neighbors))
+        return self.ordering
+
+    def likelihood_vecchia(self, hyp, n_jobs=1, backend='thread'):
+        """Returns the Vecchia NLML and its gradient, scaled as in Gradient.
+
+        Each site is conditioned on its n_neighbors nearest preceding
+        sites; the sites are solved in batches over n_jobs workers.
+        """
+        order, NN = self.vecchia_neighbors()
+        X = self.Xdata.reshape(len(self.Xdata), -1)[order]
+        y = np.reshape(self.Kdata, -1)[order]
+        sigma_eps = hyp[0]
+
+        def local_cov(c):
+            d = vecchia.local_distances(X, c, covariance_models.metric(self.kernel))
+            K = self.k_values(self.model_parameters, d)
+            I = np.eye(c.shape[1])
+            K = K + I*(sigma_eps + self.eps)
+            return K, np.broadcast_to(I, (1,) + K.shape)
+
+        NLML, D_NLML = vecchia.likelihood(local_cov, y, NN, len(hyp), n_jobs, backend)
+        D_NLML = sigma_eps*D_NLML  # dL/dK*dK/dtheta
+        print(NLML, hyp)
+        return NLML, D_NLML
     
-    def execute1D(self, xx):
+    def kriging_state(self, hyp):
+        """Returns the prediction state (hyp, mu, factor, beta) for hyp."""
+        C = self.factorize(hyp)
+        y = C['y']
+        mu = np.mean(y)
+        return KrigingState(hyp=np.array(hyp, dtype=float).reshape(-1), rho=None, mu=mu,
+                            factor=C['factor'], beta=C['factor'].solve(y-mu))
+
+    def fit(self, bnds=((-5, 2),), hess=None, n_jobs=1):
+        """Fits sigma_eps by TNC and factors K once.
+
+        The fitted KrigingState is kept on the model for predict(), and is
+        also returned. The state is immutable, so models can be fitted and
+        used for prediction concurrently. With likelihood_mode='vecchia'
+        the likelihood is evaluated over n_jobs workers and K is not
+        factored; the state then has no factor and predict() kriges each
+        point from its n_neighbors nearest sites.
+        """
         # initialhyp = [sigma_eps]
         inihyp = np.array([0])
-        bnds = ((-5, 2),)
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient, bounds = bnds)
+        Result = op.minimize(fun = self.value_and_grad, x0 = inihyp, args = (n_jobs,), method = 'TNC', jac = True, hess = hess, bounds = bnds)
         print('TNC Optimization details:')
         print(Result)
-        hyp = Result.x
-        X = self.Xdata
-        y = self.Kdata
-        D = np.size(X)/len(X)
-        mu = np.mean(y)
+        if self.likelihood_mode == 'vecchia':
+            self.state = KrigingState(hyp=np.array(Result.x, dtype=float).reshape(-1), rho=None,
+                                      mu=np.mean(self.Kdata), factor=None, beta=None)
+            return self.state
+        self.state = self.kriging_state(Result.x)
+        return self.state
+
+    def border(self, X_new, hyp):
+        """Returns the covariances (B, C) of new points with the data and with themselves."""
+        B = self.k(self.Xdata, X_new, self.model_parameters)
+        C = self.k(X_new, X_new, self.model_parameters) + np.eye(len(X_new))*(hyp[0] + self.eps)
+        return B, C
+
+    def add_observations(self, X_new, y_new):
+        """Adds observations and updates the fitted state.
+
+        The hyperparameters of the fitted state are kept and the factor of
+        K is bordered with the new rows in O(N^2) instead of being
+        refactored; mu and beta are then re-estimated. A sparse state is
+        refactored and a state without a factor (from a Vecchia fit) only
+        updates mu. Call fit() to re-estimate the hyperparameters.
+        """
+        X_new = np.asarray(X_new, dtype=float).reshape((-1,) + np.shape(self.Xdata)[1:])
+        y_new = np.asarray(y_new, dtype=float).reshape((-1,) + np.shape(self.Kdata)[1:])
+
+        state = self.state
+        bordered = state is not None and isinstance(state.factor, Factorization)
+        if bordered:
+            B, C = self.border(X_new, state.hyp)
+            factor = state.factor.extend(B, C)
+
+        self.Xdata = np.concatenate([self.Xdata, X_new])
+        self.Kdata = np.concatenate([self.Kdata, y_new])
+        self.blocks = None
+        self.cache = None
+        self.neighborhood = None
+        self.local_factors.clear()
+        self.ordering = None
+
+        if bordered:
+            y = self.Kdata
+            mu = np.mean(y)
+            self.state = state._replace(mu=mu, factor=factor, beta=factor.solve(y-mu))
+        elif state is not None and state.factor is None:
+            self.state = state._replace(mu=np.mean(self.Kdata))
+        elif state is not None:
+            self.state = self.kriging_state(state.hyp)
+        return self.state
+
+    def predict_tile(self, x_star, state, full_cov=False):
+        """Predicts the kriging mean and variance on one tile.
+
+        Only the diagonal of the predictive covariance is computed unless
+        full_cov is set, in which case the tile x tile covariance is
+        returned instead of the variance.
+        """
+        psi = self.k(x_star, self.Xdata, self.model_parameters)
+
+        # calculate prediction
+        mean_star = state.mu + psi@state.beta
+        if full_cov:
+            cov_star = self.k(x_star, x_star, self.model_parameters) - state.factor.quad(psi.T)
+            return mean_star, cov_star
+        var_star = self.k_diag(x_star, self.model_parameters) - state.factor.quad_diag(psi.T)
+        var_star = abs(var_star)
+        return mean_star, var_star
+
+    def local_factor(self, i, state):
+        """Factorization and beta of the kriging system on the sites i, cached."""
+        key = (tuple(state.hyp), float(state.mu), tuple(i))
+        local = self.local_factors.get(key)
+        if local is not None:
+            return local
+        X = self.Xdata[i]
+
+        # K matrix of the neighborhood
+        K = self.k(X, X, self.model_parameters) + np.eye(len(i))*(state.hyp[0] + self.eps)
+
+        F = Factorization(K)
+        local = (F, F.solve(self.Kdata[i]-state.mu))
+        self.local_factors.put(key, local, F.nbytes() + local[1].nbytes)
+        return local
+
+    def predict_tile_local(self, x_star, state, neighborhood):
+        """Predicts the kriging mean and variance on one tile from the nearest sites of each point."""
+        mean_star = np.empty(len(x_star))
+        var_star = np.empty(len(x_star))
+        for rows, (i,) in neighborhood.groups(x_star):
+            F, beta = self.local_factor(i, state)
+            x = x_star[rows]
+            psi = self.k(x, self.Xdata[i], self.model_parameters)
+
+            # calculate prediction
+            mean_star[rows] = state.mu + (psi@beta).reshape(-1)
+            var_star[rows] = self.k_diag(x, self.model_parameters) - F.quad_diag(psi.T)
+        var_star = abs(var_star)
+        return mean_star, var_star
+
+    def predict(self, x_star_all, state=None, out=None, tiles=False, full_cov=False,
+                budget=tiling.MEMORY_BUDGET, n_jobs=1, backend='thread', neighbors=None):
+        """Predicts the kriging mean and variance at x_star_all.
+
+        state holds mu, the factorization of K and beta = K^-1 (y-mu);
+        it defaults to the state from fit().
+        The points are predicted in tiles sized by budget (bytes) and
+        written into out = (mean, var) if given. With tiles=True a
+        generator of (slice, mean, var) per finished tile is returned.
+        With full_cov=True all points are predicted at once and the full
+        predictive covariance is returned in place of the variance.
+        n_jobs > 1 (or -1 for all cores) spreads the tiles over a pool of
+        threads, or of forked processes sharing the factorization when
+        backend='process'.
+        With neighbors = k each point is kriged from its k nearest
+        training sites only (moving window), using hyp and mu of state;
+        the cost then scales with k instead of the number of sites.
+        A state without a factor uses neighbors = n_neighbors by default.
+        """
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() first!")
+        if state.factor is None and neighbors is None:
+            neighbors = self.n_neighbors
+        x_star_all = x_star_all.reshape(len(x_star_all), -1)
+        if full_cov and neighbors is None:
+            mean_star, cov_star = self.predict_tile(x_star_all, state, full_cov=True)
+            return mean_star.reshape(-1), cov_star
+        N = len(self.Xdata)
+        predict_tile = lambda x_star: self.predict_tile(x_star, state)
+        if neighbors is not None:
+            if full_cov:
+                raise Exception("Neighborhood kriging only predicts the variance!")
+            if self.neighborhood is None or self.neighborhood[0] != neighbors:
+                self.neighborhood = (neighbors, Neighborhood([self.Xdata], neighbors))
+            neighborhood = self.neighborhood[1]
+            N = neighborhood.size()
+            predict_tile = lambda x_star: self.predict_tile_local(x_star, state, neighborhood)
+        if tiles:
+            return tiling.iter_predict(predict_tile, x_star_all, N, budget, n_jobs, backend)
+        return tiling.predict(predict_tile, x_star_all, N, out, budget, n_jobs, backend)
+
+    def predict_grid(self, axes, state=None, out=None, budget=tiling.MEMORY_BUDGET, n_jobs=1, backend='thread'):
+        """Predicts the kriging mean and variance on the lattice of the coordinate values axes.
+
+        mean and var are returned (or written into out) in C order of the
+        lattice. With a separable kernel the covariances of the lattice
+        with the sites are products of per-axis factors: for sites on a
+        lattice the mean and variance are applied axis by axis through the
+        Kronecker factorization, otherwise the tiles of covariances are
+        assembled from the per-axis factors instead of distances. The
+        nugget is not added at lattice points that coincide with sites.
+        Other kernels and states without a factor predict at the lattice
+        points with predict().
+        """
+        if state is None:
+            state = self.state
+            if state is None:
+                raise Exception("The model has not been fitted, call fit() first!")
+        axes = [np.asarray(g, dtype=float).reshape(-1) for g in axes]
+        M = int(np.prod([len(g) for g in axes]))
+        if self.kernel not in covariance_models.separable_kernels or state.factor is None:
+            x_star_all = np.stack([x.reshape(-1) for x in np.meshgrid(*axes, indexing='ij')], axis=1)
+            return self.predict(x_star_all, state, out=out, budget=budget, n_jobs=n_jobs, backend=backend)
+
+        if out is None:
+            out = (np.empty(M), np.empty(M))
+        mean_star_all, var_star_all = out
+        psill = float(self.model_parameters[0])
+        C0 = self.k_diag(np.zeros(1), self.model_parameters)
+        X = np.reshape(self.Xdata, (len(self.Xdata), -1))
+
+        if isinstance(state.factor, KroneckerFactorization):
+            # Per-axis covariances of the lattice with the lattice of the sites
+            P = [covariance_models.axis_covariance(self.kernel, self.model_parameters, g, g_X)
+                 for g, g_X in zip(axes, self.blocks['axes'])]
+            beta = np.reshape(state.beta, -1)[state.factor.perm]
+            np.reshape(mean_star_all, -1)[:] = state.mu + psill*kronecker.kron_mv(P, beta)
+            var_star = C0 - psill**2*state.factor.quad_diag_kron(P)
+            np.reshape(var_star_all, -1)[:] = abs(var_star)
+            return mean_star_all, var_star_all
+
+        # Per-axis covariances of the lattice values with the sites
+        E = [covariance_models.axis_covariance(self.kernel, self.model_parameters, g, X[:, a])
+             for a, g in enumerate(axes)]
+
+        def predict_tile(idx):
+            psi = psill*kronecker.grid_rows(E, idx)
+            mean_star = state.mu + psi@state.beta
+            var_star = C0 - state.factor.quad_diag(psi.T)
+            return mean_star, abs(var_star)
+
+        return tiling.predict(predict_tile, np.arange(M), len(X), out, budget, n_jobs, backend)
+
+    def predict_meshgrid(self, coords, state=None, out=None, n_jobs=1):
+        """Predicts on the np.meshgrid arrays coords through predict_grid.
+
+        Returns None unless the kernel is separable, state has a factor and
+        coords form a lattice.
+        """
+        if state is None:
+            state = self.state
+        if self.kernel not in covariance_models.separable_kernels or state.factor is None:
+            return None
+        lattice = kronecker.meshgrid_axes(*coords)
+        if lattice is None:
+            return None
+        axes, dims = lattice
+        mean_star, var_star = self.predict_grid(axes, state, n_jobs=n_jobs)
+        mean_star_all = kronecker.to_meshgrid(mean_star, axes, dims)
+        var_star_all = kronecker.to_meshgrid(var_star, axes, dims)
+        if out is not None:
+            out[0][...] = mean_star_all
+            out[1][...] = var_star_all
+            return out
+        return mean_star_all, var_star_all
+
+    def execute1D(self, xx, out=None, n_jobs=1):
+        self.fit(bnds = ((-5, 2),))
         
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
         x_star_all = xx
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi = self.k(x_star, X, self.model_parameters)
-        
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            var_star = self.k(x_star, x_star, self.model_parameters) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0])
         var_star_all = var_star_all.reshape(dim[0])
 
         return mean_star_all, var_star_all
 
-    def execute2D(self, xx, yy):
-        # initialhyp = [sigma_eps]
-        inihyp = np.array([0])
-        bnds = ((-5, 2),)
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient)
-        print('TNC Optimization details:')
-        print(Result)
-        hyp = Result.x
-        X = self.Xdata
-        y = self.Kdata
-        D = np.size(X)/len(X)
-        mu = np.mean(y)
+    def execute2D(self, xx, yy, out=None, n_jobs=1):
+        state = self.fit(bnds = None)
+        # Simple kriging without the constant mean
+        if state.factor is None:
+            # Vecchia fit, kriged from the neighborhood of each point
+            state = state._replace(mu = 0)
+        else:
+            state = state._replace(mu = 0, beta = state.factor.solve(self.Kdata))
         
+        grid = self.predict_meshgrid((xx, yy), state, out=out, n_jobs=n_jobs)
+        if grid is not None:
+            return grid
+
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
         yy = yy.reshape(np.size(yy),-1)
         x_star_all = np.concatenate([xx, yy],axis=1)
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi = self.k(x_star, X, self.model_parameters)
-        
-            # calculate prediction
-            #mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            mean_star = psi@(la.inv(U)@(la.inv(L)@(P.T@y)))
-            var_star = self.k(x_star, x_star, self.model_parameters) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, state, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0], dim[1])
         var_star_all = var_star_all.reshape(dim[0], dim[1])
         
         return mean_star_all, var_star_all
     
-    def execute3D(self, xx, yy, zz):
-        # initialhyp = [sigma_eps]
-        inihyp = np.array([0])
-        bnds = ((-5, 2),)
-        Result = op.minimize(fun = self.likelihood, x0 = inihyp, method = 'TNC', jac = self.Gradient, hess = self.Hessian, bounds = bnds)
-        print('TNC Optimization details:')
-        print(Result)
-        hyp = Result.x
-        X = self.Xdata
-        y = self.Kdata
-        D = np.size(X)/len(X)
-        mu = np.mean(y)
+    def execute3D(self, xx, yy, zz, out=None, n_jobs=1):
+        self.fit(bnds = ((-5, 2),), hess = self.Hessian)
         
+        grid = self.predict_meshgrid((xx, yy, zz), out=out, n_jobs=n_jobs)
+        if grid is not None:
+            return grid
+
         dim = xx.shape
         
         xx = xx.reshape(np.size(xx),-1)
@@ -217,26 +543,7 @@ class SingleKriging:
         zz = zz.reshape(np.size(zz),-1)
         x_star_all = np.concatenate([xx, yy, zz],axis=1)
         
-        # divided matrix calculation
-        for i in range(100):
-            if (i==99):
-                x_star = x_star_all[int(len(x_star_all)/100)*i:,:]
-            else:
-                x_star = x_star_all[int(len(x_star_all)/100)*i:int(len(x_star_all)/100)*(i+1),:]
-            psi = self.k(x_star, X, self.model_parameters)
-        
-            # calculate prediction
-            mean_star = mu + psi@(la.inv(U)@(la.inv(L)@(P.T@(y-mu))))
-            var_star = self.k(x_star, x_star, self.model_parameters) - psi@(la.inv(U)@(la.inv(L)@(P.T@psi.T))) 
-            var_star = abs(np.diag(var_star))
-            
-            # Combine mean_star and var_star
-            if (i==0):
-                mean_star_all = mean_star
-                var_star_all = var_star
-            else:
-                mean_star_all = np.append([mean_star_all], [mean_star])
-                var_star_all = np.append([var_star_all], [var_star])
+        mean_star_all, var_star_all = self.predict(x_star_all, out=out, n_jobs=n_jobs)
         
         mean_star_all = mean_star_all.reshape(dim[0], dim[1], dim[2])
         var_star_all = var_star_all.reshape(dim[0], dim[1], dim[2])
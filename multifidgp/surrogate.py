@@ -0,0 +1,105 @@
+__doc__ = """
+Surrogate
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Surrogate-assisted minimization of expensive, noisy objectives such as the
+Monte Carlo utility of the Bayesian experimental design classes. The
+objective values seen so far are kriged with SingleKriging, with a
+separable Gaussian covariance and a noise variance fitted by maximum
+likelihood, and the next point is the candidate with the largest expected
+improvement [1] over the best kriged mean, until a budget of objective
+evaluations is spent. The surrogate is grown by add_observations, so each
+step only borders its factorization; the noise variance is refitted
+whenever the number of points has doubled.
+
+References
+----------
+.. [1] Jones, D. R., Schonlau, M., & Welch, W. J. (1998). Efficient global
+optimization of expensive black-box functions. Journal of Global
+Optimization, 13(4), 455-492.
+
+"""
+
+import numpy as np
+import scipy.optimize as op
+from scipy.stats import norm
+from multifidgp.singlekriging import SingleKriging
+
+
+def expected_improvement(mean, var, f_min):
+    """Expected improvement below f_min of kriging predictions (mean, var)."""
+    sd = np.sqrt(var)
+    improvement = f_min - mean
+    z = improvement/np.where(sd > 0, sd, 1)
+    ei = improvement*norm.cdf(z) + sd*norm.pdf(z)
+    return np.where(sd > 0, ei, np.maximum(improvement, 0))
+
+
+def fit_noise(model):
+    """Fits the noise variance sigma_eps of a SingleKriging model by maximum likelihood.
+
+    sigma_eps is searched on a log scale between 1e-6 and 1 times the
+    partial sill; the fitted state is kept on the model and returned.
+    """
+    psill = float(model.model_parameters[0])
+
+    def NLML(t):
+        # from the factorization directly, likelihood() prints on every call
+        C = model.factorize(np.array([psill*10.**t]))
+        return float(0.5*C['y']@C['alpha'] + 0.5*C['logdet'] + np.log(2*np.pi)*C['N']/2)
+
+    t = op.minimize_scalar(NLML, bounds=(-6., 0.), method='bounded').x
+    model.state = model.kriging_state(np.array([psill*10.**t]))
+    return model.state
+
+
+def minimize(fun, bnd, budget=30, n_init=None, n_candidates=2000, rng=None):
+    """Minimizes the noisy objective fun over the box bnd within budget evaluations of fun.
+
+    fun maps an (M, d) array of points to M values and bnd is a (d, 2)
+    array of bounds. The n_init initial points (2*d+1 by default) are
+    drawn uniformly and evaluated in one call; every later point is the
+    best of n_candidates uniform candidates by expected improvement. The
+    points are drawn from rng, a numpy Generator (a fresh one if None).
+    Returns (x_best, f_best, X, F) with all evaluated points and values;
+    x_best is the evaluated point of lowest kriged mean, which is less
+    sensitive to the noise than the lowest value.
+    """
+    random = np.random.default_rng() if rng is None else rng
+    bnd = np.reshape(bnd, (-1, 2)).astype(float)
+    d = len(bnd)
+    lo = bnd[:, 0]
+    hi = bnd[:, 1]
+    if n_init is None:
+        n_init = 2*d+1
+    n_init = max(min(n_init, budget), 2)
+
+    X = lo + (hi-lo)*random.uniform(size=(n_init, d))
+    F = np.reshape(fun(X), -1)
+
+    # Separable Gaussian covariance scaled to the spread of the initial values and the domain
+    model_parameters = np.array([np.var(F) if np.var(F) > 0 else 1., np.sqrt(np.sum((hi-lo)**2))/2, 0.])
+    model = SingleKriging(X, F, model_parameters, kernel='separable_gaussian')
+    fit_noise(model)
+    n_fit = len(F)
+
+    while len(F) < budget:
+        S = lo + (hi-lo)*random.uniform(size=(n_candidates, d))
+        mean, var = model.predict(S)
+        ei = expected_improvement(mean, var, np.min(model.predict(X)[0]))
+        x = S[np.argmax(ei)].reshape(1, d)
+        f = np.reshape(fun(x), -1)
+        model.add_observations(x, f)
+        X = np.concatenate([X, x])
+        F = np.concatenate([F, f])
+        if len(F) >= 2*n_fit:
+            fit_noise(model)
+            n_fit = len(F)
+
+    i = np.argmin(model.predict(X)[0])
+    return X[i], F[i], X, F
@@ -0,0 +1,124 @@
+__doc__ = """
+Tiling
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Tiled prediction over large sets of kriging locations. The prediction
+points are split into tiles sized by a memory budget, each tile is
+predicted independently, and the results are either written into
+preallocated mean/variance buffers or yielded tile by tile. Tiles can be
+spread over a thread pool (numpy/BLAS release the GIL) or over a pool of
+forked processes that share the fitted factorization read-only.
+
+"""
+
+import os
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+
+MEMORY_BUDGET = 256*2**20   # Scratch memory per prediction tile (bytes)
+
+# Task of a forked worker process, set in the worker only by _init_worker
+_worker_tile = None
+
+
+def tile_size(N, budget=MEMORY_BUDGET):
+    """Number of prediction points per tile for N training points."""
+    # psi, its solve against K and temporaries take about 4*N floats per point
+    return max(int(budget//(32*max(N, 1))), 1)
+
+
+def tile_slices(M, size):
+    """Yields consecutive slices of at most size points out of M."""
+    for start in range(0, M, size):
+        yield slice(start, min(start+size, M))
+
+
+def _init_worker(task):
+    global _worker_tile
+    _worker_tile = task
+
+
+def _run_tile(chunk):
+    return _worker_tile(chunk)
+
+
+def n_workers(n_jobs):
+    """Number of workers for n_jobs, with None or -1 meaning all cores."""
+    if n_jobs is None or n_jobs < 0:
+        return os.cpu_count()
+    return n_jobs
+
+
+def map_tiles(task, chunks, n_jobs=1, backend='thread'):
+    """Yields task(chunk) for each chunk in order, in a pool of n_jobs workers.
+
+    The workers are threads (backend='thread') or forked processes
+    (backend='process') that inherit task and its data from the parent.
+    The task is bound to each pool, so concurrent calls do not share it.
+    """
+    n_jobs = n_workers(n_jobs)
+    chunks = list(chunks)
+    if n_jobs <= 1 or len(chunks) <= 1:
+        yield from map(task, chunks)
+        return
+
+    if backend == 'thread':
+        pool = ThreadPoolExecutor(n_jobs)
+    elif backend == 'process':
+        # forked workers take task from initargs without pickling it
+        pool = ProcessPoolExecutor(n_jobs, mp_context=multiprocessing.get_context('fork'),
+                                   initializer=_init_worker, initargs=(task,))
+        task = _run_tile
+    else:
+        raise Exception("The parallel backend must be 'thread' or 'process'!")
+    with pool:
+        yield from pool.map(task, chunks)
+
+
+def iter_predict(predict_tile, x_star_all, N, budget=MEMORY_BUDGET, n_jobs=1, backend='thread'):
+    """Yields (slice, mean, var) for each tile as soon as it is predicted.
+
+    With n_jobs > 1 (or -1 for all cores) the tiles are predicted in a
+    pool of n_jobs workers, either threads (backend='thread') or forked
+    processes (backend='process'); tiles are still yielded in order.
+    """
+    M = len(x_star_all)
+    n_jobs = n_workers(n_jobs)
+    size = tile_size(N, budget)
+    if n_jobs > 1:
+        # keep every worker busy even when the budget allows few large tiles
+        size = max(min(size, -(-M//n_jobs)), 1)
+    tiles = list(tile_slices(M, size))
+
+    chunks = (x_star_all[tile] for tile in tiles)
+    for tile, (mean_star, var_star) in zip(tiles, map_tiles(predict_tile, chunks, n_jobs, backend)):
+        yield tile, np.reshape(mean_star, -1), np.reshape(var_star, -1)
+
+
+def predict(predict_tile, x_star_all, N, out=None, budget=MEMORY_BUDGET, n_jobs=1, backend='thread'):
+    """Predicts x_star_all tile by tile into preallocated mean/var buffers.
+
+    out is an optional (mean, var) pair of contiguous arrays holding
+    len(x_star_all) values each; it is filled in place and returned.
+    n_jobs and backend select parallel prediction as in iter_predict.
+    """
+    M = len(x_star_all)
+    if out is None:
+        out = (np.empty(M), np.empty(M))
+    mean_star_all, var_star_all = out
+    mean_flat = np.reshape(mean_star_all, -1)
+    var_flat = np.reshape(var_star_all, -1)
+    for buf, flat in ((mean_star_all, mean_flat), (var_star_all, var_flat)):
+        if flat.size != M or not np.shares_memory(buf, flat):
+            raise Exception("The output buffers must be contiguous arrays with one value per prediction point!")
+
+    for tile, mean_star, var_star in iter_predict(predict_tile, x_star_all, N, budget, n_jobs, backend):
+        mean_flat[tile] = mean_star
+        var_flat[tile] = var_star
+    return mean_star_all, var_star_all
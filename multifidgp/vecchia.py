@@ -0,0 +1,167 @@
+__doc__ = """
+Vecchia
+=======
+
+Code by Chien-Yung Tseng, University of Illinois Urbana-Champaign
+cytseng2@illinois.edu
+
+Summary
+-------
+Vecchia approximation [1] of the negative log marginal likelihood for
+fitting kriging hyperparameters on large data sets. The sites are put in
+maxmin order [2] and the joint density is factored into conditionals of
+each site given its m nearest previously ordered sites, found with a
+KD-tree. Every conditional is a small (m x m) system, solved in batches
+of sites that are spread over a pool of workers, so one evaluation of the
+likelihood and its gradient costs O(N m^3) instead of O(N^3). With m = N-1
+the exact likelihood is recovered.
+
+References
+----------
+.. [1] Vecchia, A. V. (1988). Estimation and model identification for
+continuous spatial processes. Journal of the Royal Statistical Society:
+Series B, 50(2), 297-312.
+.. [2] Guinness, J. (2018). Permutation and grouping methods for
+sharpening Gaussian process approximations. Technometrics, 60(4),
+415-429.
+
+"""
+
+import heapq
+import numpy as np
+from scipy.spatial import cKDTree
+from multifidgp import tiling
+
+
+def maxmin_order(X):
+    """Returns the maxmin ordering of the sites X, starting next to their center.
+
+    Each next site is the one farthest from the sites ordered so far. The
+    distances only shrink, so they are kept in a lazy max-heap and only
+    the sites within the current maxmin distance of a new site, found
+    with a KD-tree, are updated.
+    """
+    X = np.reshape(X, (len(X), -1))
+    N = len(X)
+    tree = cKDTree(X)
+    i = np.argmin(np.sum((X - np.mean(X, axis=0))**2, axis=1))
+    dist = np.sqrt(np.sum((X - X[i])**2, axis=1))
+    heap = [(-d, j) for j, d in enumerate(dist)]
+    heapq.heapify(heap)
+    ordered = np.zeros(N, dtype=bool)
+    order = np.empty(N, dtype=int)
+    for n in range(N):
+        if n:
+            # skip heap entries of ordered sites or with outdated distances
+            while True:
+                d, i = heapq.heappop(heap)
+                if not ordered[i] and -d == dist[i]:
+                    break
+            near = np.array(tree.query_ball_point(X[i], -d), dtype=int)
+            if len(near):
+                d_near = np.sqrt(np.sum((X[near] - X[i])**2, axis=1))
+                closer = d_near < dist[near]
+                for j, d_j in zip(near[closer], d_near[closer]):
+                    dist[j] = d_j
+                    heapq.heappush(heap, (-d_j, j))
+        order[n] = i
+        ordered[i] = True
+        dist[i] = 0
+    return order
+
+
+def ordered_neighbors(X, m):
+    """Returns the (N, m) indices of the m nearest preceding sites of the ordered sites X.
+
+    Sites with fewer than m predecessors are padded with -1.
+    """
+    X = np.reshape(X, (len(X), -1))
+    N = len(X)
+    NN = -np.ones((N, m), dtype=int)
+    for i in range(min(N, m+1)):
+        NN[i, :i] = np.arange(i)
+
+    # query growing sets of nearest sites until m of them precede each site
+    tree = cKDTree(X)
+    pending = np.arange(m+1, N)
+    k = 2*m
+    while len(pending):
+        k = min(k, N)
+        idx = tree.query(X[pending], k)[1].reshape(len(pending), -1)
+        before = idx < pending.reshape(-1, 1)
+        done = (np.sum(before, axis=1) >= m) | (k == N)
+        first = np.argsort(~before[done], axis=1, kind='stable')[:, :m]
+        NN[pending[done]] = np.take_along_axis(idx[done], first, axis=1)
+        pending = pending[~done]
+        k = 2*k
+    return NN
+
+
+def local_distances(X, c, metric='euclidean'):
+    """Returns the (n, m+1, m+1) euclidean or cityblock distances among the sites c of each conditional."""
+    Xc = np.reshape(X, (len(X), -1))[c]
+    if metric == 'cityblock':
+        return np.sum(abs(Xc[:, :, None, :] - Xc[:, None, :, :]), axis=-1)
+    return np.sqrt(np.sum((Xc[:, :, None, :] - Xc[:, None, :, :])**2, axis=-1))
+
+
+def conditionals(local_cov, y, NN, rows):
+    """Returns the NLML terms of the sites rows and their gradient.
+
+    local_cov(c) returns the covariances K (n, m+1, m+1) among the sites
+    c (n, m+1), each site last after its neighbors, and their derivatives
+    DK (p, n, m+1, m+1) with respect to the p hyperparameters.
+    """
+    c = np.concatenate([NN[rows], rows.reshape(-1, 1)], axis=1)
+    valid = c >= 0
+    c = np.where(valid, c, 0)
+    K, DK = local_cov(c)
+
+    # padded neighbors are decoupled with unit variance and zero data
+    pair = valid[:, :, None] & valid[:, None, :]
+    K = np.where(pair, K, np.eye(c.shape[1]))
+    DK = np.where(pair, DK, 0)
+    y_c = np.where(valid, y[c], 0)
+
+    # weights w = K_N^-1 k and b = K_N^-1 y_N of the conditional on the neighbors
+    K_N = K[:, :-1, :-1]
+    k = K[:, :-1, -1]
+    y_N = y_c[:, :-1]
+    Wb = np.linalg.solve(K_N, np.stack([k, y_N], axis=2))
+    w = Wb[:, :, 0]
+    b = Wb[:, :, 1]
+    v = K[:, -1, -1] - np.sum(k*w, axis=1)
+    r = y_c[:, -1] - np.sum(w*y_N, axis=1)
+    NLML = 0.5*np.sum(np.log(abs(v)) + r**2/v)
+
+    # Derivatives of the conditional variance v and residual r
+    DK_N = DK[:, :, :-1, :-1]
+    Dk = DK[:, :, :-1, -1]
+    wDK_N = np.einsum('nj,pnjl->pnl', w, DK_N)
+    Dv = DK[:, :, -1, -1] - 2*np.sum(Dk*w, axis=2) + np.sum(wDK_N*w, axis=2)
+    Dr = np.sum(wDK_N*b, axis=2) - np.sum(Dk*b, axis=2)
+    D_NLML = 0.5*np.sum(Dv/v + 2*r*Dr/v - r**2*Dv/v**2, axis=1)
+    return NLML, D_NLML
+
+
+def likelihood(local_cov, y, NN, n_hyp, n_jobs=1, backend='thread', budget=tiling.MEMORY_BUDGET):
+    """Returns the Vecchia NLML of the ordered data y and its gradient.
+
+    The sites are processed in batches sized by budget (bytes), in a pool
+    of n_jobs workers as in tiling.map_tiles.
+    """
+    y = np.reshape(y, -1)
+    N, m = NN.shape
+    size = tiling.tile_size((n_hyp+2)*(m+1)**2, budget)
+    n_jobs = tiling.n_workers(n_jobs)
+    if n_jobs > 1:
+        size = max(min(size, -(-N//n_jobs)), 1)
+    chunks = (np.arange(N)[tile] for tile in tiling.tile_slices(N, size))
+    task = lambda rows: conditionals(local_cov, y, NN, rows)
+
+    NLML = np.log(2*np.pi)*N/2
+    D_NLML = np.zeros(n_hyp)
+    for NLML_rows, D_rows in tiling.map_tiles(task, chunks, n_jobs, backend):
+        NLML += NLML_rows
+        D_NLML += D_rows
+    return NLML, D_NLML
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from multifidgp.multikriging import MultiKriging
+from test_multikriging import cokriging_data
+
+# constructor keywords and fitted hyperparameters of every mode that can be saved
+modes = {
+    'exact': ({}, [1.e-4, 1.e-4, 1.2]),
+    'recursive': ({'recursive': True}, [1.e-4, 1.e-4, 1.2]),
+    'fitc': ({'kernel': 'separable_exponential', 'inducing_L': 30}, [1.e-4, 1.e-4, 1.2]),
+    'sparse': ({'kernel': 'wendland', 'taper': 6.}, [1.e-4, 1.e-4, 1.2]),
+    'separable': ({'kernel': 'separable_gaussian'}, [1.e-3, 1.e-3, 1.2]),
+    'vecchia': ({'likelihood_mode': 'vecchia', 'n_neighbors': 10}, [1.e-4, 1.e-4, 1.2]),
+}
+
+
+def fitted(mode):
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    kwargs, hyp = modes[mode]
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], **kwargs)
+    hyp = np.array(hyp)
+    if mode == 'recursive':
+        model.state = model.recursive_state(hyp)
+    elif mode == 'vecchia':
+        model.state = model.kriging_state(hyp)._replace(factor=None, beta=None)
+    else:
+        model.state = model.kriging_state(hyp)
+    return model, X_star
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+@pytest.mark.parametrize('mode', sorted(modes))
+def test_save_load_round_trip(tmp_path, mode, mmap):
+    model, X_star = fitted(mode)
+    mean, var = model.predict(X_star)
+    model.save(tmp_path/'model.npz')
+    loaded = MultiKriging.load(tmp_path/'model.npz', mmap=mmap)
+    mean_loaded, var_loaded = loaded.predict(X_star)
+    assert np.allclose(mean_loaded, mean, rtol=1.e-13, atol=1.e-13)
+    assert np.allclose(var_loaded, var, rtol=1.e-13, atol=1.e-13)
+
+
+def test_bordered_factor_round_trip(tmp_path):
+    model, X_star = fitted('exact')
+    model.add_observations(X_star[:3], np.ones(3), 'H')
+    mean, var = model.predict(X_star)
+    model.save(tmp_path/'model.npz')
+    mean_loaded, var_loaded = MultiKriging.load(tmp_path/'model.npz').predict(X_star)
+    assert np.allclose(mean_loaded, mean, rtol=1.e-13, atol=1.e-13)
+    assert np.allclose(var_loaded, var, rtol=1.e-13, atol=1.e-13)
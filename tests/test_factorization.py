@@ -0,0 +1,81 @@
+import threading
+import numpy as np
+import pytest
+from multifidgp import tiling
+from multifidgp.factorization import Factorization, FactorCache
+
+
+def kriging_matrices(N=40, seed=0):
+    """A positive definite and an indefinite (variogram-like) symmetric matrix."""
+    rng = np.random.default_rng(seed)
+    A = rng.standard_normal((N, N))
+    K_pd = A@A.T/N + np.eye(N)
+    K_indefinite = np.exp(-abs(np.subtract.outer(np.arange(N), np.arange(N)))/5.) - 0.5*np.eye(N)
+    return K_pd, K_indefinite
+
+
+@pytest.mark.parametrize('which', [0, 1])
+def test_inv_diag_and_trace_solve(which, monkeypatch):
+    K = kriging_matrices()[which]
+    N = len(K)
+    B = np.random.default_rng(1).standard_normal((N, N))
+    # several column blocks
+    monkeypatch.setattr(tiling, 'tile_size', lambda N, budget=None: 7)
+    F = Factorization(K)
+    assert F.cholesky == (which == 0)
+    assert not hasattr(F, 'inv')
+    invK = np.linalg.inv(K)
+    assert np.allclose(F.inv_diag(), np.diag(invK), rtol=1.e-12, atol=0)
+    assert abs(F.trace_solve(B) - np.trace(invK@B)) < 1.e-12*np.sum(abs(invK@B))
+
+    # bordering K without rows 10:20 by them before row 10 gives K with permuted factor rows
+    keep, new = np.r_[0:10, 20:N], np.r_[10:20]
+    G = Factorization(K[np.ix_(keep, keep)]).extend(K[np.ix_(keep, new)], K[np.ix_(new, new)], 10)
+    assert G.perm is not None
+    assert np.allclose(G.inv_diag(), np.diag(invK), rtol=1.e-10, atol=0)
+    assert abs(G.trace_solve(B) - np.trace(invK@B)) < 1.e-10*np.sum(abs(invK@B))
+
+
+def test_factor_cache_evicts_least_recently_used():
+    cache = FactorCache(budget=100)
+    cache.put('a', 1, 40)
+    cache.put('b', 2, 40)
+    assert cache.get('a') == 1
+    # 'b' is now the least recently used and makes room for 'c'
+    cache.put('c', 3, 40)
+    assert cache.get('b') is None and [key for key, _ in cache.items()] == ['a', 'c']
+    assert cache.nbytes == 80
+
+    # replacing an entry releases its old size, oversized entries are not stored
+    cache.put('a', 4, 60)
+    assert cache.items() == [('c', 3), ('a', 4)] and cache.nbytes == 100
+    cache.put('d', 5, 101)
+    assert cache.get('d') is None and cache.nbytes == 100
+    cache.clear()
+    assert cache.items() == [] and cache.nbytes == 0
+
+
+def test_factor_cache_threads():
+    cache = FactorCache(budget=1000)
+    errors = []
+
+    def work(t):
+        try:
+            for i in range(2000):
+                key = (t, i % 37)
+                value = cache.get(key)
+                if value is None:
+                    cache.put(key, (t, i % 37), 10 + i % 7)
+                elif value != key:
+                    errors.append((key, value))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(t,)) for t in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    # the byte count stays that of the entries kept, within the budget
+    assert cache.nbytes == sum(nbytes for _, nbytes in cache.entries.values()) <= 1000
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+from multifidgp.multibayesian_exp import MultiBayesianExp
+
+
+def design(seed=0, n_samples=20, **kwargs):
+    rng = np.random.default_rng(seed)
+    X_L = rng.uniform(0, 10, (25, 2))
+    X_H = rng.uniform(0, 10, (6, 2))
+    f = lambda X: np.exp(0.3*np.sin(X[:, 0]) + 0.2*np.cos(X[:, 1]))
+    return MultiBayesianExp(X_H, X_L, 1.2*f(X_H), f(X_L), [0.3, 4., 1.e-4], [0.5, 5., 1.e-4], 0.9,
+                            n_samples=n_samples, seed=seed, **kwargs)
+
+
+def test_batch_borders_sample_factors_in_parallel():
+    bnd = ((0, 10), (0, 10))
+    serial = design().execute_batch(bnd, 2.5, 3)
+
+    model = design()
+    cached = []
+    utility_parallel = model.utility_parallel
+
+    def counted(S, *args, **kwargs):
+        # the workers are forked with every sampled factor already cached
+        cached.append(len([key for key, _ in model.factors.items() if key[0] == model.version]))
+        return utility_parallel(S, *args, **kwargs)
+
+    compute_sample = model.compute_sample
+    computed = []
+    model.compute_sample = lambda r_H, r_L: computed.append(1) or compute_sample(r_H, r_L)
+    model.utility_parallel = counted
+    parallel = model.execute_batch(bnd, 2.5, 3, n_jobs=2)
+    assert np.array_equal(serial, parallel)
+    assert cached == [model.n_samples + 1]*3
+    # factored once on the real data, bordered for the later picks
+    assert len(computed) == model.n_samples + 1
+
+
+def test_sample_factors_follow_the_data_version():
+    model = design()
+    r_H, r_L = model.sample_ranges(np.random.default_rng(1), 3)
+    samples = [model.factor_sample(h, l) for h, l in zip(r_H, r_L)]
+    assert all(model.factor_sample(h, l) is sample for h, l, sample in zip(r_H, r_L, samples))
+
+    # bordered into the new version, equal to a refactorization of the enlarged data
+    model.add_observations([[5., 5.]], [1.1], 'L')
+    assert [key[0] for key, _ in model.factors.items()] == [1]*3
+    for h, l in zip(r_H, r_L):
+        F, mu, beta = model.factor_sample(h, l)
+        F_new, mu_new, beta_new = model.compute_sample(h, l)
+        assert abs(mu - mu_new) < 1.e-14 and np.allclose(beta, beta_new, rtol=0, atol=1.e-10*np.max(abs(beta_new)))
+
+    model.invalidate()
+    assert model.factors.items() == []
+    assert model.factor_sample(r_H[0], r_L[0]) is not samples[0] and model.factors.items()[0][0][0] == 2
+
+
+def test_batch_fantasizes_the_lognormal_mean():
+    model = design()
+    fantasized = []
+    add_observations = model.add_observations
+
+    def recorded(X_new, K_new, fidelity):
+        # MultiKrig returns the lognormal mean exp(m + v/2) of the log-space kriging (m, v)
+        mean = model.MultiKrig(X_new, model.model_parameters_H[1], model.model_parameters_L[1])[0]
+        fantasized.append((np.reshape(K_new, -1)[0], np.reshape(mean, -1)[0]))
+        return add_observations(X_new, K_new, fidelity)
+
+    model.add_observations = recorded
+    model.execute_batch(((0, 10), (0, 10)), 2.5, 2)
+    assert len(fantasized) == 2 and all(K_new == mean for K_new, mean in fantasized)
+
+
+@pytest.mark.parametrize('own_seed', [True, False])
+def test_parallel_max_matches_serial(own_seed):
+    bnd = ((0, 10), (0, 10))
+    smax = []
+    for n_jobs in (1, 2):
+        model = design()
+        if not own_seed:
+            # draws from the seed of execute_max, in the parent only
+            model.seed = None
+        smax.append(model.execute_max(bnd, 2., n_jobs=n_jobs, seed=7))
+        if n_jobs > 1:
+            # forked after the nominal and sampled factorizations were cached
+            assert len(model.factors.items()) == model.n_samples + 1
+    assert np.array_equal(smax[0], smax[1])
+
+
+def finite_difference(fun, S, step=1.e-6):
+    D = np.zeros(S.shape)
+    for a in range(S.shape[1]):
+        E = np.zeros(S.shape)
+        E[:, a] = step
+        D[:, a] = (fun(S + E) - fun(S - E))/(2*step)
+    return D
+
+
+def test_screening_matches_nested_mc():
+    bnd = ((0, 10), (0, 10))
+    for seed in range(3):
+        model = design(seed, n_samples=100)
+        S = model.candidates(bnd, 0.5)
+        Utility = model.utility_batch(S)
+        Laplace = model.utility_batch(S, mode='laplace')
+        # the screen keeps most of the nested top 20 and puts the nested best in its top 5
+        assert len(np.intersect1d(np.argsort(Laplace)[:20], np.argsort(Utility)[:20])) >= 16
+        assert np.argmin(Utility) in np.argsort(Laplace)[:5]
+        assert np.array_equal(model.execute_screening(bnd, 0.5, top_k=5), S[np.argmin(Utility)])
+
+
+@pytest.mark.parametrize('mode', ['nested_mc', 'laplace'])
+def test_utility_gradient(mode):
+    model = design()
+    S = np.array([[2.3, 4.1], [7.7, 1.2]])
+    Utility, dUtility = model.utility_grad(S, mode=mode)
+    assert np.allclose(Utility, model.utility_batch(S, mode=mode), rtol=1.e-12, atol=0)
+    D = finite_difference(lambda S: model.utility_batch(S, mode=mode), S)
+    assert np.allclose(dUtility, D, rtol=1.e-5, atol=1.e-6*np.max(abs(D)))
@@ -0,0 +1,289 @@
+import numpy as np
+import numpy.linalg as la
+import scipy.linalg as sla
+import pytest
+from multifidgp.multikriging import MultiKriging
+from multifidgp.factorization import Factorization
+from multifidgp import tiling
+
+
+def cokriging_data(N_L=120, N_H=15, seed=0):
+    rng = np.random.default_rng(seed)
+    X_L = rng.uniform(0, 10, (N_L, 2))
+    X_H = rng.uniform(0, 10, (N_H, 2))
+    f = lambda X: np.sin(X[:, 0])*np.cos(0.5*X[:, 1])
+    return X_H, 1.3*f(X_H) + 0.2, X_L, f(X_L), rng.uniform(0, 10, (40, 2))
+
+
+def test_fitc_requires_covariance_kernel():
+    X_H, y_H, X_L, y_L, _ = cokriging_data()
+    with pytest.raises(ValueError):
+        MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], inducing_L=10)
+
+
+def test_fitc_converges_to_exact():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    args = (X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.])
+    hyp = np.array([1.e-4, 1.e-4, 1.2])
+    exact = MultiKriging(*args, kernel='separable_exponential')
+    NLML = exact.likelihood(hyp)
+    mean, var = exact.predict(X_star, exact.kriging_state(hyp))
+
+    errors = []
+    for m in (15, 60, len(X_L) + len(X_H)):
+        model = MultiKriging(*args, kernel='separable_exponential', inducing_L=m)
+        mean_m, var_m = model.predict(X_star, model.kriging_state(hyp))
+        errors.append((abs(model.likelihood(hyp) - NLML), np.max(abs(mean_m - mean)), np.max(abs(var_m - var))))
+    errors = np.array(errors)
+    assert np.all(np.diff(errors, axis=0) < 0)
+    assert errors[-1, 0] < 1.e-6*abs(NLML)
+    assert np.all(errors[-1, 1:] < 1.e-8)
+
+
+def test_fitc_grid_placement():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    args = (X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.])
+    hyp = np.array([1.e-4, 1.e-4, 1.2])
+    exact = MultiKriging(*args, kernel='separable_exponential')
+    mean, var = exact.predict(X_star, exact.kriging_state(hyp))
+    errors = []
+    for m in (9, 100):
+        model = MultiKriging(*args, kernel='separable_exponential', inducing_L=m, inducing_placement='grid')
+        assert len(model.inducing_L) == m
+        mean_m, var_m = model.predict(X_star, model.kriging_state(hyp))
+        errors.append(np.max(abs(mean_m - mean)))
+    assert errors[1] < errors[0]
+
+
+def dense_reference(model, hyp, x_star):
+    """NLML, gradient, Hessian, mean and variance by the original dense LU and inverse formulas."""
+    k = model.k
+    X_L, X_H, mp_L, mp_H = model.Xdata_L, model.Xdata_H, model.model_parameters_L, model.model_parameters_H
+    y = np.concatenate([model.Kdata_L, model.Kdata_H])
+    sigma_eps_L, sigma_eps_H, rho = hyp
+    N_L = len(X_L)
+    N = len(y)
+    K = np.block([[k(X_L, X_L, mp_L) + np.eye(N_L)*sigma_eps_L, rho*k(X_L, X_H, mp_L)],
+                  [rho*k(X_H, X_L, mp_L), rho**2*k(X_H, X_H, mp_L) + k(X_H, X_H, mp_H) + np.eye(len(X_H))*sigma_eps_H]])
+    K = K + np.eye(N)*model.eps
+    P, L, U = sla.lu(K)
+    invK = la.inv(U)@(la.inv(L)@P.T)
+    alpha = invK@y
+    NLML = 0.5*y.T@alpha + 0.5*np.sum(np.log(abs(np.diag(U)))) + np.log(2*np.pi)*N/2
+
+    Q = invK - alpha@alpha.T
+    DK = np.block([[np.zeros((N_L, N_L)), k(X_L, X_H, mp_L)], [k(X_H, X_L, mp_L), 2*rho*k(X_H, X_H, mp_L)]])
+    D_NLML = np.array([sigma_eps_L*np.trace(Q[:N_L, :N_L])/2, sigma_eps_H*np.trace(Q[N_L:, N_L:])/2, np.sum(Q*DK)/2])
+
+    DQ = 0.5*invK@(np.eye(N) - 2*y@y.T@invK)@invK
+    DD_NLML = np.zeros((3, 3))
+    DD_NLML[2, 2] = np.sum(DQ*DK**2)
+    DD_NLML[0, 0] = sigma_eps_L**2*np.trace(DQ[:N_L, :N_L])
+    DD_NLML[1, 1] = sigma_eps_H**2*np.trace(DQ[N_L:, N_L:])
+    DD_NLML[0, 2] = DD_NLML[2, 0] = sigma_eps_L*np.trace(DQ[:N_L, :N_L]*DK[:N_L, :N_L])
+    DD_NLML[1, 2] = DD_NLML[2, 1] = sigma_eps_H*np.trace(DQ[N_L:, N_L:]*DK[N_L:, N_L:])
+
+    mu = np.mean(y)
+    psi = np.concatenate([rho*k(x_star, X_L, mp_L), rho**2*k(x_star, X_H, mp_L) + k(x_star, X_H, mp_H)], axis=1)
+    mean = mu + psi@(invK@(y - mu))
+    var = abs(np.diag(rho**2*k(x_star, x_star, mp_L) + k(x_star, x_star, mp_H) - psi@invK@psi.T))
+    return NLML.item(), D_NLML, DD_NLML, mean.reshape(-1), var
+
+
+def likelihood_fd(fun, hyp, step=1.e-6):
+    """Central differences of fun, scaled by hyp for the noise terms as in Gradient."""
+    D = np.zeros(len(hyp))
+    for i in range(len(hyp)):
+        E = np.zeros(len(hyp))
+        E[i] = step*hyp[i]
+        D[i] = (fun(hyp + E) - fun(hyp - E))/(2*step*hyp[i])
+    return D
+
+
+def test_exact_matches_dense_formulas():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    # column data as in the original scripts, for which the Hessian was written
+    model = MultiKriging(X_H, y_H[:, None], X_L, y_L[:, None], [0.3, 3., 0.], [1., 4., 0.])
+    hyp = np.array([0.05, 0.02, 1.2])
+    NLML, D_NLML, DD_NLML, mean, var = dense_reference(model, hyp, X_star)
+    assert abs(model.likelihood(hyp) - NLML) < 1.e-14*abs(NLML)
+    assert np.allclose(model.Gradient(hyp), D_NLML, rtol=1.e-14, atol=0)
+    assert np.allclose(model.Hessian(hyp), DD_NLML, rtol=0, atol=1.e-14*np.max(abs(DD_NLML)))
+    mean_star, var_star = model.predict(X_star, model.kriging_state(hyp))
+    # the predictions agree to the accuracy of the dense inverse, cond(K) is about 2e4
+    assert np.allclose(mean_star, mean, rtol=0, atol=5.e-14*np.max(abs(mean)))
+    assert np.allclose(var_star, var, rtol=0, atol=5.e-13*np.max(var))
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'kernel': 'separable_exponential'}, {'kernel': 'wendland', 'taper': 6.},
+                                    {'kernel': 'separable_exponential', 'inducing_L': 30}])
+def test_likelihood_gradient(kwargs):
+    X_H, y_H, X_L, y_L, _ = cokriging_data()
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], **kwargs)
+    hyp = np.array([0.1, 0.05, 1.2])
+    # the noise components are sigma*dL/dsigma, as seen by TNC on log scales
+    D = likelihood_fd(model.likelihood, hyp)*np.array([hyp[0], hyp[1], 1.])
+    assert np.allclose(model.Gradient(hyp), D, rtol=1.e-6, atol=0)
+    NLML, D_NLML = model.value_and_grad(hyp)
+    assert NLML == model.likelihood(hyp) and np.array_equal(D_NLML, model.Gradient(hyp))
+
+
+def test_vecchia_likelihood():
+    X_H, y_H, X_L, y_L, _ = cokriging_data(N_L=60, N_H=10)
+    args = (X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.])
+    hyp = np.array([0.1, 0.05, 1.2])
+    model = MultiKriging(*args, likelihood_mode='vecchia', n_neighbors=10)
+    NLML, D_NLML = model.likelihood_vecchia(hyp)
+    D = likelihood_fd(lambda h: model.likelihood_vecchia(h)[0], hyp)*np.array([hyp[0], hyp[1], 1.])
+    assert np.allclose(D_NLML, D, rtol=1.e-6, atol=0)
+
+    # conditioning on every preceding site is the exact likelihood
+    model.n_neighbors = len(X_L) + len(X_H) - 1
+    NLML, D_NLML = model.likelihood_vecchia(hyp)
+    exact = MultiKriging(*args)
+    assert abs(NLML - exact.likelihood(hyp)) < 1.e-10*abs(NLML)
+    assert np.allclose(D_NLML, exact.Gradient(hyp), rtol=1.e-8, atol=0)
+
+
+def test_predict_grid_matches_predict():
+    X_H, y_H, X_L, y_L, _ = cokriging_data()
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], kernel='separable_gaussian')
+    model.state = model.kriging_state(np.array([1.e-3, 1.e-3, 1.2]))
+    axes = [np.linspace(0, 10, 9), np.linspace(1, 9, 7)]
+    x_star = np.stack([x.reshape(-1) for x in np.meshgrid(*axes, indexing='ij')], axis=1)
+    mean, var = model.predict(x_star)
+    mean_grid, var_grid = model.predict_grid(axes)
+    assert np.allclose(mean_grid, mean, rtol=0, atol=1.e-12)
+    assert np.allclose(var_grid, var, rtol=0, atol=1.e-12)
+
+    xx, yy = np.meshgrid(*axes)
+    mean_mesh, var_mesh = model.predict_meshgrid((xx, yy))
+    assert np.allclose(mean_mesh, mean.reshape(9, 7).T, rtol=0, atol=1.e-12)
+    assert np.allclose(var_mesh, var.reshape(9, 7).T, rtol=0, atol=1.e-12)
+
+
+def test_recursive_gls_recovers_rho_and_mu_D():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    # nested design whose high fidelity is exactly 1.7*y_L + 0.4
+    X_H = X_L[:15]
+    model = MultiKriging(X_H, 1.7*y_L[:15] + 0.4, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], recursive=True)
+    state = model.recursive_state([1.e-4, 1.e-4])
+    assert abs(state.rho - 1.7) < 1.e-10 and abs(state.mu_D - 0.4) < 1.e-10
+    assert np.allclose(state.beta_D, 0, atol=1.e-8)
+
+    # with a discrepancy, rho and mu_D are the GLS estimate of the dense system
+    y_H = 1.7*y_L[:15] + 0.4 + 0.1*np.cos(X_H[:, 0])
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], recursive=True)
+    state = model.recursive_state([1.e-4, 1.e-4])
+    K_D = model.k(X_H, X_H, model.model_parameters_H) + np.eye(15)*(1.e-4 + model.eps)
+    G = np.stack([y_L[:15], np.ones(15)], axis=1)
+    rho, mu_D = la.solve(G.T@la.solve(K_D, G), G.T@la.solve(K_D, y_H))
+    assert abs(state.rho - rho) < 1.e-10 and abs(state.mu_D - mu_D) < 1.e-10
+
+
+def test_recursive_predict_matches_closed_form():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    hyp = [1.e-3, 1.e-3]
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], recursive=True)
+    state = model.recursive_state(hyp)
+    mean, cov = model.predict(X_star, state, full_cov=True)
+    mean_tiled, var = model.predict(X_star, state)
+
+    # low-fidelity kriging, then kriging of the discrepancy y_H - rho*y_L - mu_D
+    K_L = model.k(X_L, X_L, model.model_parameters_L) + np.eye(len(X_L))*(hyp[0] + model.eps)
+    K_D = model.k(X_H, X_H, model.model_parameters_H) + np.eye(len(X_H))*(hyp[1] + model.eps)
+    mu_L = np.mean(y_L)
+    k_L = model.k(X_star, X_L, model.model_parameters_L)
+    k_D = model.k(X_star, X_H, model.model_parameters_H)
+    y_LH = mu_L + model.k(X_H, X_L, model.model_parameters_L)@la.solve(K_L, y_L - mu_L)
+    r_H = y_H - state.rho*y_LH - state.mu_D
+    mean_ref = state.rho*(mu_L + k_L@la.solve(K_L, y_L - mu_L)) + state.mu_D + k_D@la.solve(K_D, r_H)
+    cov_ref = (state.rho**2*(model.k(X_star, X_star, model.model_parameters_L) - k_L@la.solve(K_L, k_L.T))
+               + model.k(X_star, X_star, model.model_parameters_H) - k_D@la.solve(K_D, k_D.T))
+    assert np.allclose(mean, mean_ref, rtol=0, atol=1.e-12)
+    assert np.allclose(cov, cov_ref, rtol=0, atol=1.e-12)
+    assert np.allclose(mean_tiled, mean_ref, rtol=0, atol=1.e-12)
+    assert np.allclose(var, abs(np.diag(cov_ref)), rtol=0, atol=1.e-12)
+
+
+@pytest.mark.parametrize('kernel', ['variogram', 'separable_exponential'])
+def test_add_observations_matches_rebuilt(kernel):
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    hyp = np.array([0.05, 0.02, 1.2])
+    model = MultiKriging(X_H[:10], y_H[:10], X_L[:100], y_L[:100], [0.3, 3., 0.], [1., 4., 0.], kernel=kernel)
+    model.state = model.kriging_state(hyp)
+    # low-fidelity rows go inside K, before the high-fidelity block
+    model.add_observations(X_L[100:], y_L[100:], 'L')
+    state = model.add_observations(X_H[10:], y_H[10:], 'H')
+    assert state.factor.cholesky == (kernel != 'variogram') and state.factor.perm is not None
+
+    rebuilt = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.], kernel=kernel)
+    rebuilt.state = rebuilt.kriging_state(hyp)
+    assert np.allclose(state.beta, rebuilt.state.beta, rtol=0, atol=1.e-11*np.max(abs(rebuilt.state.beta)))
+    mean, var = model.predict(X_star)
+    mean_rebuilt, var_rebuilt = rebuilt.predict(X_star)
+    assert np.allclose(mean, mean_rebuilt, rtol=0, atol=1.e-12)
+    assert np.allclose(var, var_rebuilt, rtol=0, atol=1.e-12)
+
+
+def test_local_predict(monkeypatch):
+    X_H, y_H, X_L, y_L, X_star = cokriging_data(N_L=300, N_H=40)
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 1., 0.], [1., 1., 0.], kernel='separable_exponential')
+    state = model.kriging_state(np.array([1.e-4, 1.e-4, 1.3]))
+    mean, var = model.predict(X_star, state)
+    # the nearest fifth of the sites screen off the rest on smooth data
+    mean_local, var_local = model.predict(X_star, state, neighbors=(60, 10))
+    assert np.allclose(mean_local, mean, rtol=0, atol=1.e-3)
+    assert np.allclose(var_local, var, rtol=0, atol=1.e-5)
+
+    # points sharing their neighbors are kriged from one factorization, also across tiles and calls
+    factored = []
+    class CountingFactorization(Factorization):
+        def __init__(self, K):
+            factored.append(len(K))
+            super().__init__(K)
+    monkeypatch.setattr('multifidgp.multikriging.Factorization', CountingFactorization)
+    x_star = np.array([5., 5.]) + 1.e-6*np.random.default_rng(1).standard_normal((9, 2))
+    model.local_factors.clear()
+    model.predict(x_star, state, neighbors=(60, 10), budget=32*70*3)
+    model.predict(x_star, state, neighbors=(60, 10))
+    assert factored == [70] and len(model.local_factors.entries) == 1
+
+
+def test_tiled_predict():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.])
+    model.state = model.kriging_state(np.array([0.05, 0.02, 1.2]))
+    mean, var = model.predict_tile(X_star, model.state)
+    M = len(X_star)
+    # the budget holds tiles of 3 points
+    budget = 32*(len(X_H)+len(X_L))*3
+    assert tiling.tile_size(len(X_H)+len(X_L), budget) == 3
+
+    mean_tiled, var_tiled = model.predict(X_star, budget=budget)
+    assert np.allclose(mean_tiled, mean, rtol=0, atol=1.e-14)
+    assert np.allclose(var_tiled, var, rtol=0, atol=1.e-14)
+
+    out = (np.full((5, M//5), np.nan), np.full((5, M//5), np.nan))
+    result = model.predict(X_star, out=out, budget=budget)
+    assert result[0] is out[0] and result[1] is out[1]
+    assert np.array_equal(out[0].reshape(-1), mean_tiled) and np.array_equal(out[1].reshape(-1), var_tiled)
+    with pytest.raises(Exception):
+        model.predict(X_star, out=(np.empty((5, 2*M//5))[:, :M//5], np.empty(M)), budget=budget)
+
+    tiles = list(model.predict(X_star, tiles=True, budget=budget))
+    assert [tile for tile, _, _ in tiles] == list(tiling.tile_slices(M, 3))
+    assert np.array_equal(np.concatenate([m for _, m, _ in tiles]), mean_tiled)
+    assert np.array_equal(np.concatenate([v for _, _, v in tiles]), var_tiled)
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel_predict(backend):
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    model = MultiKriging(X_H, y_H, X_L, y_L, [0.3, 3., 0.], [1., 4., 0.])
+    model.state = model.kriging_state(np.array([0.05, 0.02, 1.2]))
+    # small tiles, so that every worker gets several
+    budget = 32*(len(X_H)+len(X_L))*3
+    mean, var = model.predict(X_star, budget=budget)
+    mean_par, var_par = model.predict(X_star, budget=budget, n_jobs=2, backend=backend)
+    assert np.array_equal(mean_par, mean) and np.array_equal(var_par, var)
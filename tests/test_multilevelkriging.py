@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from multifidgp.multikriging import MultiKriging
+from multifidgp.multilevelkriging import MultiLevelKriging
+from test_multikriging import cokriging_data, likelihood_fd
+
+
+def test_two_levels_match_multikriging():
+    X_H, y_H, X_L, y_L, X_star = cokriging_data()
+    mp_H, mp_L = [0.3, 3., 0.], [1., 4., 0.]
+    hyp = np.array([0.05, 0.02, 1.2])
+    cokriging = MultiKriging(X_H, y_H, X_L, y_L, mp_H, mp_L)
+    model = MultiLevelKriging([(X_L, y_L, mp_L), (X_H, y_H, mp_H)])
+    assert abs(model.likelihood(hyp) - cokriging.likelihood(hyp)) < 1.e-12*abs(cokriging.likelihood(hyp))
+    assert np.allclose(model.Gradient(hyp), cokriging.Gradient(hyp), rtol=1.e-12, atol=0)
+    mean, var = model.predict(X_star, model.kriging_state(hyp))
+    mean_co, var_co = cokriging.predict(X_star, cokriging.kriging_state(hyp))
+    assert np.allclose(mean, mean_co, rtol=0, atol=1.e-12)
+    assert np.allclose(var, var_co, rtol=0, atol=1.e-12)
+
+
+def three_levels(seed=1):
+    rng = np.random.default_rng(seed)
+    f = lambda X: np.sin(X[:, 0])*np.cos(0.5*X[:, 1])
+    levels = []
+    for t, N in enumerate((80, 30, 10)):
+        X = rng.uniform(0, 10, (N, 2))
+        levels.append((X, (1 + 0.2*t)*f(X) + 0.1*t, [1./(t+1), 4. - t, 0.]))
+    return MultiLevelKriging(levels), rng.uniform(0, 10, (40, 2))
+
+
+def test_likelihood_gradient():
+    model, _ = three_levels()
+    hyp = np.array([0.05, 0.03, 0.02, 1.1, 0.9])
+    # the noise components are sigma*dL/dsigma, as in MultiKriging.Gradient
+    D = likelihood_fd(model.likelihood, hyp)*np.concatenate([hyp[:3], np.ones(2)])
+    assert np.allclose(model.Gradient(hyp), D, rtol=1.e-6, atol=0)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(tmp_path, mmap):
+    model, X_star = three_levels()
+    model.state = model.kriging_state(np.array([0.05, 0.03, 0.02, 1.1, 0.9]))
+    mean, var = model.predict(X_star)
+    model.save(tmp_path/'model.npz')
+    mean_loaded, var_loaded = MultiLevelKriging.load(tmp_path/'model.npz', mmap=mmap).predict(X_star)
+    assert np.allclose(mean_loaded, mean, rtol=1.e-13, atol=1.e-13)
+    assert np.allclose(var_loaded, var, rtol=1.e-13, atol=1.e-13)
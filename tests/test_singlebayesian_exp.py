@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+from multifidgp.singlebayesian_exp import SingleBayesianExp
+from test_multibayesian_exp import finite_difference
+
+
+def design(seed=0, n_samples=20, **kwargs):
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(0, 10, (25, 2))
+    K = np.exp(0.3*np.sin(X[:, 0]) + 0.2*np.cos(X[:, 1]))
+    return SingleBayesianExp(X, K, [0.5, 5., 1.e-4], n_samples=n_samples, seed=seed, **kwargs)
+
+
+@pytest.mark.parametrize('own_seed', [True, False])
+def test_parallel_max_matches_serial(own_seed):
+    bnd = ((0, 10), (0, 10))
+    smax = []
+    for n_jobs in (1, 2):
+        model = design()
+        if not own_seed:
+            # draws from the seed of execute_max, in the parent only
+            model.seed = None
+        smax.append(model.execute_max(bnd, 2., n_jobs=n_jobs, seed=7))
+        if n_jobs > 1:
+            # forked after the nominal and sampled factorizations were cached
+            assert len(model.factors.items()) == model.n_samples + 1
+    assert np.array_equal(smax[0], smax[1])
+
+
+def test_screening_matches_nested_mc():
+    bnd = ((0, 10), (0, 10))
+    for seed in range(3):
+        model = design(seed, n_samples=100)
+        S = model.candidates(bnd, 0.5)
+        Utility = model.utility_batch(S)
+        Laplace = model.utility_batch(S, mode='laplace')
+        # the screen keeps most of the nested top 20 and puts the nested best in its top 5
+        assert len(np.intersect1d(np.argsort(Laplace)[:20], np.argsort(Utility)[:20])) >= 16
+        assert np.argmin(Utility) in np.argsort(Laplace)[:5]
+        assert np.array_equal(model.execute_screening(bnd, 0.5, top_k=5), S[np.argmin(Utility)])
+
+
+@pytest.mark.parametrize('mode', ['nested_mc', 'laplace'])
+def test_utility_gradient(mode):
+    model = design()
+    S = np.array([[2.3, 4.1], [7.7, 1.2]])
+    Utility, dUtility = model.utility_grad(S, mode=mode)
+    assert np.allclose(Utility, model.utility_batch(S, mode=mode), rtol=1.e-12, atol=0)
+    D = finite_difference(lambda S: model.utility_batch(S, mode=mode), S)
+    assert np.allclose(dUtility, D, rtol=1.e-5, atol=1.e-6*np.max(abs(D)))
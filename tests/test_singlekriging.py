@@ -0,0 +1,165 @@
+import numpy as np
+import pytest
+from multifidgp.factorization import Factorization, KroneckerFactorization
+from multifidgp.singlekriging import SingleKriging
+from multifidgp import tiling
+from test_multikriging import likelihood_fd
+
+
+def kriging_data(N=60, seed=0):
+    rng = np.random.default_rng(seed)
+    X = rng.uniform(0, 10, (N, 2))
+    return X, np.sin(X[:, 0]) + np.cos(0.5*X[:, 1])
+
+
+def test_vecchia_execute():
+    X, y = kriging_data()
+    model = SingleKriging(X[:, 0], y, [1., 4., 1.e-4], likelihood_mode='vecchia', n_neighbors=10)
+    xx = np.linspace(0, 10, 7)
+    mean, var = model.execute1D(xx)
+    assert mean.shape == (7,) and np.all(np.isfinite(mean)) and np.all(var >= 0)
+
+    model = SingleKriging(X, y, [1., 4., 1.e-4], likelihood_mode='vecchia', n_neighbors=10)
+    xx, yy = np.meshgrid(np.linspace(0, 10, 5), np.linspace(0, 10, 4))
+    mean, var = model.execute2D(xx, yy)
+    assert mean.shape == (4, 5) and np.all(np.isfinite(mean)) and np.all(var >= 0)
+
+    # simple kriging from the neighborhoods matches the exact one when they hold all sites
+    model.n_neighbors = len(X)
+    mean, var = model.execute2D(xx, yy)
+    exact = SingleKriging(X, y, [1., 4., 1.e-4])
+    state = exact.kriging_state(model.state.hyp)
+    state = state._replace(mu=0, beta=state.factor.solve(y))
+    mean_exact, var_exact = exact.predict(np.stack([xx.reshape(-1), yy.reshape(-1)], axis=1), state)
+    assert np.allclose(mean.reshape(-1), mean_exact, atol=1.e-8)
+    assert np.allclose(var.reshape(-1), var_exact, atol=1.e-8)
+
+
+def test_vecchia_likelihood():
+    X, y = kriging_data()
+    hyp = np.array([0.05])
+    model = SingleKriging(X, y, [1., 4., 1.e-4], likelihood_mode='vecchia', n_neighbors=10)
+    NLML, D_NLML = model.likelihood_vecchia(hyp)
+    # sigma*dL/dsigma, as in Gradient
+    D = hyp*likelihood_fd(lambda h: model.likelihood_vecchia(h)[0], hyp)
+    assert np.allclose(D_NLML, D, rtol=1.e-6, atol=0)
+
+    # conditioning on every preceding site is the exact likelihood
+    model.n_neighbors = len(X) - 1
+    NLML, D_NLML = model.likelihood_vecchia(hyp)
+    exact = SingleKriging(X, y, [1., 4., 1.e-4])
+    assert abs(NLML - exact.likelihood(hyp)) < 1.e-10*abs(NLML)
+    assert np.allclose(D_NLML, exact.Gradient(hyp), rtol=1.e-8, atol=0)
+
+
+@pytest.mark.parametrize('kernel', ['separable_exponential', 'separable_gaussian'])
+def test_kronecker_matches_dense(kernel):
+    rng = np.random.default_rng(0)
+    xx, yy = np.meshgrid(np.linspace(0, 10, 8), np.linspace(0, 10, 6))
+    X = np.stack([xx.reshape(-1), yy.reshape(-1)], axis=1)[rng.permutation(48)]
+    y = np.sin(X[:, 0]) + np.cos(0.5*X[:, 1])
+    mp = [1., 4., 1.e-3]
+    hyp = np.array([0.01])
+    model = SingleKriging(X, y, mp, kernel=kernel)
+    dense = SingleKriging(X, y, mp, kernel=kernel)
+    dense.blocks = dense.k(X, X, mp)   # skips the lattice detection
+    F = model.factorize(hyp)['factor']
+    F_dense = dense.factorize(hyp)['factor']
+    assert isinstance(F, KroneckerFactorization) and isinstance(F_dense, Factorization)
+
+    B = rng.standard_normal((48, 3))
+    assert np.allclose(F.solve(B), F_dense.solve(B), rtol=0, atol=1.e-12*np.max(abs(F_dense.solve(B))))
+    assert abs(F.logdet() - F_dense.logdet()) < 1.e-12*abs(F_dense.logdet())
+    assert np.allclose(F.inv_diag(), F_dense.inv_diag(), rtol=1.e-12, atol=0)
+    assert abs(model.likelihood(hyp) - dense.likelihood(hyp)) < 1.e-12*abs(dense.likelihood(hyp))
+    assert np.allclose(model.Gradient(hyp), dense.Gradient(hyp), rtol=1.e-12, atol=0)
+
+    # lattice points off the sites, where the nugget is not added by either path
+    model.state = model.kriging_state(hyp)
+    axes = [np.linspace(0.3, 9.7, 11), np.linspace(0.1, 9.9, 5)]
+    x_star = np.stack([x.reshape(-1) for x in np.meshgrid(*axes, indexing='ij')], axis=1)
+    mean, var = dense.predict(x_star, dense.kriging_state(hyp))
+    mean_grid, var_grid = model.predict_grid(axes)
+    assert np.allclose(mean_grid, mean, rtol=0, atol=1.e-12)
+    assert np.allclose(var_grid, var, rtol=0, atol=1.e-12)
+    mean_mesh, var_mesh = model.predict_meshgrid(np.meshgrid(*axes))
+    assert np.allclose(mean_mesh, mean.reshape(11, 5).T, rtol=0, atol=1.e-12)
+    assert np.allclose(var_mesh, var.reshape(11, 5).T, rtol=0, atol=1.e-12)
+
+
+@pytest.mark.parametrize('kernel', ['variogram', 'separable_exponential'])
+def test_add_observations_matches_rebuilt(kernel):
+    X, y = kriging_data()
+    hyp = np.array([0.05])
+    model = SingleKriging(X[:50], y[:50], [1., 4., 1.e-4], kernel=kernel)
+    model.state = model.kriging_state(hyp)
+    state = model.add_observations(X[50:], y[50:])
+    assert state.factor.cholesky == (kernel != 'variogram')
+
+    rebuilt = SingleKriging(X, y, [1., 4., 1.e-4], kernel=kernel)
+    rebuilt.state = rebuilt.kriging_state(hyp)
+    assert np.allclose(state.beta, rebuilt.state.beta, rtol=0, atol=1.e-11*np.max(abs(rebuilt.state.beta)))
+    x_star = np.random.default_rng(1).uniform(0, 10, (40, 2))
+    mean, var = model.predict(x_star)
+    mean_rebuilt, var_rebuilt = rebuilt.predict(x_star)
+    assert np.allclose(mean, mean_rebuilt, rtol=0, atol=1.e-12)
+    assert np.allclose(var, var_rebuilt, rtol=0, atol=1.e-12)
+
+
+def test_local_predict(monkeypatch):
+    X, y = kriging_data(N=200)
+    model = SingleKriging(X, y, [1., 1., 1.e-4], kernel='separable_exponential')
+    state = model.kriging_state(np.array([1.e-4]))
+    x_star = np.random.default_rng(1).uniform(1, 9, (40, 2))
+    mean, var = model.predict(x_star, state)
+    mean_local, var_local = model.predict(x_star, state, neighbors=40)
+    assert np.allclose(mean_local, mean, rtol=0, atol=1.e-3)
+    assert np.allclose(var_local, var, rtol=0, atol=1.e-6)
+
+    factored = []
+    class CountingFactorization(Factorization):
+        def __init__(self, K):
+            factored.append(len(K))
+            super().__init__(K)
+    monkeypatch.setattr('multifidgp.singlekriging.Factorization', CountingFactorization)
+    x_star = np.array([5., 5.]) + 1.e-6*np.random.default_rng(2).standard_normal((9, 2))
+    model.local_factors.clear()
+    model.predict(x_star, state, neighbors=40, budget=32*40*3)
+    model.predict(x_star, state, neighbors=40)
+    assert factored == [40] and len(model.local_factors.entries) == 1
+
+
+def test_tiled_predict():
+    X, y = kriging_data()
+    model = SingleKriging(X, y, [1., 4., 1.e-4])
+    model.state = model.kriging_state(np.array([0.05]))
+    x_star = np.random.default_rng(1).uniform(0, 10, (40, 2))
+    mean, var = model.predict_tile(x_star, model.state)
+    budget = 32*len(X)*3
+    assert tiling.tile_size(len(X), budget) == 3
+
+    mean_tiled, var_tiled = model.predict(x_star, budget=budget)
+    assert np.allclose(mean_tiled, mean, rtol=0, atol=1.e-14)
+    assert np.allclose(var_tiled, var, rtol=0, atol=1.e-14)
+
+    out = (np.empty(40), np.empty(40))
+    result = model.predict(x_star, out=out, budget=budget)
+    assert result[0] is out[0] and result[1] is out[1]
+    assert np.array_equal(out[0], mean_tiled) and np.array_equal(out[1], var_tiled)
+
+    tiles = list(model.predict(x_star, tiles=True, budget=budget))
+    assert [tile for tile, _, _ in tiles] == list(tiling.tile_slices(40, 3))
+    assert np.array_equal(np.concatenate([m for _, m, _ in tiles]), mean_tiled)
+    assert np.array_equal(np.concatenate([v for _, _, v in tiles]), var_tiled)
+
+
+@pytest.mark.parametrize('backend', ['thread', 'process'])
+def test_parallel_predict(backend):
+    X, y = kriging_data()
+    model = SingleKriging(X, y, [1., 4., 1.e-4])
+    model.state = model.kriging_state(np.array([0.05]))
+    x_star = np.random.default_rng(1).uniform(0, 10, (40, 2))
+    budget = 32*len(X)*3
+    mean, var = model.predict(x_star, budget=budget)
+    mean_par, var_par = model.predict(x_star, budget=budget, n_jobs=2, backend=backend)
+    assert np.array_equal(mean_par, mean) and np.array_equal(var_par, var)
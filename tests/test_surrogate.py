@@ -0,0 +1,39 @@
+import numpy as np
+from multifidgp import surrogate
+from multifidgp.singlekriging import SingleKriging
+from test_multibayesian_exp import design
+
+
+def test_surrogate_reaches_grid_optimum():
+    bnd = ((0, 10), (0, 10))
+    for seed in range(3):
+        model = design(seed, n_samples=100)
+        S = model.candidates(bnd, 0.5)
+        Utility = model.utility_batch(S)
+        smax = model.execute_surrogate(bnd, budget=30)
+        # within the best 2% of the grid in 30 evaluations, and reproducible from the seed
+        assert model.utility_batch(smax.reshape(1, -1))[0] <= np.sort(Utility)[len(S)//50]
+        assert np.array_equal(model.execute_surrogate(bnd, budget=30), smax)
+
+
+def test_surrogate_noisy_quadratic():
+    rng = np.random.default_rng(0)
+    noise = np.random.default_rng(1)
+    fun = lambda X: np.sum((X - [0.3, -0.2])**2, axis=1) + 0.05*noise.normal(size=len(X))
+    x_best, f_best, X, F = surrogate.minimize(fun, ((-1, 1), (-1, 1)), budget=40, rng=rng)
+    assert len(F) == 40
+    assert np.sqrt(np.sum((x_best - [0.3, -0.2])**2)) < 0.15
+
+
+def test_fit_noise(capsys):
+    rng = np.random.default_rng(0)
+    X = rng.uniform(-1, 1, (30, 2))
+    F = np.sum(X**2, axis=1) + 0.05*rng.normal(size=30)
+    model = SingleKriging(X, F, np.array([np.var(F), 1.5, 0.]), kernel='separable_gaussian')
+    state = surrogate.fit_noise(model)
+    assert capsys.readouterr().out == ''
+    # a minimum of the printed likelihood within the search interval
+    sigma_eps = state.hyp[0]
+    assert np.var(F)*1.e-6 < sigma_eps < np.var(F)
+    NLML = model.likelihood(state.hyp)
+    assert NLML <= model.likelihood(state.hyp*1.1) and NLML <= model.likelihood(state.hyp/1.1)
@@ -0,0 +1,17 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from multifidgp import tiling
+
+
+def test_concurrent_process_pools():
+    def sweep(offset):
+        def task(chunk):
+            time.sleep(0.01)
+            return chunk + offset
+        return list(tiling.map_tiles(task, range(20), n_jobs=2, backend='process'))
+
+    # each call keeps its own task while the other forks its workers
+    with ThreadPoolExecutor(2) as pool:
+        results = list(pool.map(sweep, [0, 100]))
+    assert results == [list(range(20)), list(range(100, 120))]